@@ -8,14 +8,20 @@
 from abc import ABC
 from typing import Optional
 
-from tenacity import retry, stop_after_attempt, wait_fixed
+from tenacity import retry, retry_if_not_exception_type, stop_after_attempt, wait_fixed
 
 from .action_output import ActionOutput
-from autoagents.system.llm import LLM
-from autoagents.system.utils.common import OutputParser
+from autoagents.system.config import CONFIG
+from autoagents.system.llm import LLM, route
+from autoagents.system.provider.metrics import calling
+from autoagents.system.provider.retry_policy import PROVIDER_ERRORS
+from autoagents.system.provider.router import GENERATION
+from autoagents.system.utils.common import IncrementalOutputParser, OutputParser
 from autoagents.system.logs import logger
 
 class Action(ABC):
+    task_class = GENERATION  # picks the model through LLM_ROUTES
+
     def __init__(self, name: str = '', context=None, llm: LLM = None, serpapi_api_key=None):
         self.name: str = name
         # if llm is None:
@@ -33,7 +39,7 @@ class Action(ABC):
         """Set prefix for later usage"""
         self.prefix = prefix
         self.profile = profile
-        self.llm = LLM(proxy, api_key)
+        self.llm = route(self.task_class, proxy, api_key)
         self.serpapi_api_key = serpapi_api_key
 
     def __str__(self):
@@ -47,9 +53,10 @@ class Action(ABC):
         if not system_msgs:
             system_msgs = []
         system_msgs.append(self.prefix)
-        return await self.llm.aask(prompt, system_msgs)
+        with calling(self.profile, str(self)):
+            return await self.llm.aask(prompt, system_msgs)
 
-    @retry(stop=stop_after_attempt(2), wait=wait_fixed(1))
+    @retry(stop=stop_after_attempt(2), wait=wait_fixed(1), retry=retry_if_not_exception_type(PROVIDER_ERRORS))
     async def _aask_v1(self, prompt: str, output_class_name: str,
                        output_data_mapping: dict,
                        system_msgs: Optional[list[str]] = None) -> ActionOutput:
@@ -57,9 +64,26 @@ class Action(ABC):
         if not system_msgs:
             system_msgs = []
         system_msgs.append(self.prefix)
-        content = await self.llm.aask(prompt, system_msgs)
-        logger.debug(content)
         output_class = ActionOutput.create_model_class(output_class_name, output_data_mapping)
+        if CONFIG.structured_output and self.llm.supports_structured_output:
+            with calling(self.profile, str(self)):
+                # the answer is validated before it may be cached, a retry must not get a broken one back
+                parsed_data = await self.llm.aask_json(prompt, output_class.schema(), output_class_name, system_msgs,
+                                                       check=lambda data: output_class(**data))
+            logger.debug(parsed_data)
+            instruct_content = output_class(**parsed_data)
+            # roles and later actions read the "## Block" text, render it from the structured answer
+            return ActionOutput(OutputParser.render_blocks(instruct_content.dict()), instruct_content)
+
+        # validates the blocks while they stream in and stops a malformed answer early
+        parser = IncrementalOutputParser(output_data_mapping, output_class)
+
+        def check(content):
+            output_class(**OutputParser.parse_data_with_mapping(content, output_data_mapping))
+
+        with calling(self.profile, str(self)):
+            content = await self.llm.aask(prompt, system_msgs, sinks=[parser], check=check)
+        logger.debug(content)
         parsed_data = OutputParser.parse_data_with_mapping(content, output_data_mapping)
         logger.debug(parsed_data)
         instruct_content = output_class(**parsed_data)
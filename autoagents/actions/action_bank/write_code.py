@@ -9,9 +9,10 @@ from .design_api import WriteDesign
 from autoagents.actions.action import Action
 from autoagents.system.const import WORKSPACE_ROOT
 from autoagents.system.logs import logger
+from autoagents.system.provider.retry_policy import PROVIDER_ERRORS
 from autoagents.system.schema import Message
 from autoagents.system.utils.common import CodeParser
-from tenacity import retry, stop_after_attempt, wait_fixed
+from tenacity import retry, retry_if_not_exception_type, stop_after_attempt, wait_fixed
 
 PROMPT_TEMPLATE = """
 NOTICE
@@ -66,7 +67,7 @@ class WriteCode(Action):
         code_path.write_text(code)
         logger.info(f"Saving Code to {code_path}")
 
-    @retry(stop=stop_after_attempt(2), wait=wait_fixed(1))
+    @retry(stop=stop_after_attempt(2), wait=wait_fixed(1), retry=retry_if_not_exception_type(PROVIDER_ERRORS))
     async def write_code(self, prompt):
         code_rsp = await self._aask(prompt)
         code = CodeParser.parse_code(block="", text=code_rsp)
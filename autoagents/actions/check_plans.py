@@ -3,6 +3,7 @@
 
 from typing import List, Tuple
 from .action import Action
+from autoagents.system.provider.router import CRITIQUE
 import re
 
 PROMPT_TEMPLATE = '''
@@ -64,6 +65,8 @@ TOOLS = 'None'
 
 
 class CheckPlans(Action):
+    task_class = CRITIQUE
+
     def __init__(self, name="Check Plan", context=None, llm=None):
         super().__init__(name, context, llm)
 
@@ -3,6 +3,7 @@
 
 from typing import List, Tuple
 from .action import Action
+from autoagents.system.provider.router import CRITIQUE
 import re
 import json
 
@@ -93,6 +94,8 @@ TOOLS = 'None'
 
 
 class CheckRoles(Action):
+    task_class = CRITIQUE
+
     def __init__(self, name="Check Roles", context=None, llm=None):
         super().__init__(name, context, llm)
 
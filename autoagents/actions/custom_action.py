@@ -108,6 +108,19 @@ class CustomAction(Action):
         with open(file_path, mode='w+', encoding='utf-8') as f:
             f.write(content)
         
+    def prompt(self, context, previous='', completed_steps=''):
+        """The prompt of the step `context`, also used to measure what the fixed part of it takes"""
+        tools = list(self.tool) + ['Print', 'Write File', 'Final Output']
+        return PROMPT_TEMPLATE.format(
+            context=context,
+            previous=previous,
+            role=self.role_prompt,
+            tool=str(tools),
+            suggestions=self.suggestions,
+            completed_steps=completed_steps,
+            format_example=FORMAT_EXAMPLE
+        )
+
     async def run(self, context):
         # steps = ''
         # for i, step in enumerate(list(self.steps)):
@@ -125,16 +138,7 @@ class CustomAction(Action):
         # print('-----------------------------------')
         # exit()
         
-        tools = list(self.tool) + ['Print', 'Write File', 'Final Output']
-        prompt = PROMPT_TEMPLATE.format(
-            context=task_context,
-            previous=previous_context,
-            role=self.role_prompt,
-            tool=str(tools),
-            suggestions=self.suggestions,
-            completed_steps=completed_steps,
-            format_example=FORMAT_EXAMPLE
-        )
+        prompt = self.prompt(task_context, previous_context, completed_steps)
 
         rsp = await self._aask_v1(prompt, "task", OUTPUT_MAPPING)
 
@@ -8,11 +8,12 @@
 """
 import asyncio
 import re
+from collections import defaultdict
 import json
 import datetime
 import websockets
 from common import MessageType, format_message, timestamp
-from typing import Iterable
+from typing import Iterable, Optional
 
 from pydantic import BaseModel, Field
 
@@ -20,15 +21,29 @@ from .roles import Role
 from .actions import Requirement
 from .roles import CustomRole, ActionObserver, Group, ROLES_LIST, ROLES_MAPPING
 
+from .system.config import CONFIG
+from .system.llm import route
+from .system.logs import logger
 from .system.memory import Memory
+from .system.memory.bounded_memory import RollingSummary
+from .system.message_bus import MessageBus
+from .system.provider.metrics import get_task_metrics
+from .system.provider.openai_api import get_cost_manager
+from .system.provider.router import GENERATION
 from .system.schema import Message
+from .system.utils.common import NoMoneyException
+from .system.utils.pricing import forecast_task_cost
 
 class Environment(BaseModel):
     """环境，承载一批角色，角色可以向环境发布消息，可以被其他角色观察到"""
 
     roles: dict[str, Role] = Field(default_factory=dict)
     memory: Memory = Field(default_factory=Memory)
+    bus: MessageBus = Field(default_factory=MessageBus)
     history: str = Field(default='')
+    history_messages: list = Field(default_factory=list)  # (message, tokens) in the history, with HISTORY_MAX_TOKENS
+    history_tokens: int = Field(default=0)
+    history_summary: Optional[RollingSummary] = Field(default=None)
     new_roles_args: dict = Field(default_factory=dict)
     new_roles: dict[str, Role] = Field(default_factory=dict)
     steps: list = Field(default_factory=list)
@@ -48,6 +63,8 @@ class Environment(BaseModel):
         """增加一个在当前环境的Role"""
         role.set_env(self)
         self.roles[role.profile] = role
+        # what was published before the role joined is waiting for it as well
+        self.bus.subscribe(role.profile, role._rc.watch, backlog=self.memory.get_by_actions(role._rc.watch))
 
     def add_roles(self, roles: Iterable[Role]):
         """增加一批在当前环境的Role"""
@@ -80,6 +97,51 @@ class Environment(BaseModel):
         steps.insert(0, '')
         return steps
     
+    def _check_forecast(self, plan: list, args: list):
+        """Reject a plan whose forecast cost exceeds what is left of the budget, before any of its steps runs.
+        Calls are assumed to be as large as the ones made so far, e.g. by the Manager."""
+        # Group runs the roles named before the ":" of a step
+        agents = [max(1, sum(1 for role in args if role['name'] in step.split(':')[0])) for step in plan if step]
+        llm = route(GENERATION, self.proxy, self.llm_api_key)
+        calls = get_task_metrics().calls if get_task_metrics() else []
+        if calls:
+            prompt_tokens = sum(i.prompt_tokens for i in calls) // len(calls)
+            completion_tokens = sum(i.completion_tokens for i in calls) // len(calls)
+        else:
+            prompt_tokens, completion_tokens = llm.context.max_prompt_tokens // 2, int(CONFIG.max_tokens_rsp)
+        forecast = forecast_task_cost(llm.model, agents, prompt_tokens, completion_tokens)
+
+        costs = get_cost_manager()
+        remaining = costs.total_budget - costs.total_cost
+        logger.info(f"Plan of {len(agents)} steps forecast: {forecast.calls} calls, ${forecast.cost:.3f}, "
+                    f"${remaining:.3f} left")
+        if forecast.cost > remaining:
+            raise NoMoneyException(costs.total_cost + forecast.cost,
+                                   f'The plan of {len(agents)} steps is forecast to cost ${forecast.cost:.3f} '
+                                   f'({forecast.calls} calls), only ${remaining:.3f} is left')
+
+    def _add_history(self, message: Message):
+        """Append the message to the history. Beyond HISTORY_MAX_TOKENS the oldest messages are folded into a
+        summary, so the history stays the same size however many messages the task publishes."""
+        limit = int(CONFIG.history_max_tokens)
+        if not limit:
+            self.history += f"\n{message}"
+            return
+        tokens = self.memory.count_tokens([message])[0]
+        self.history_messages.append((message, tokens))
+        self.history_tokens += tokens
+        if self.history_tokens <= limit:
+            self.history += f"\n{message}"
+            return
+        if not self.history_summary:
+            self.history_summary = RollingSummary(min(int(CONFIG.memory_summary_tokens), limit // 4), self.memory.model)
+        # the summary takes up to a quarter of the limit, the newest messages the rest
+        while self.history_tokens > limit - self.history_summary.max_tokens and len(self.history_messages) > 1:
+            evicted, tokens = self.history_messages.pop(0)
+            self.history_tokens -= tokens
+            self.history_summary.fold(evicted)
+        self.history = f"\n{self.history_summary.text}" + "".join(f"\n{i}" for i, _ in self.history_messages)
+
     def create_roles(self, plan: list, args: dict):
         """创建Role""" 
 
@@ -127,12 +189,15 @@ class Environment(BaseModel):
     async def publish_message(self, message: Message):
         """向当前环境发布信息"""
         # self.message_queue.put(message)
-        self.memory.add(message)
-        self.history += f"\n{message}"
+        if message not in self.memory:
+            self.memory.add(message)
+            self.bus.publish(message)
+        self._add_history(message)
 
         if 'Manager' in message.role:
             self.steps = self._parser_plan(message.content)
             self.new_roles_args = self._parser_roles(message.content)
+            self._check_forecast(self.steps, self.new_roles_args)
             self.new_roles = self.create_roles(self.steps, self.new_roles_args)
 
         filename, file_content = None, None
@@ -178,29 +243,44 @@ class Environment(BaseModel):
 
 
 
-    async def run(self, k=1):
-        """处理一次所有Role的运行"""
-        old_roles = []
-        for _ in range(k):
-            futures = []
-            for key in self.roles.keys():
-                old_roles.append(key)
-                role = self.roles[key]
-                future = role.run()
-                futures.append(future)
-            
-            await asyncio.gather(*futures)
-
-        if len(old_roles) < len(self.roles):
-            while len(self.get_role(name='Group').steps) > 0:
-                futures = []
-                for key in self.roles.keys():
-                    if key not in old_roles:
-                        role = self.roles[key]
-                        future = role.run()
-                        futures.append(future)
-
-                await asyncio.gather(*futures)
+    async def run(self, n_round: int = None):
+        """Run the roles that have messages in their inbox, each as soon as it gets them, until none has any left.
+        A role gets one run at a time, what arrives meanwhile wakes it again once it is done.
+
+        n_round: how often each role may be woken, plus once per step of the plan since Group runs one step per
+        wake-up. Only runs with news count, roles answering each other stop there instead of running forever.
+        None: no limit. The budget is checked before every wake-up."""
+        running: dict[str, asyncio.Task] = {}
+        wakeups: dict[str, int] = defaultdict(int)
+        planned = 0  # Group pops the steps it ran, remember how many there were
+        try:
+            while True:
+                self.bus.clear()
+                planned = max(planned, len(self.steps))
+                for name in self.bus.pending():
+                    if name in running or name not in self.roles:
+                        continue
+                    messages = self.bus.take(name)
+                    if n_round is not None and wakeups[name] >= n_round + planned:
+                        logger.warning(f"{name} was woken {wakeups[name]} times, the limit of the run, "
+                                       f"{len(messages)} messages left unhandled")
+                        continue
+                    get_cost_manager().check_budget()
+                    logger.debug(f"Waking {name} for {len(messages)} messages")
+                    running[name] = asyncio.create_task(self.roles[name].run(inbox=messages))
+                if not running:
+                    return
+                wakeup = asyncio.create_task(self.bus.wait())
+                done, _ = await asyncio.wait([wakeup, *running.values()], return_when=asyncio.FIRST_COMPLETED)
+                wakeup.cancel()
+                for name, task in list(running.items()):
+                    if task in done:
+                        del running[name]
+                        if task.result() is not None:  # a failed role stops the run
+                            wakeups[name] += 1  # a role without news did not use up a wake-up
+        finally:
+            for task in running.values():
+                task.cancel()
 
     def get_roles(self) -> dict[str, Role]:
         """获得环境内的所有Role"""
@@ -6,6 +6,7 @@
 @Modified From    : https://github.com/geekan/MetaGPT/blob/main/metagpt/software_company.py
 """
 from pydantic import BaseModel, Field
+from common import MessageType, format_message
 
 from .roles import Role
 from .actions import Requirement
@@ -13,8 +14,13 @@ from .environment import Environment
 
 from .system.config import CONFIG
 from .system.logs import logger
+from .system.provider.hedging import set_hedge_budget
+from .system.provider.metrics import get_task_metrics, start_task_metrics
+from .system.provider.openai_api import close_providers, get_cost_manager, start_task_costs
+from .system.provider.retry_policy import set_retry_budget
+from .system.provider.router import task_route_summary
+from .system.provider.streaming import LogSink, QueueSink, subscribe
 from .system.schema import Message
-from .system.utils.common import NoMoneyException
 
 
 class Explorer(BaseModel):
@@ -29,12 +35,10 @@ class Explorer(BaseModel):
 
     def invest(self, investment: float):
         self.investment = investment
-        CONFIG.max_budget = investment
         logger.info(f'Investment: ${investment}.')
 
     def _check_balance(self):
-        if CONFIG.total_cost > CONFIG.max_budget:
-            raise NoMoneyException(CONFIG.total_cost, f'Insufficient funds: {CONFIG.max_budget}')
+        get_cost_manager().check_budget()
 
     async def start_project(self, idea=None, llm_api_key=None, proxy=None, serpapi_key=None, task_id=None, alg_msg_queue=None):
         self.environment.llm_api_key = llm_api_key
@@ -42,17 +46,36 @@ class Explorer(BaseModel):
         self.environment.task_id = task_id
         self.environment.alg_msg_queue = alg_msg_queue
         self.environment.serpapi_key = serpapi_key
-        
+
+        if alg_msg_queue:
+            # forward partial LLM output to the websocket client while it is generated
+            subscribe(QueueSink(alg_msg_queue, lambda text: format_message(
+                action=MessageType.Stream.value, data={'task_id': task_id, 'delta': text})))
+        else:
+            subscribe(LogSink())
+
+        # costs, budgets and limits of this task stay apart from other tasks in the same process
+        start_task_costs(self.investment)
+        set_retry_budget(int(CONFIG.retry_budget))
+        set_hedge_budget(int(CONFIG.hedge_budget))
+        start_task_metrics(task_id)
+
         await self.environment.publish_message(Message(role="Question/Task", content=idea, cause_by=Requirement))
 
     def _save(self):
         logger.info(self.json())
 
     async def run(self, n_round=3):
-        while n_round > 0:
-            # self._save()
-            n_round -= 1
-            logger.debug(f"{n_round=}")
-            self._check_balance()
-            await self.environment.run()
+        # the environment runs until no role has anything left to do, at most n_round wake-ups per role
+        # (plus one per step of the plan), and checks the balance before every wake-up
+        self._check_balance()
+        try:
+            await self.environment.run(n_round)
+        finally:
+            # the pools belong to this task's event loop, left open they leak when it is torn down
+            await close_providers()
+        logger.info(f"LLM usage of the task per route: {task_route_summary()}")
+        task_metrics = get_task_metrics()
+        if task_metrics:
+            logger.info(f"LLM calls of the task: {task_metrics.to_json()}")
         return self.environment.history
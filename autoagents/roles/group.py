@@ -2,15 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import re
-import time
 from autoagents.actions import Action, ActionOutput
 from autoagents.roles import Role
 from autoagents.system.logs import logger
 from autoagents.system.schema import Message
 from autoagents.actions import NextAction, CustomAction, Requirement
 
-SLEEP_RATE = 30 # sleep between calls
-
 CONTENT_TEMPLATE ="""
 ## Previous Steps and Responses
 {previous}
@@ -68,12 +65,27 @@ class Group(Role):
             self.next_step = ''
             self.next_role = ''
 
+    def _context(self, history: list[Message], sizes: list[int], completed_steps: str) -> str:
+        """The previous steps and the completed substeps, in full while the prompt of the action fits. Past that they
+        share what the current step and the prompt of the action leave of the context window, as in Role._think"""
+        window = self._llm.context
+        todo = self._rc.todo
+        budget = max(0, window.max_prompt_tokens - window.count(todo.prefix + todo.prompt(self.next_step)))
+        completed_tokens = window.count(completed_steps)
+        if sum(sizes) + completed_tokens > budget:
+            # the completed substeps keep up to half of it, the previous steps get the rest
+            history = window.fit_history(history, budget - min(completed_tokens, budget // 2), sizes=sizes)
+            completed_steps = window.truncate(completed_steps, max(0, budget - window.count(str(history))))
+        message = CONTENT_TEMPLATE.format(previous=str(history), step=self.next_step)
+        return message + f"\n### Completed Steps and Responses\n{completed_steps}\n###"
+
     async def _act(self) -> Message:
         if self.next_step == '':
             return Message(content='', role='')
         
         completed_steps, num_steps = '', 5
-        message = CONTENT_TEMPLATE.format(previous=str(self._rc.important_memory), step=self.next_step)
+        important_memory = self._rc.important_memory
+        sizes = self._rc.memory.count_tokens(important_memory, self._llm.context.model)
         # context = str(self._rc.important_memory) + addition
 
         steps, consensus = 0, [0 for i in self.next_state]
@@ -86,15 +98,13 @@ class Group(Role):
                 self._set_state(state)
                 logger.info(f"{self._setting}: ready to {self._rc.todo}")
 
-                addition = f"\n### Completed Steps and Responses\n{completed_steps}\n###"
-                context = message + addition
+                context = self._context(important_memory, sizes, completed_steps)
                 response = await self._rc.todo.run(context)
 
                 if hasattr(response.instruct_content, 'Action'):
                     completed_steps += f'>{self._rc.todo} Substep:\n' + response.instruct_content.Action + '\n>Subresponse:\n' + response.instruct_content.Response + '\n'
                 else:
                     consensus[i] = 1
-                time.sleep(SLEEP_RATE)
 
             steps += 1
 
@@ -107,21 +117,3 @@ class Group(Role):
         # self._rc.memory.add(msg)
 
         return msg
-
-    async def _observe(self) -> int:
-        """从环境中观察，获得全部重要信息，并加入记忆"""
-        if not self._rc.env:
-            return 0
-        env_msgs = self._rc.env.memory.get()
-        
-        observed = self._rc.env.memory.get_by_actions(self._rc.watch)
-        
-        news = self._rc.memory.remember(observed)  # remember recent exact or similar memories
-
-        for i in env_msgs:
-            self.recv(i)
-
-        news_text = [f"{i.role}: {i.content[:20]}..." for i in news]
-        if news_text:
-            logger.debug(f'{self._setting} observed: {news_text}')
-        return len(news)
\ No newline at end of file
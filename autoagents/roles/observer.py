@@ -21,20 +21,8 @@ class ObserverPlans(Role):
         self._init_actions([CheckPlans])
         self._watch([CreateRoles,CheckRoles])
 
-    async def _observe(self) -> int:
-        """从环境中观察，获得全部重要信息，并加入记忆"""
-        if not self._rc.env:
-            return 0
-        env_msgs = self._rc.env.memory.get()
-        
-        observed = self._rc.env.memory.get_by_and_actions(self._rc.watch)
-        
-        news = self._rc.memory.remember(observed)  # remember recent exact or similar memories
-
-        for i in env_msgs:
-            self.recv(i)
-
-        news_text = [f"{i.role}: {i.content[:20]}..." for i in news]
-        if news_text:
-            logger.debug(f'{self._setting} observed: {news_text}')
-        return len(news)
\ No newline at end of file
+    def _watched(self, messages):
+        """Plans are checked once both the roles and their check exist, from then on every new one is"""
+        if not self._rc.env.memory.get_by_and_actions(self._rc.watch):
+            return []
+        return super()._watched(messages)
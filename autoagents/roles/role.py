@@ -10,9 +10,12 @@ from pydantic import BaseModel, Field
 # from autoagents.environment import Environment
 from autoagents.actions import Action, ActionOutput
 from autoagents.system.config import CONFIG
-from autoagents.system.llm import LLM
+from autoagents.system.llm import route
 from autoagents.system.logs import logger
-from autoagents.system.memory import Memory, LongTermMemory
+from autoagents.system.memory import BoundedMemory, Memory, LongTermMemory
+from autoagents.system.provider.metrics import calling
+from autoagents.system.provider.openai_api import get_cost_manager
+from autoagents.system.provider.router import CLASSIFICATION, GENERATION, SUMMARIZATION
 from autoagents.system.schema import Message
 
 PREFIX_TEMPLATE = """You are a {profile}, named {name}, your goal is {goal}, and the constraint is {constraints}. """
@@ -66,6 +69,7 @@ class RoleContext(BaseModel):
     state: int = Field(default=0)
     todo: Action = Field(default=None)
     watch: set[Type[Action]] = Field(default_factory=set)
+    env_seq: int = Field(default=0)  # watermark: the environment messages up to this one have been observed
 
     class Config:
         arbitrary_types_allowed = True
@@ -74,6 +78,10 @@ class RoleContext(BaseModel):
         if hasattr(CONFIG, "long_term_memory") and CONFIG.long_term_memory:
             self.long_term_memory.recover_memory(role_id, self)
             self.memory = self.long_term_memory  # use memory to act as long_term_memory for unify operation
+        elif BoundedMemory.configured() and not isinstance(self.memory, BoundedMemory):
+            memory = BoundedMemory.from_config(self.watch)
+            memory.add_batch(self.memory.storage)
+            self.memory = memory
 
     @property
     def important_memory(self) -> list[Message]:
@@ -89,7 +97,9 @@ class Role:
     """角色/代理"""
 
     def __init__(self, name="", profile="", goal="", constraints="", desc="", proxy="", llm_api_key="", serpapi_api_key=""):
-        self._llm = LLM(proxy, llm_api_key)
+        self._llm = route(GENERATION, proxy, llm_api_key)
+        # choosing the next state only needs a digit back, a cheaper model can do it
+        self._think_llm = route(CLASSIFICATION, proxy, llm_api_key)
         self._setting = RoleSetting(name=name, profile=profile, goal=goal, constraints=constraints, desc=desc)
         self._states = []
         self._actions = []
@@ -150,9 +160,15 @@ class Role:
             self._set_state(0)
             return
         prompt = self._get_prefix()
-        prompt += STATE_TEMPLATE.format(history=self._rc.history, states="\n".join(self._states),
-                                        n_states=len(self._states) - 1)
-        next_state = await self._llm.aask(prompt)
+        states = "\n".join(self._states)
+        # the history gets whatever the rest of the prompt leaves of the context window
+        context = self._think_llm.context
+        history = self._rc.history
+        budget = context.max_prompt_tokens - context.count(prompt + STATE_TEMPLATE + states)
+        history = context.fit_history(history, budget, sizes=self._rc.memory.count_tokens(history, context.model))
+        prompt += STATE_TEMPLATE.format(history=history, states=states, n_states=len(self._states) - 1)
+        with calling(self.profile, "think"):
+            next_state = await self._think_llm.aask(prompt)
         logger.debug(f"{prompt=}")
         if not next_state.isdigit() or int(next_state) not in range(len(self._states)):
             logger.warning(f'Invalid answer of state, {next_state=}')
@@ -177,14 +193,16 @@ class Role:
 
         return msg
 
-    async def _observe(self) -> int:
-        """从环境中观察，获得重要信息，并加入记忆"""
+    async def _observe(self, inbox: list[Message] = None) -> int:
+        """从环境中观察，获得重要信息，并加入记忆
+        inbox: the messages the environment delivered to us, they are the news instead of what is new in its memory"""
         if not self._rc.env:
             return 0
-        env_msgs = self._rc.env.memory.get()
-        
-        observed = self._rc.env.memory.get_by_actions(self._rc.watch)
-        
+        # only what was published since the last observation is looked at, and kept as history
+        env_msgs, self._rc.env_seq = self._rc.env.memory.since(self._rc.env_seq)
+
+        observed = self._watched(env_msgs if inbox is None else inbox)
+
         news = self._rc.memory.remember(observed)  # remember recent exact or similar memories
 
         for i in env_msgs:
@@ -195,6 +213,10 @@ class Role:
             logger.debug(f'{self._setting} observed: {news_text}')
         return len(news)
 
+    def _watched(self, messages: list[Message]) -> list[Message]:
+        """The messages caused by the actions we watch"""
+        return [i for i in messages if i.cause_by in self._rc.watch]
+
     async def _publish_message(self, msg):
         """如果role归属于env，那么role的消息会向env广播"""
         if not self._rc.env:
@@ -202,6 +224,20 @@ class Role:
             return
         await self._rc.env.publish_message(msg)
 
+    def _report_budget(self):
+        """Tell which of our calls the budget shortened or downgraded, their answers may be cut short or rougher"""
+        for admission in get_cost_manager().pop_admissions(self.profile):
+            logger.warning(f"{self._setting}: ran on a tight budget, {admission.action} was {admission.decision} "
+                           f"to {admission.model} with max_tokens {admission.max_tokens}")
+
+    async def _summarize_memory(self):
+        """Condense what the bounded memory evicted since the last time, when MEMORY_SUMMARY is "llm" """
+        memory = self._rc.memory
+        if not isinstance(memory, BoundedMemory) or memory.summary_mode != "llm" or not memory.stale():
+            return
+        with calling(self.profile, "summarize"):
+            await memory.summarize(route(SUMMARIZATION, self._proxy, self._llm_api_key))
+
     async def _react(self) -> Message:
         """先想，然后再做"""
         await self._think()
@@ -212,7 +248,7 @@ class Role:
         """add message to history."""
         # self._history += f"\n{message}"
         # self._context = self._history
-        if message in self._rc.memory.get():
+        if message in self._rc.memory:
             return
         self._rc.memory.add(message)
 
@@ -223,8 +259,9 @@ class Role:
 
         return await self._react()
 
-    async def run(self, message=None):
-        """观察，并基于观察的结果思考、行动"""
+    async def run(self, message=None, inbox: list[Message] = None):
+        """观察，并基于观察的结果思考、行动
+        inbox: the messages the environment took from our inbox for this run"""
         if message:
             if isinstance(message, str):
                 message = Message(message)
@@ -232,11 +269,13 @@ class Role:
                 self.recv(message)
             if isinstance(message, list):
                 self.recv(Message("\n".join(message)))
-        elif not await self._observe():
+        elif not await self._observe(inbox):
             # 如果没有任何新信息，挂起等待
             logger.debug(f"{self._setting}: no news. waiting.")
             return
         rsp = await self._react()
+        self._report_budget()
+        await self._summarize_memory()
         # 将回复发布到环境，等待下一个订阅者处理
         await self._publish_message(rsp)
         return rsp
@@ -57,11 +57,22 @@ class Config(metaclass=Singleton):
         self.openai_api_type = self._get("OPENAI_API_TYPE")
         self.openai_api_version = self._get("OPENAI_API_VERSION")
         self.openai_api_rpm = self._get("RPM", 3)
+        self.openai_api_tpm = self._get("TPM", 0)  # 0 means no tokens-per-minute limit
         self.openai_api_model = self._get("OPENAI_API_MODEL", "gpt-4")
         self.max_tokens_rsp = self._get("MAX_TOKENS", 2048)
         self.deployment_id = self._get("DEPLOYMENT_ID")
-
+        self.retry_budget = self._get("RETRY_BUDGET", 20)
+        self.circuit_breaker_threshold = self._get("CIRCUIT_BREAKER_THRESHOLD", 5)
+        self.circuit_breaker_reset = self._get("CIRCUIT_BREAKER_RESET", 60)
+        self.hedge_requests = self._get("HEDGE_REQUESTS", False)
+        self.hedge_percentile = self._get("HEDGE_PERCENTILE", 95)
+        self.hedge_budget = self._get("HEDGE_BUDGET", 10)
+        self.llm_routes = self._get("LLM_ROUTES", {})
+        self.structured_output = self._get("STRUCTURED_OUTPUT", False)
+
+        self.llm_provider = self._get("LLM_PROVIDER", "openai")
         self.claude_api_key = self._get('Anthropic_API_KEY')
+        self.claude_api_model = self._get('Anthropic_API_MODEL', "claude-2")
         self.serpapi_api_key = self._get("SERPAPI_API_KEY")
         self.serper_api_key = self._get("SERPER_API_KEY")
         self.google_api_key = self._get("GOOGLE_API_KEY")
@@ -76,7 +87,24 @@ class Config(metaclass=Singleton):
         if self.long_term_memory:
             logger.warning("LONG_TERM_MEMORY is True")
         self.max_budget = self._get("MAX_BUDGET", 10.0)
-        self.total_cost = 0.0
+        self.budget_fallback_models = self._get("BUDGET_FALLBACK_MODELS", [])
+        self.budget_min_completion_tokens = self._get("BUDGET_MIN_COMPLETION_TOKENS", 256)
+        self.budget_max_admissions = self._get("BUDGET_MAX_ADMISSIONS", 256)
+        self.llm_models = self._get("LLM_MODELS", {})
+        self.llm_default_price = self._get("LLM_DEFAULT_PRICE")
+        self.forecast_rounds = self._get("FORECAST_ROUNDS", 2)
+        self.memory_max_messages = self._get("MEMORY_MAX_MESSAGES", 0)
+        self.memory_max_tokens = self._get("MEMORY_MAX_TOKENS", 0)
+        self.memory_eviction = self._get("MEMORY_EVICTION", "fifo")
+        self.memory_pinned_actions = self._get("MEMORY_PINNED_ACTIONS", ["Requirement"])
+        self.memory_action_weights = self._get("MEMORY_ACTION_WEIGHTS", {})
+        self.memory_summary = self._get("MEMORY_SUMMARY", "extractive")
+        self.memory_summary_tokens = self._get("MEMORY_SUMMARY_TOKENS", 512)
+        self.history_max_tokens = self._get("HISTORY_MAX_TOKENS", 0)
+
+        self.llm_cache = self._get("LLM_CACHE", "off")
+        self.llm_cache_path = self._get("LLM_CACHE_PATH")
+        self.llm_cache_size_mb = self._get("LLM_CACHE_SIZE_MB", 256)
 
     def _init_with_config_files_and_env(self, configs: dict, yaml_file):
         """从config/key.yaml / config/config.yaml / env三处按优先级递减加载"""
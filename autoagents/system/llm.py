@@ -4,10 +4,25 @@
 @File    : llm.py
 @From    : https://github.com/geekan/MetaGPT/blob/main/metagpt/llm.py
 """
+from .config import CONFIG
 from .provider.anthropic_api import Claude2 as Claude
 from .provider.openai_api import OpenAIGPTAPI as LLM
+from .provider.router import RoutedLLM, Router
 
-DEFAULT_LLM = LLM()
+
+def get_llm(proxy='', api_key='', model=''):
+    """Return the LLM shared by every role and action using the same key, base, proxy and model"""
+    if CONFIG.llm_provider == "anthropic":
+        return Claude.shared(proxy, api_key, model)
+    return LLM.shared(proxy, api_key, model)
+
+
+def route(task_class: str, proxy='', api_key=''):
+    """Return the LLM for a call site asking for `task_class`, with the model LLM_ROUTES picks for it"""
+    return RoutedLLM(task_class, get_llm(proxy, api_key, Router().model(task_class)))
+
+
+DEFAULT_LLM = get_llm()
 CLAUDE_LLM = Claude()
 
 
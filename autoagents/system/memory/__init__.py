@@ -2,5 +2,6 @@
 # -*- coding: utf-8 -*-
 
 from .memory import Memory
+from .bounded_memory import BoundedMemory, EvictionPolicy, EVICTION_POLICIES
 from .longterm_memory import LongTermMemory
 
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : bounded_memory.py
+@Desc    : a Memory capped in messages and tokens, folding what it evicts into rolling summaries
+"""
+import re
+from collections import deque
+from typing import Iterable, Optional, Type
+
+from autoagents.actions import Action
+from autoagents.system.config import CONFIG
+from autoagents.system.logs import logger
+from autoagents.system.schema import Message
+from autoagents.system.utils.token_counter import count_string_tokens
+from .memory import Memory
+
+SUMMARY_PROMPT = """Below are notes on earlier messages of a conversation, oldest first.
+Rewrite them as one concise summary in at most {limit} tokens. Keep decisions, results, names and numbers, drop \
+everything else. Answer with the summary only.
+
+{notes}
+"""
+
+
+def extract(message: Message, max_chars: int = 200) -> str:
+    """The gist of a message: who said it and the first sentence of its first line of text"""
+    lines = [i.strip() for i in message.content.splitlines()]
+    lines = [i for i in lines if i and not i.startswith(("#", "```"))]
+    sentence = re.split(r"(?<=[.!?。])\s", lines[0], 1)[0] if lines else ""
+    if len(sentence) > max_chars:
+        sentence = sentence[:max_chars] + "..."
+    return f"{message.role}: {sentence}"
+
+
+class RollingSummary:
+    """Summary of evicted messages: one extracted line each, the oldest lines dropped beyond `max_tokens`.
+    An LLM may condense it into a single paragraph, to which the following evictions are appended again."""
+
+    def __init__(self, max_tokens: int, model: str):
+        self.max_tokens = max_tokens
+        self.model = model
+        self.lines: deque[tuple[str, int]] = deque()
+        self.tokens = 0
+        self.folded = 0  # number of messages summarised
+        self.stale = False  # lines were appended since the last LLM pass
+
+    def fold(self, message: Message):
+        self.append(extract(message))
+        self.folded += 1
+        self.stale = True
+
+    def append(self, line: str):
+        tokens = count_string_tokens(line, self.model)
+        self.lines.append((line, tokens))
+        self.tokens += tokens
+        while self.tokens > self.max_tokens and len(self.lines) > 1:
+            self.tokens -= self.lines.popleft()[1]
+
+    def replace(self, text: str):
+        self.lines.clear()
+        self.tokens = 0
+        self.append(text.strip())
+        self.stale = False
+
+    @property
+    def notes(self) -> str:
+        return "\n".join(line for line, _ in self.lines)
+
+    @property
+    def text(self) -> str:
+        return f"Summary of {self.folded} earlier messages:\n{self.notes}"
+
+
+class EvictionPolicy:
+    """Picks the message a full BoundedMemory gives up, None when all of them have to be kept"""
+
+    def victim(self, candidates: list[Message]) -> Optional[Message]:
+        raise NotImplementedError
+
+
+def _named(action: Type[Action], names) -> Optional[str]:
+    """The first name of `action` or of its base classes found in `names`, so Requirement covers Requirement_Group"""
+    if not isinstance(action, type):
+        return None
+    return next((i.__name__ for i in action.__mro__ if i.__name__ in names), None)
+
+
+class FIFOEviction(EvictionPolicy):
+    """The oldest message goes first"""
+
+    def victim(self, candidates: list[Message]) -> Optional[Message]:
+        return candidates[0] if candidates else None
+
+
+class PinnedEviction(EvictionPolicy):
+    """The oldest message goes first, unless its action is one of the pinned, e.g. the task of the Requirement"""
+
+    def __init__(self, pinned: Iterable[str] = ("Requirement",)):
+        self.pinned = set(pinned)
+
+    def victim(self, candidates: list[Message]) -> Optional[Message]:
+        return next((i for i in candidates if not _named(i.cause_by, self.pinned)), None)
+
+
+class ImportanceEviction(EvictionPolicy):
+    """The least important message goes first: the weight of its action, halved every `half_life` newer messages.
+    Actions have the weight given in `weights`, else 2 when the role watches them and 1 otherwise."""
+
+    def __init__(self, weights: dict = None, watched: set = None, half_life: int = 10):
+        self.weights = weights or {}
+        self.watched = watched if watched is not None else set()
+        self.half_life = half_life
+
+    def weight(self, message: Message) -> float:
+        name = _named(message.cause_by, self.weights)
+        if name:
+            return float(self.weights[name])
+        return 2.0 if message.cause_by in self.watched else 1.0
+
+    def victim(self, candidates: list[Message]) -> Optional[Message]:
+        if not candidates:
+            return None
+        last = len(candidates) - 1
+        return min(enumerate(candidates),
+                   key=lambda i: self.weight(i[1]) * 0.5 ** ((last - i[0]) / self.half_life))[1]
+
+
+EVICTION_POLICIES = {"fifo": FIFOEviction, "pinned": PinnedEviction, "importance": ImportanceEviction}
+
+
+class BoundedMemory(Memory):
+    """Memory of at most `max_messages` messages and `max_tokens` tokens (0: no limit), the newest always stays.
+
+    The messages `policy` evicts are folded into a rolling summary per action, capped at `summary_tokens`. The
+    summaries lead the results of `get()` and of the action lookups, so prompts keep the gist of what was evicted
+    and stay the same size however long the task runs. summary: "extractive", "llm" (extractive until `summarize`
+    condenses it) or "off".
+    """
+
+    def __init__(self, max_messages: int = 0, max_tokens: int = 0, policy: EvictionPolicy = None,
+                 summary: str = "extractive", summary_tokens: int = 512, model: str = None):
+        super().__init__(model)
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.policy = policy or FIFOEviction()
+        self.summary_mode = summary
+        self.summary_tokens = summary_tokens
+        self.summaries: dict[Type[Action], RollingSummary] = {}  # cause_by -> summary of its evicted messages
+        self._summary_messages: dict[Type[Action], Message] = {}
+
+    @classmethod
+    def configured(cls) -> bool:
+        return bool(CONFIG.memory_max_messages or CONFIG.memory_max_tokens)
+
+    @classmethod
+    def from_config(cls, watched: set = None) -> "BoundedMemory":
+        """The memory of a role watching `watched`, set up by the MEMORY_* keys of config.yaml"""
+        name = CONFIG.memory_eviction
+        if name == "importance":
+            policy = ImportanceEviction(CONFIG.memory_action_weights, watched)
+        elif name == "pinned":
+            policy = PinnedEviction(CONFIG.memory_pinned_actions)
+        else:
+            policy = EVICTION_POLICIES.get(name, FIFOEviction)()
+        return cls(int(CONFIG.memory_max_messages), int(CONFIG.memory_max_tokens), policy,
+                   CONFIG.memory_summary, int(CONFIG.memory_summary_tokens))
+
+    def _over(self) -> bool:
+        return (self.max_messages and len(self.storage) > self.max_messages) or \
+            (self.max_tokens and self.total_tokens > self.max_tokens)
+
+    def add(self, message: Message):
+        if message in self:
+            return
+        super().add(message)
+        while self._over():
+            victim = self.policy.victim(self.storage[:-1])
+            if victim is None:
+                logger.debug("Memory over its limit, but every message is pinned")
+                return
+            self.evict(victim)
+
+    def evict(self, message: Message):
+        self.delete(message)
+        if self.summary_mode == "off":
+            return
+        action = message.cause_by or None
+        if action not in self.summaries:
+            self.summaries[action] = RollingSummary(self.summary_tokens, self.model)
+        self.summaries[action].fold(message)
+        self._summary_changed(action)
+
+    def _summary_changed(self, action: Type[Action]):
+        self._summary_messages.pop(action, None)
+        if action:
+            self._invalidate(action)
+
+    def summary(self, action: Type[Action] = None) -> Optional[Message]:
+        """The summary of the evicted messages of `action` as a message"""
+        if action not in self._summary_messages:
+            if action not in self.summaries:
+                return None
+            self._summary_messages[action] = Message(content=self.summaries[action].text, role="Summary",
+                                                     cause_by=action or "")
+        return self._summary_messages[action]
+
+    def _view(self, actions: tuple) -> list[Message]:
+        summaries = [self.summary(action) for action in actions if action in self.summaries]
+        return summaries + super()._view(actions)
+
+    def get(self, k=0) -> list[Message]:
+        """The most recent k messages, or the summaries followed by all messages when k=0"""
+        if k:
+            return super().get(k)
+        return [self.summary(action) for action in self.summaries] + super().get()
+
+    def clear(self):
+        super().clear()
+        self.summaries = {}
+        self._summary_messages = {}
+
+    def stale(self) -> bool:
+        return any(i.stale for i in self.summaries.values())
+
+    async def summarize(self, llm):
+        """Condense every summary with new extracted lines into one paragraph with `llm`"""
+        for action, summary in self.summaries.items():
+            if not summary.stale:
+                continue
+            rsp = await llm.aask(SUMMARY_PROMPT.format(limit=self.summary_tokens, notes=summary.notes))
+            summary.replace(rsp)
+            self._summary_changed(action)
@@ -2,29 +2,69 @@
 # -*- coding: utf-8 -*-
 # Modified from https://github.com/geekan/MetaGPT/blob/main/metagpt/memory/memory.py
 
+import re
+from bisect import bisect_right
 from collections import defaultdict
 from typing import Iterable, Type
 
 from autoagents.actions import Action
+from autoagents.system.config import CONFIG
 from autoagents.system.schema import Message
+from autoagents.system.utils.token_counter import count_string_tokens, count_tokens_batch, get_encoding
+
+
+WORD = re.compile(r"\w+")
+
+
+def default_model() -> str:
+    return CONFIG.claude_api_model if CONFIG.llm_provider == "anthropic" else CONFIG.openai_api_model
 
 
 class Memory:
     """The most basic memory: super-memory"""
 
-    def __init__(self):
-        """Initialize an empty storage list and an empty index dictionary"""
+    def __init__(self, model: str = None):
+        """Initialize an empty storage list and an empty index dictionary.
+        model: whose encoding the messages are counted in when they are added"""
         self.storage: list[Message] = []
+        self.seqs: list[int] = []  # sequence number of every stored message, increasing, never reused
+        self.last_seq = 0
         self.index: dict[Type[Action], list[Message]] = defaultdict(list)
+        self.ids: dict[str, list[Message]] = {}  # Message.id -> the stored messages with it, more than one on collision
+        # secondary indexes, their lists are in storage order
+        self.by_role: dict[str, list[Message]] = defaultdict(list)
+        self.by_sender: dict[str, list[Message]] = defaultdict(list)
+        self.by_receiver: dict[str, list[Message]] = defaultdict(list)
+        self.words: dict[str, dict[int, Message]] = defaultdict(dict)  # lowercase word -> {id(message): message}
+        self._views: dict[tuple, list[Message]] = {}  # get_by_actions results, dropped when one of the actions changes
+        self.model = model or default_model()
+        self.tokens: dict[str, int] = {}  # Message.id -> token count of str(message), as it appears in prompts
+        self.total_tokens = 0
+
+    def __contains__(self, message: Message) -> bool:
+        """O(1) membership through the hash index instead of comparing against every stored message"""
+        return any(i is message or i == message for i in self.ids.get(message.id, ()))
 
     def add(self, message: Message):
         """Add a new message to storage, while updating the index"""
 
-        if message in self.storage:
+        if message in self:
             return
+        self.last_seq += 1
         self.storage.append(message)
+        self.seqs.append(self.last_seq)
+        self.ids.setdefault(message.id, []).append(message)
         if message.cause_by:
             self.index[message.cause_by].append(message)
+            self._invalidate(message.cause_by)
+        self.by_role[message.role].append(message)
+        self.by_sender[message.sent_from].append(message)
+        self.by_receiver[message.send_to].append(message)
+        for word in set(WORD.findall(message.content.lower())):
+            self.words[word][id(message)] = message
+        tokens = count_string_tokens(str(message), self.model)
+        self.tokens[message.id] = tokens
+        self.total_tokens += tokens
 
 
     def add_batch(self, messages: Iterable[Message]):
@@ -33,22 +73,77 @@ class Memory:
 
     def get_by_role(self, role: str) -> list[Message]:
         """Return all messages of a specified role"""
-        return [message for message in self.storage if message.role == role]
+        return list(self.by_role.get(role, []))
+
+    def get_by_sender(self, sent_from: str) -> list[Message]:
+        return list(self.by_sender.get(sent_from, []))
+
+    def get_by_receiver(self, send_to: str) -> list[Message]:
+        return list(self.by_receiver.get(send_to, []))
 
     def get_by_content(self, content: str) -> list[Message]:
         """Return all messages containing a specified content"""
-        return [message for message in self.storage if content in message.content]
+        return self._containing(content)
+
+    def _containing(self, text: str) -> list[Message]:
+        """Stored messages with `text` as a substring of their content. The inverted index only narrows down the
+        candidates: a word at either end of `text` may be part of a longer word of a message, the ones inside may not"""
+        lowered = text.lower()
+        words = {i.group() for i in WORD.finditer(lowered) if 0 < i.start() and i.end() < len(lowered)}
+        candidates = self._with_words(words) if words else self.storage
+        return [message for message in candidates if text in message.content]
+
+    def _with_words(self, words: set[str]) -> list[Message]:
+        """Stored messages having all of `words`, through the inverted index"""
+        postings = sorted((self.words.get(word, {}) for word in words), key=len)
+        return [message for key, message in postings[0].items() if all(key in i for i in postings[1:])]
 
     def delete(self, message: Message):
         """Delete the specified message from storage, while updating the index"""
-        self.storage.remove(message)
+        i = self.storage.index(message)
+        del self.storage[i]
+        del self.seqs[i]
         if message.cause_by and message in self.index[message.cause_by]:
             self.index[message.cause_by].remove(message)
+            self._invalidate(message.cause_by)
+        for index, key in ((self.by_role, message.role), (self.by_sender, message.sent_from),
+                           (self.by_receiver, message.send_to)):
+            if message in index.get(key, []):
+                index[key].remove(message)
+        for word in set(WORD.findall(message.content.lower())):
+            self.words.get(word, {}).pop(id(message), None)
+        bucket = self.ids.get(message.id, [])
+        if message in bucket:
+            bucket.remove(message)
+        if not bucket:
+            self.ids.pop(message.id, None)
+            self.total_tokens -= self.tokens.pop(message.id, 0)
 
     def clear(self):
         """Clear storage and index"""
         self.storage = []
+        self.seqs = []
         self.index = defaultdict(list)
+        self.ids = {}
+        self.by_role = defaultdict(list)
+        self.by_sender = defaultdict(list)
+        self.by_receiver = defaultdict(list)
+        self.words = defaultdict(dict)
+        self._views = {}
+        self.tokens = {}
+        self.total_tokens = 0
+
+    def count_tokens(self, messages: list[Message], model: str = None) -> list[int]:
+        """Token counts of `messages`, taken from the counts made at add time when they are stored here and
+        `model` shares our encoding, so budgeting a history costs O(new messages) rather than O(history)"""
+        if model and get_encoding(model).name != get_encoding(self.model).name:
+            return count_tokens_batch([str(i) for i in messages], model)
+        counts = [self.tokens.get(i.id) for i in messages]
+        missing = [str(i) for i, count in zip(messages, counts) if count is None]
+        if missing:
+            computed = iter(count_tokens_batch(missing, self.model))
+            counts = [next(computed) if count is None else count for count in counts]
+        return counts
 
     def count(self) -> int:
         """Return the number of messages in storage"""
@@ -56,7 +151,12 @@ class Memory:
 
     def try_remember(self, keyword: str) -> list[Message]:
         """Try to recall all messages containing a specified keyword"""
-        return [message for message in self.storage if keyword in message.content]
+        return self._containing(keyword)
+
+    def since(self, seq: int) -> tuple[list[Message], int]:
+        """Messages added after sequence number `seq`, oldest first, and the number to ask from next time.
+        Readers keep that watermark, so each of them only ever looks at what is new to it."""
+        return self.storage[bisect_right(self.seqs, seq):], self.last_seq
 
     def get(self, k=0) -> list[Message]:
         """Return the most recent k memories, return all when k=0"""
@@ -74,22 +174,29 @@ class Memory:
 
     def get_by_action(self, action: Type[Action]) -> list[Message]:
         """Return all messages triggered by a specified Action"""
-        return self.index[action]
+        return self.index.get(action, [])
 
     def get_by_actions(self, actions: Iterable[Type[Action]]) -> list[Message]:
-        """Return all messages triggered by specified Actions"""
+        """Return all messages triggered by specified Actions.
+        The result is a cached view, kept until a message of one of the actions is added or deleted: do not modify it"""
+        key = tuple(actions)
+        if key not in self._views:
+            self._views[key] = self._view(key)
+        return self._views[key]
+
+    def _view(self, actions: tuple) -> list[Message]:
         rsp = []
         for action in actions:
-            if action not in self.index:
-                continue # return []
-            rsp += self.index[action]
+            rsp += self.index.get(action, [])
         return rsp
-    
+
     def get_by_and_actions(self, actions: Iterable[Type[Action]]) -> list[Message]:
         """Return all messages triggered by specified Actions"""
-        rsp = []
-        for action in actions:
-            if action not in self.index:
-                return []
-            rsp += self.index[action]
-        return rsp
+        actions = tuple(actions)
+        if not all(action in self.index for action in actions):
+            return []
+        return self.get_by_actions(actions)
+
+    def _invalidate(self, action: Type[Action]):
+        for key in [i for i in self._views if action in i]:
+            del self._views[key]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : message_bus.py
+@Desc    : deliver published messages to the inboxes of the roles watching their cause_by, and wake the scheduler
+"""
+import asyncio
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from autoagents.system.schema import Message
+
+
+class MessageBus:
+    """Subscriptions by action type: a message goes to the inbox of every role watching the action that caused it"""
+
+    def __init__(self):
+        self.subscribers: dict[type, list[str]] = defaultdict(list)  # action -> names of the subscribed roles
+        self.inboxes: dict[str, list[Message]] = {}
+        self._event: Optional[asyncio.Event] = None
+        self._loop = None
+
+    def subscribe(self, name: str, actions: Iterable[type], backlog: Iterable[Message] = ()):
+        """Subscribe role `name` to `actions`, `backlog` are earlier messages it has not seen yet"""
+        self.inboxes.setdefault(name, [])
+        for action in actions:
+            if name not in self.subscribers[action]:
+                self.subscribers[action].append(name)
+        self._deliver(name, backlog)
+
+    def publish(self, message: Message) -> list[str]:
+        """Put `message` into the inboxes of its subscribers, returns their names"""
+        names = self.subscribers.get(message.cause_by, []) if message.cause_by else []
+        for name in names:
+            self._deliver(name, [message])
+        return names
+
+    def _deliver(self, name: str, messages: Iterable[Message]):
+        inbox = self.inboxes[name]
+        inbox.extend(messages)
+        if inbox and self._event:
+            self._event.set()
+
+    def pending(self) -> list[str]:
+        """Names of the roles with messages in their inbox"""
+        return [name for name, inbox in self.inboxes.items() if inbox]
+
+    def take(self, name: str) -> list[Message]:
+        messages, self.inboxes[name] = self.inboxes[name], []
+        return messages
+
+    def _wakeup(self) -> asyncio.Event:
+        loop = asyncio.get_running_loop()
+        if self._event is None or self._loop is not loop:
+            self._event, self._loop = asyncio.Event(), loop
+        return self._event
+
+    def clear(self):
+        """Forget the deliveries so far, `wait` returns on the next one"""
+        self._wakeup().clear()
+
+    async def wait(self):
+        """Return once a message is delivered to any inbox after the last `clear`"""
+        await self._wakeup().wait()
@@ -7,29 +7,167 @@
 @From    : https://github.com/geekan/MetaGPT/blob/main/metagpt/provider/anthropic_api.py
 """
 
+import time
+from typing import AsyncIterator
+
 import anthropic
-from anthropic import Anthropic
+from anthropic import Anthropic, AsyncAnthropic
 
 from autoagents.system.config import CONFIG
+from autoagents.system.provider.base_gpt_api import BaseGPTAPI
+from autoagents.system.provider.hedging import Hedger, hedge
+from autoagents.system.provider.metrics import instrumented, note_first_token, note_queue_wait
+from autoagents.system.provider.openai_api import Admission, Costs, admit, get_cost_manager
+from autoagents.system.provider.rate_limiter import RateLimiter, get_rate_limiter
+from autoagents.system.provider.retry_policy import retry
+from autoagents.system.provider.streaming import collect
+from autoagents.system.utils.common import OutputDivergedError
+from autoagents.system.utils.context_window import ContextWindow
+
+_PROVIDERS: dict[tuple, "Claude2"] = {}
+
+
+class Claude2(BaseGPTAPI):
+    """
+    Anthropic completion API behind the same interface as OpenAIGPTAPI, so it can back Roles and Actions
+    """
+    def __init__(self, proxy='', api_key='', model=''):
+        self.proxy = proxy or ''
+        self.api_key = api_key or CONFIG.claude_api_key
+        self.model = model or CONFIG.claude_api_model
+        self.stops = None
+        # retries are handled by our own retry decorator and rate limiter
+        self.client = AsyncAnthropic(api_key=self.api_key, proxies=self.proxy or None, max_retries=0)
+        self.sync_client = Anthropic(api_key=self.api_key, proxies=self.proxy or None, max_retries=0)
+        self.endpoint = str(self.client.base_url)
+        self.rate_limiter: RateLimiter = get_rate_limiter(self.api_key, self.model, rpm=int(CONFIG.get("RPM", 10)),
+                                                          tpm=int(CONFIG.openai_api_tpm))
+        self.hedger = Hedger(float(CONFIG.hedge_percentile)) if CONFIG.hedge_requests else None
+        self.context = ContextWindow(self.model)
+
+    @classmethod
+    def shared(cls, proxy='', api_key='', model='') -> "Claude2":
+        """Return the instance shared by every caller using the same key, proxy and model"""
+        key = (api_key or CONFIG.claude_api_key, proxy or '', model or CONFIG.claude_api_model)
+        if key not in _PROVIDERS:
+            _PROVIDERS[key] = cls(proxy, api_key, model)
+        return _PROVIDERS[key]
+
+    def _messages_to_prompt(self, messages: list[dict]) -> str:
+        """OpenAI style messages to the Human/Assistant prompt of the completion API, system messages lead"""
+        prompt = ""
+        for message in messages:
+            if message["role"] == "system":
+                prompt += f"{message['content']}\n"
+            elif message["role"] == "assistant":
+                prompt += f"{anthropic.AI_PROMPT} {message['content']}"
+            else:
+                prompt += f"{anthropic.HUMAN_PROMPT} {message['content']}"
+        return prompt + anthropic.AI_PROMPT
+
+    def _prompt(self, messages: list[dict]) -> str:
+        """The prompt of `messages` fitted into the context window, built once per request"""
+        return self._messages_to_prompt(self.context.fit_messages(messages))
+
+    def _cons_kwargs(self, prompt: str, admission: Admission = None) -> dict:
+        """admission: the model and max_tokens the budget allowed, the defaults of the instance without one"""
+        kwargs = {
+            "model": admission.model if admission else self.model,
+            "prompt": prompt,
+            "max_tokens_to_sample": admission.max_tokens if admission else CONFIG.max_tokens_rsp,
+            "temperature": 0.3,
+        }
+        if self.stops:
+            kwargs["stop_sequences"] = self.stops
+        return kwargs
+
+    @staticmethod
+    def _to_openai_rsp(text: str, usage: dict) -> dict:
+        return {"choices": [{"message": {"role": "assistant", "content": text}}], "usage": usage}
+
+    def completion(self, messages: list[dict]) -> dict:
+        """Blocking completion, admitted by the budget and paced by the rate limiter like the async ones"""
+        prompt = self._prompt(messages)
+        prompt_tokens = self.sync_client.count_tokens(prompt)
+        admission = admit(self.model, prompt_tokens)
+        reserved_tokens, used_tokens = prompt_tokens + admission.max_tokens, 0
+        try:
+            self.rate_limiter.wait_if_needed_sync(1, reserved_tokens)
+            rsp = self.sync_client.completions.create(**self._cons_kwargs(prompt, admission))
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": self.sync_client.count_tokens(rsp.completion)}
+            used_tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+        finally:
+            get_cost_manager().release(admission)
+            self.rate_limiter.settle(reserved_tokens, used_tokens)
+        self._update_costs(usage, admission)
+        return self._to_openai_rsp(rsp.completion, usage)
+
+    async def astream(self, kwargs: dict) -> AsyncIterator[str]:
+        """Yield the content deltas of a streamed completion of the request `kwargs` as they arrive.
+        A consumer stopping early (a lost hedge, a diverged answer) closes the upstream response."""
+        started = time.time()
+        stream = await self.client.completions.create(**kwargs, stream=True)
+        try:
+            async for event in stream:
+                if event.completion:
+                    note_first_token(time.time() - started)
+                    yield event.completion
+        finally:
+            await stream.response.aclose()
+
+    @instrumented
+    @retry(max_retries=6)
+    async def _acompletion_text(self, messages: list[dict], stream=False, sinks=()) -> tuple[str, dict]:
+        prompt = self._prompt(messages)
+        prompt_tokens = await self.client.count_tokens(prompt)
+        admission = admit(self.model, prompt_tokens)
+        kwargs = self._cons_kwargs(prompt, admission)
+        reserved_tokens, used_tokens = prompt_tokens + admission.max_tokens, 0
+        if self.hedger:
+            def admit_hedge() -> bool:
+                # the duplicate request takes a request and its prompt tokens from the rate limiter, if free right away
+                return self.rate_limiter.try_acquire(1, prompt_tokens)
+
+            def on_hedge():
+                # the duplicate request is billed for its prompt even though it gets cancelled
+                self._update_costs({"prompt_tokens": prompt_tokens, "completion_tokens": 0}, admission)
 
+        try:
+            note_queue_wait(await self.rate_limiter.wait_if_needed(1, reserved_tokens))
+            if self.hedger:
+                deltas = hedge(lambda: self.astream(kwargs), self.hedger, on_hedge, admit_hedge)
+                rsp = await collect(deltas, sinks) if stream else "".join([delta async for delta in deltas])
+            elif stream:
+                rsp = await collect(self.astream(kwargs), sinks)
+            else:
+                rsp = (await self.client.completions.create(**kwargs)).completion
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": await self.client.count_tokens(rsp)}
+            used_tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+        except OutputDivergedError as e:
+            # a sink stopped the stream early, only what was generated until then is paid for
+            self._update_costs({"prompt_tokens": prompt_tokens,
+                                "completion_tokens": await self.client.count_tokens(e.text)}, admission)
+            raise
+        finally:
+            get_cost_manager().release(admission)
+            # a failed call gives its whole reservation back, or every retry would shrink the shared capacity
+            self.rate_limiter.settle(reserved_tokens, used_tokens)
+        self._update_costs(usage, admission)
+        return rsp, usage
 
-class Claude2:
-    def ask(self, prompt):
-        client = Anthropic(api_key=CONFIG.claude_api_key)
+    async def acompletion(self, messages: list[dict]) -> dict:
+        rsp, usage = await self._acompletion_text(messages)
+        return self._to_openai_rsp(rsp, usage)
 
-        res = client.completions.create(
-            model="claude-2",
-            prompt=f"{anthropic.HUMAN_PROMPT} {prompt} {anthropic.AI_PROMPT}",
-            max_tokens_to_sample=1000,
-        )
-        return res.completion
+    async def acompletion_text(self, messages: list[dict], stream=False, sinks=(), check=None) -> str:
+        """when streaming, every delta goes to the stream sinks subscribed in the current context and to `sinks`.
+        check: unused, nothing is cached here"""
+        rsp, _ = await self._acompletion_text(messages, stream, sinks)
+        return rsp
 
-    async def aask(self, prompt):
-        client = Anthropic(api_key=CONFIG.claude_api_key)
+    def _update_costs(self, usage: dict, admission: Admission = None):
+        get_cost_manager().update_cost(usage["prompt_tokens"], usage["completion_tokens"],
+                                       admission.model if admission else self.model)
 
-        res = client.completions.create(
-            model="claude-2",
-            prompt=f"{anthropic.HUMAN_PROMPT} {prompt} {anthropic.AI_PROMPT}",
-            max_tokens_to_sample=1000,
-        )
-        return res.completion
\ No newline at end of file
+    def get_costs(self) -> Costs:
+        return get_cost_manager().get_costs()
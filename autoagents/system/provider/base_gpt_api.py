@@ -12,6 +12,7 @@ from autoagents.system.provider.base_chatbot import BaseChatbot
 class BaseGPTAPI(BaseChatbot):
     """GPT API abstract class, requiring all inheritors to provide a series of standard capabilities"""
     system_prompt = 'You are a helpful assistant.'
+    supports_structured_output = False  # whether aask_json can constrain the answer to a JSON schema
 
     def _user_msg(self, msg: str) -> dict[str, str]:
         return {"role": "user", "content": msg}
@@ -33,17 +34,24 @@ class BaseGPTAPI(BaseChatbot):
         rsp = self.completion(message)
         return self.get_choice_text(rsp)
 
-    async def aask(self, msg: str, system_msgs: Optional[list[str]] = None) -> str:
+    async def aask(self, msg: str, system_msgs: Optional[list[str]] = None, sinks=(), check=None) -> str:
+        """`sinks` receive the answer while it streams, besides the sinks subscribed in the current context.
+        `check` raises if the answer is unusable, see acompletion_text"""
         if system_msgs:
             message = self._system_msgs(system_msgs) + [self._user_msg(msg)]
         else:
             message = [self._default_system_msg(), self._user_msg(msg)]
 
-        rsp = await self.acompletion_text(message, stream=True)
+        rsp = await self.acompletion_text(message, stream=True, sinks=sinks, check=check)
         logger.debug(message)
         # logger.debug(rsp)
         return rsp
 
+    async def aask_json(self, msg: str, schema: dict, name: str, system_msgs: Optional[list[str]] = None,
+                        check=None) -> dict:
+        """Ask for an answer matching the JSON `schema`, only for providers that support structured output"""
+        raise NotImplementedError(f"{self.__class__.__name__} does not support structured output")
+
     def _extract_assistant_rsp(self, context):
         return "\n".join([i["content"] for i in context if i["role"] == "assistant"])
 
@@ -99,8 +107,9 @@ class BaseGPTAPI(BaseChatbot):
         """
 
     @abstractmethod
-    async def acompletion_text(self, messages: list[dict], stream=False) -> str:
-        """Asynchronous version of completion. Return str. Support stream-print"""
+    async def acompletion_text(self, messages: list[dict], stream=False, sinks=(), check=None) -> str:
+        """Asynchronous version of completion. Return str. Support stream-print to `sinks`.
+        `check` raises if the caller cannot use the answer, a cached answer must have passed it"""
 
     def get_choice_text(self, rsp: dict) -> str:
         """Required to provide the first text of choice"""
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : hedging.py
+@Desc    : hedged requests: duplicate a completion whose first token is late and keep whichever answers first
+"""
+import asyncio
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Optional
+
+from autoagents.system.config import CONFIG
+from autoagents.system.logs import logger
+from autoagents.system.provider.retry_policy import TaskBudget
+
+
+class Hedger:
+    """Keeps the recently observed time-to-first-token of an endpoint and derives the hedging delay from it"""
+
+    def __init__(self, percentile: float, window=200, min_samples=20):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+
+    def record(self, ttft: float):
+        self._samples.append(ttft)
+
+    def delay(self) -> Optional[float]:
+        """Seconds to wait for the first token before hedging, None until enough samples were seen"""
+        if len(self._samples) < self.min_samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100))]
+
+
+_HEDGE_BUDGET: ContextVar[Optional[TaskBudget]] = ContextVar("hedge_budget", default=None)
+
+
+def set_hedge_budget(hedges: int):
+    """Give the current task, and the tasks it starts, its own number of hedged requests"""
+    _HEDGE_BUDGET.set(TaskBudget(hedges))
+
+
+def get_hedge_budget() -> TaskBudget:
+    budget = _HEDGE_BUDGET.get()
+    if budget is None:
+        budget = TaskBudget(int(CONFIG.hedge_budget))
+        _HEDGE_BUDGET.set(budget)
+    return budget
+
+
+async def hedge(start: Callable[[], AsyncIterator[str]], hedger: Hedger, on_hedge: Callable[[], None] = None,
+                admit_hedge: Callable[[], bool] = None) -> AsyncIterator[str]:
+    """Yield the deltas of the stream returned by `start()`.
+
+    If no delta arrived within `hedger.delay()`, a second stream is started (paid from the hedge budget of the
+    task, `on_hedge` is called to account for it). `admit_hedge` may veto it, e.g. when the rate limiter has no
+    request free right away: a slow provider is not sent more requests than it is paced for. The stream that
+    produces its first delta first is kept and the other one is cancelled, so only the deltas of the kept stream
+    are ever yielded. Losers are closed with `aclose()`, the streams of the providers close their upstream response
+    then and bill what it had delivered.
+    """
+    started = {}
+    pending = {}
+
+    def launch():
+        stream = start()
+        future = asyncio.ensure_future(stream.__anext__())
+        pending[future] = stream
+        started[stream] = time.time()
+
+    launch()
+    delay = hedger.delay()
+    stream, first, error = None, None, None
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                delay = None
+                budget = get_hedge_budget()
+                if budget.remaining <= 0:
+                    continue
+                if admit_hedge and not admit_hedge():
+                    logger.info(f"No first token after {hedger.delay():.2f}s, but no request free to hedge it")
+                    continue
+                budget.take()
+                logger.info(f"No first token after {hedger.delay():.2f}s, hedging the request")
+                launch()
+                if on_hedge:
+                    on_hedge()
+                continue
+            future = done.pop()
+            candidate = pending.pop(future)
+            try:
+                first = future.result()
+            except StopAsyncIteration:
+                first = ""
+            except Exception as e:
+                # the other request may still succeed
+                error = e
+                await candidate.aclose()
+                continue
+            stream = candidate
+            hedger.record(time.time() - started[stream])
+            break
+    finally:
+        for future in pending:
+            future.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for loser in pending.values():
+            await loser.aclose()
+    if stream is None:
+        raise error
+
+    try:
+        if first:
+            yield first
+        async for delta in stream:
+            yield delta
+    finally:
+        await stream.aclose()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : metrics.py
+@Desc    : per-call LLM telemetry: an in-process histogram registry (Prometheus text) and per-task summaries (JSON)
+"""
+import json
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Optional
+
+from autoagents.system.utils.singleton import Singleton
+
+SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8)
+
+METRICS = {
+    # name: (help, buckets)
+    "llm_ttft_seconds": ("Time from sending a request to its first streamed token", SECONDS_BUCKETS),
+    "llm_latency_seconds": ("Total time of a call, including queueing, retries and backoff", SECONDS_BUCKETS),
+    "llm_output_tokens_per_second": ("Completion tokens per second of generation", RATE_BUCKETS),
+    "llm_retries": ("Retries per call", COUNT_BUCKETS),
+    "llm_queue_wait_seconds": ("Time a call waited in the rate limiter", SECONDS_BUCKETS),
+    "llm_backoff_seconds": ("Time a call slept between retries", SECONDS_BUCKETS),
+}
+
+COUNTERS = {
+    "llm_cost_dollars_total": "Dollars spent on LLM calls by all tasks of the process",
+    "llm_prompt_tokens_total": "Prompt tokens of all tasks of the process",
+    "llm_completion_tokens_total": "Completion tokens of all tasks of the process",
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: tuple, **extra) -> str:
+    pairs = list(labels) + list(extra.items())
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in pairs) + "}"
+
+
+class MetricsRegistry(metaclass=Singleton):
+    """Histograms of every metric in METRICS, one per label set (model, role, action, status),
+    and the process-wide counters of COUNTERS"""
+
+    def __init__(self):
+        self.histograms: dict[str, dict[tuple, Histogram]] = {name: {} for name in METRICS}
+        self.counters: dict[str, dict[tuple, float]] = {name: {} for name in COUNTERS}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.counters[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self.histograms[name]
+        key = tuple(sorted(labels.items()))
+        if key not in series:
+            series[key] = Histogram(METRICS[name][1])
+        series[key].observe(value)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name, series in self.histograms.items():
+            lines.append(f"# HELP {name} {METRICS[name][0]}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        for name, series in self.counters.items():
+            lines.append(f"# HELP {name} {COUNTERS[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class CallRecord:
+    """What happened during one LLM call, filled in by the layers the call passes through"""
+
+    def __init__(self, model: str, role: str, action: str):
+        self.model = model
+        self.role = role
+        self.action = action
+        self.start = time.time()
+        self.sent = self.start
+        self.ttft = None
+        self.latency = None
+        self.retries = 0
+        self.queue_wait = 0.0
+        self.backoff = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.admission = "admitted"  # what the budget decided, see CostManager.admit
+        self.status = "ok"
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        generation = self.start + self.latency - self.sent
+        if not self.completion_tokens or generation <= 0:
+            return None
+        return self.completion_tokens / generation
+
+    def to_dict(self) -> dict:
+        return {"model": self.model, "role": self.role, "action": self.action, "status": self.status,
+                "ttft": self.ttft, "latency": self.latency, "tokens_per_second": self.tokens_per_second,
+                "retries": self.retries, "queue_wait": self.queue_wait, "backoff": self.backoff,
+                "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens,
+                "admission": self.admission}
+
+
+class TaskMetrics:
+    """The calls of one task, summarised as JSON"""
+
+    def __init__(self, task_id=None):
+        self.task_id = task_id
+        self.calls: list[CallRecord] = []
+
+    def summary(self) -> dict:
+        def total(attr):
+            return sum(getattr(i, attr) for i in self.calls)
+
+        def percentile(values, p):
+            values = sorted(values)
+            return values[min(len(values) - 1, int(len(values) * p / 100))] if values else None
+
+        latencies = [i.latency for i in self.calls]
+        ttfts = [i.ttft for i in self.calls if i.ttft is not None]
+        by_caller = {}
+        for call in self.calls:
+            caller = by_caller.setdefault(f"{call.role}/{call.action}", {"calls": 0, "latency": 0.0, "queue_wait": 0.0,
+                                                                         "retries": 0, "completion_tokens": 0})
+            caller["calls"] += 1
+            caller["latency"] += call.latency
+            caller["queue_wait"] += call.queue_wait
+            caller["retries"] += call.retries
+            caller["completion_tokens"] += call.completion_tokens
+        return {
+            "task_id": self.task_id,
+            "calls": len(self.calls),
+            "errors": sum(1 for i in self.calls if i.status != "ok"),
+            "latency": {"total": sum(latencies), "p50": percentile(latencies, 50), "p95": percentile(latencies, 95)},
+            "ttft": {"p50": percentile(ttfts, 50), "p95": percentile(ttfts, 95)},
+            "queue_wait": total("queue_wait"),
+            "backoff": total("backoff"),
+            "retries": total("retries"),
+            "prompt_tokens": total("prompt_tokens"),
+            "completion_tokens": total("completion_tokens"),
+            "degraded": sum(1 for i in self.calls if i.admission != "admitted"),
+            "by_caller": by_caller,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), ensure_ascii=False)
+
+
+_CALLER: ContextVar[tuple[str, str]] = ContextVar("llm_caller", default=("", ""))
+_CALL: ContextVar[Optional[CallRecord]] = ContextVar("llm_call", default=None)
+_TASK_METRICS: ContextVar[Optional[TaskMetrics]] = ContextVar("task_metrics", default=None)
+
+
+@contextmanager
+def calling(role: str, action: str):
+    """Attribute the LLM calls made inside the block to `role` and `action`"""
+    token = _CALLER.set((role, action))
+    try:
+        yield
+    finally:
+        _CALLER.reset(token)
+
+
+def start_task_metrics(task_id=None) -> TaskMetrics:
+    """Collect the calls of the current task, and of the tasks it starts, into their own summary"""
+    metrics = TaskMetrics(task_id)
+    _TASK_METRICS.set(metrics)
+    return metrics
+
+
+def get_task_metrics() -> Optional[TaskMetrics]:
+    return _TASK_METRICS.get()
+
+
+def current_call() -> Optional[CallRecord]:
+    return _CALL.get()
+
+
+def current_caller() -> tuple[str, str]:
+    """(role, action) the LLM calls of the current context are attributed to"""
+    return _CALLER.get()
+
+
+def note_queue_wait(seconds: float):
+    """The rate limiter let the current call go after `seconds`, the request is sent now"""
+    call = _CALL.get()
+    if call:
+        call.queue_wait += seconds
+        call.sent = time.time()
+
+
+def note_retry(backoff: float = 0):
+    call = _CALL.get()
+    if call:
+        call.retries += 1
+        call.backoff += backoff
+
+
+def note_admission(decision: str):
+    call = _CALL.get()
+    if call and decision != "admitted":
+        call.admission = decision
+
+
+def note_first_token(ttft: float):
+    call = _CALL.get()
+    if call and call.ttft is None:
+        call.ttft = ttft
+
+
+def note_usage(prompt_tokens: int, completion_tokens: int):
+    call = _CALL.get()
+    if call:
+        call.prompt_tokens += prompt_tokens
+        call.completion_tokens += completion_tokens
+
+
+def instrumented(f):
+    """Record a provider coroutine method as one LLM call, the provider needs a `model` attribute"""
+    @wraps(f)
+    async def wrapper(self, *args, **kwargs):
+        if _CALL.get() is not None:
+            return await f(self, *args, **kwargs)
+        role, action = _CALLER.get()
+        call = CallRecord(self.model, role, action)
+        token = _CALL.set(call)
+        try:
+            return await f(self, *args, **kwargs)
+        except BaseException:
+            call.status = "error"
+            raise
+        finally:
+            _CALL.reset(token)
+            call.latency = time.time() - call.start
+            _record(call)
+    return wrapper
+
+
+def _record(call: CallRecord):
+    registry = MetricsRegistry()
+    labels = {"model": call.model, "role": call.role, "action": call.action, "status": call.status}
+    registry.observe("llm_latency_seconds", call.latency, **labels)
+    registry.observe("llm_retries", call.retries, **labels)
+    registry.observe("llm_queue_wait_seconds", call.queue_wait, **labels)
+    registry.observe("llm_backoff_seconds", call.backoff, **labels)
+    if call.ttft is not None:
+        registry.observe("llm_ttft_seconds", call.ttft, **labels)
+    if call.tokens_per_second is not None:
+        registry.observe("llm_output_tokens_per_second", call.tokens_per_second, **labels)
+    task_metrics = _TASK_METRICS.get()
+    if task_metrics is not None:
+        task_metrics.calls.append(call)
@@ -6,59 +6,45 @@
 @From    : https://github.com/geekan/MetaGPT/blob/main/metagpt/provider/openai_api.py
 """
 import asyncio
+import contextvars
+import json
+import threading
 import time
-from functools import wraps
-from typing import NamedTuple
+from collections import deque
+from contextvars import ContextVar
+from typing import AsyncIterator, NamedTuple, Optional
 
+import aiohttp
 import openai
 import litellm
 
 from autoagents.system.config import CONFIG
 from autoagents.system.logs import logger
 from autoagents.system.provider.base_gpt_api import BaseGPTAPI
-from autoagents.system.utils.singleton import Singleton
-from autoagents.system.utils.token_counter import (
-    TOKEN_COSTS,
-    count_message_tokens,
-    count_string_tokens,
+from autoagents.system.provider.hedging import Hedger, hedge
+from autoagents.system.provider.metrics import (
+    MetricsRegistry,
+    calling,
+    current_caller,
+    instrumented,
+    note_admission,
+    note_first_token,
+    note_queue_wait,
+    note_usage,
 )
+from autoagents.system.provider.rate_limiter import AdaptiveConcurrency, RateLimiter, get_rate_limiter
+from autoagents.system.provider.response_cache import ResponseCache
+from autoagents.system.provider.retry_policy import get_retry_budget, is_overloaded, retry, retry_after
+from autoagents.system.provider.router import Router, start_task_routes
+from autoagents.system.provider.single_flight import SingleFlight
+from autoagents.system.provider.streaming import collect, replay
+from autoagents.system.utils.common import NoMoneyException, OutputDivergedError
+from autoagents.system.utils.context_window import ContextWindow
+from autoagents.system.utils.pricing import ModelRegistry
 
 
-def retry(max_retries):
-    def decorator(f):
-        @wraps(f)
-        async def wrapper(*args, **kwargs):
-            for i in range(max_retries):
-                try:
-                    return await f(*args, **kwargs)
-                except Exception:
-                    if i == max_retries - 1:
-                        raise
-                    await asyncio.sleep(2 ** i)
-        return wrapper
-    return decorator
-
-
-class RateLimiter:
-    """Rate control class, each call goes through wait_if_needed, sleep if rate control is needed"""
-    def __init__(self, rpm):
-        self.last_call_time = 0
-        self.interval = 1.1 * 60 / rpm  # Here 1.1 is used because even if the calls are made strictly according to time, they will still be QOS'd; consider switching to simple error retry later
-        self.rpm = rpm
-
-    def split_batches(self, batch):
-        return [batch[i:i + self.rpm] for i in range(0, len(batch), self.rpm)]
-
-    async def wait_if_needed(self, num_requests):
-        current_time = time.time()
-        elapsed_time = current_time - self.last_call_time
-
-        if elapsed_time < self.interval * num_requests:
-            remaining_time = self.interval * num_requests - elapsed_time
-            logger.info(f"sleep {remaining_time}")
-            await asyncio.sleep(remaining_time)
-
-        self.last_call_time = time.time()
+STRUCTURED_OUTPUT_PROMPT = "Answer by calling the function {name}. Put the content of every section the answer " \
+                           "format asks for into the argument of the same name."
 
 
 class Costs(NamedTuple):
@@ -68,13 +54,38 @@ class Costs(NamedTuple):
     total_budget: float
 
 
-class CostManager(metaclass=Singleton):
-    """计算使用接口的开销"""
-    def __init__(self):
+class Admission(NamedTuple):
+    """What the budget let one call do, decided before the call is sent"""
+    role: str
+    action: str
+    decision: str  # "admitted", "shortened" (smaller max_tokens), "downgraded" (cheaper model) or "refused"
+    model: str
+    max_tokens: int
+    estimated_cost: float  # prompt plus the longest completion allowed, reserved until the call ends
+
+
+class CostManager:
+    """计算使用接口的开销
+
+    One instance per task (see start_task_costs), so budgets and costs of tasks sharing a process stay apart.
+    Every update is also added to the process-wide aggregate returned by get_process_costs().
+    """
+    def __init__(self, max_budget=None, parent: "CostManager" = None):
         self.total_prompt_tokens = 0
         self.total_completion_tokens = 0
         self.total_cost = 0
-        self.total_budget = 0
+        self.total_budget = CONFIG.max_budget if max_budget is None else max_budget
+        self.parent = parent
+        self.reserved = 0.0  # estimated costs of the calls admitted but not finished yet
+        # calls that were shortened, downgraded or refused, the oldest are dropped if no role asks for them
+        self.admissions: deque[Admission] = deque(maxlen=int(CONFIG.budget_max_admissions))
+
+    def _add(self, prompt_tokens, completion_tokens, cost):
+        self.total_prompt_tokens += prompt_tokens
+        self.total_completion_tokens += completion_tokens
+        self.total_cost += cost
+        if self.parent:
+            self.parent._add(prompt_tokens, completion_tokens, cost)
 
     def update_cost(self, prompt_tokens, completion_tokens, model):
         """
@@ -85,16 +96,70 @@ class CostManager(metaclass=Singleton):
         completion_tokens (int): The number of tokens used in the completion.
         model (str): The model used for the API call.
         """
-        self.total_prompt_tokens += prompt_tokens
-        self.total_completion_tokens += completion_tokens
-        cost = (
-            prompt_tokens * TOKEN_COSTS[model]["prompt"]
-            + completion_tokens * TOKEN_COSTS[model]["completion"]
-        ) / 1000
-        self.total_cost += cost
-        logger.info(f"Total running cost: ${self.total_cost:.3f} | Max budget: ${CONFIG.max_budget:.3f} | "
+        cost = ModelRegistry().cost(model, prompt_tokens, completion_tokens)
+        self._add(prompt_tokens, completion_tokens, cost)
+        Router().record_cost(prompt_tokens, completion_tokens, cost)
+        note_usage(prompt_tokens, completion_tokens)
+        registry = MetricsRegistry()
+        registry.inc("llm_cost_dollars_total", cost, model=model)
+        registry.inc("llm_prompt_tokens_total", prompt_tokens, model=model)
+        registry.inc("llm_completion_tokens_total", completion_tokens, model=model)
+        logger.info(f"Total running cost: ${self.total_cost:.3f} | Max budget: ${self.total_budget:.3f} | "
                     f"Current cost: ${cost:.3f}, {prompt_tokens=}, {completion_tokens=}")
-        CONFIG.total_cost = self.total_cost
+
+    def check_budget(self):
+        if self.total_cost > self.total_budget:
+            raise NoMoneyException(self.total_cost, f'Insufficient funds: {self.total_budget}')
+
+    def admit(self, model: str, prompt_tokens: int, max_tokens: int, role="", action="") -> Admission:
+        """Admission control before a call: the budget left, minus what running calls may still spend, has to cover
+        the prompt and the longest completion. If it does not, the completion is shortened, then the cheaper models
+        of BUDGET_FALLBACK_MODELS are tried, and NoMoneyException is raised if neither leaves enough room.
+        The estimate is reserved until `release`."""
+        registry = ModelRegistry()
+        remaining = self.total_budget - self.total_cost - self.reserved
+        estimate = registry.cost(model, prompt_tokens, max_tokens)
+        if estimate <= remaining:
+            return self._reserve(Admission(role, action, "admitted", model, max_tokens, estimate))
+
+        min_tokens = min(max_tokens, int(CONFIG.budget_min_completion_tokens))
+        tokens = min(max_tokens, registry.affordable_tokens(model, prompt_tokens, remaining))
+        if tokens >= min_tokens:
+            return self._reserve(Admission(role, action, "shortened", model, tokens,
+                                           registry.cost(model, prompt_tokens, tokens)))
+        for fallback in CONFIG.budget_fallback_models or []:
+            if fallback == model:
+                continue
+            tokens = min(max_tokens, registry.affordable_tokens(fallback, prompt_tokens, remaining),
+                         registry.max_tokens(fallback) - prompt_tokens)
+            if tokens >= min_tokens:
+                return self._reserve(Admission(role, action, "downgraded", fallback, tokens,
+                                               registry.cost(fallback, prompt_tokens, tokens)))
+
+        self._reserve(Admission(role, action, "refused", model, 0, 0.0))
+        raise NoMoneyException(self.total_cost + self.reserved + registry.cost(model, prompt_tokens, min_tokens),
+                               f'Insufficient funds for a call of {role or "?"}/{action or "?"}: '
+                               f'${max(remaining, 0):.3f} left of {self.total_budget}')
+
+    def _reserve(self, admission: Admission) -> Admission:
+        self.reserved += admission.estimated_cost
+        if admission.decision != "admitted":
+            self.admissions.append(admission)
+            logger.warning(f"Budget {admission.decision} a call of {admission.role}/{admission.action}: "
+                           f"model {admission.model}, max_tokens {admission.max_tokens}")
+        return admission
+
+    def release(self, admission: Admission):
+        """The admitted call is over, its actual cost has been added by update_cost"""
+        self.reserved = max(0.0, self.reserved - admission.estimated_cost)
+
+    def pop_admissions(self, role: str) -> list[Admission]:
+        """The calls of `role` the budget changed or refused since the last time it asked"""
+        popped = [i for i in self.admissions if i.role == role]
+        kept = [i for i in self.admissions if i.role != role]
+        self.admissions.clear()
+        self.admissions.extend(kept)
+        return popped
 
     def get_total_prompt_tokens(self):
         """
@@ -128,64 +193,215 @@ class CostManager(metaclass=Singleton):
         return Costs(self.total_prompt_tokens, self.total_completion_tokens, self.total_cost, self.total_budget)
 
 
-class OpenAIGPTAPI(BaseGPTAPI, RateLimiter):
+_PROCESS_COSTS = CostManager(max_budget=float("inf"))
+_COST_MANAGER: ContextVar[CostManager] = ContextVar("cost_manager", default=_PROCESS_COSTS)
+
+
+def start_task_costs(max_budget=None) -> CostManager:
+    """Give the current task, and the tasks it starts, its own costs and budget, and route stats"""
+    cost_manager = CostManager(max_budget, parent=_PROCESS_COSTS)
+    _COST_MANAGER.set(cost_manager)
+    start_task_routes()
+    return cost_manager
+
+
+def get_cost_manager() -> CostManager:
+    """The costs of the current task, the process-wide ones outside of a task"""
+    return _COST_MANAGER.get()
+
+
+def get_process_costs() -> Costs:
+    """Costs of all tasks run by this process"""
+    return _PROCESS_COSTS.get_costs()
+
+
+def admit(model: str, prompt_tokens: int) -> Admission:
+    """Ask the budget of the current task whether a call may be made, and with which model and max_tokens"""
+    role, action = current_caller()
+    admission = get_cost_manager().admit(model, prompt_tokens, int(CONFIG.max_tokens_rsp), role, action)
+    note_admission(admission.decision)
+    return admission
+
+
+def _close_stream(response):
+    """Stop reading a litellm stream, its underlying generator closes the upstream response"""
+    for stream in (getattr(response, "completion_stream", None), response):
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+
+
+_PROVIDERS: dict[tuple, "OpenAIGPTAPI"] = {}
+
+
+async def close_providers():
+    """Close the connection pools of the shared instances, call it before the event loop of a task ends"""
+    loop = asyncio.get_running_loop()
+    for provider in list(_PROVIDERS.values()):
+        if provider._session_loop is loop:
+            await provider.aclose()
+
+
+class OpenAIGPTAPI(BaseGPTAPI):
     """
     Check https://platform.openai.com/examples for examples
     """
-    def __init__(self, proxy='', api_key=''):
-        self.proxy = proxy
-        self.api_key = api_key
+    supports_structured_output = True
+
+    def __init__(self, proxy='', api_key='', model=''):
+        self.proxy = proxy or ''
+        self.api_key = api_key or ''
         self.__init_openai(CONFIG)
         self.llm = openai
         self.stops = None
-        self.model = CONFIG.openai_api_model
-        self._cost_manager = CostManager()
-        RateLimiter.__init__(self, rpm=self.rpm)
+        self.model = model or CONFIG.openai_api_model
+        self.rate_limiter: RateLimiter = get_rate_limiter(self.api_key, self.model, rpm=self.rpm, tpm=self.tpm)
+        self._session: aiohttp.ClientSession = None
+        self._session_loop = None
+        self._single_flight = SingleFlight()
+        self.hedger = Hedger(float(CONFIG.hedge_percentile)) if CONFIG.hedge_requests else None
+        self.context = ContextWindow(self.model)
+
+    @classmethod
+    def shared(cls, proxy='', api_key='', model='') -> "OpenAIGPTAPI":
+        """Return the instance shared by every caller using the same key, base, proxy and model"""
+        key = (api_key or CONFIG.openai_api_key, CONFIG.openai_api_base, proxy or '', model or CONFIG.openai_api_model)
+        if key not in _PROVIDERS:
+            _PROVIDERS[key] = cls(proxy, api_key, model)
+        return _PROVIDERS[key]
 
     def __init_openai(self, config):
         if self.proxy != '':
             openai.proxy = self.proxy
-        else:
-            litellm.api_key = config.openai_api_key
-        
-        if self.api_key != '':
-            litellm.api_key = self.api_key
-        else:
-            litellm.api_key = config.openai_api_key
-        
-        if config.openai_api_base:
-            litellm.api_base = config.openai_api_base
+
+        # key and base go along with every request instead of being written into the litellm module,
+        # so instances with different keys can be used side by side
+        self.api_key = self.api_key or config.openai_api_key
+        self.api_base = config.openai_api_base
+        self.endpoint = self.api_base or "https://api.openai.com/v1"
         if config.openai_api_type:
             litellm.api_type = config.openai_api_type
             litellm.api_version = config.openai_api_version
         self.rpm = int(config.get("RPM", 10))
+        self.tpm = int(config.openai_api_tpm)
 
-    async def _achat_completion_stream(self, messages: list[dict]) -> str:
-        response = await litellm.acompletion(
-            **self._cons_kwargs(messages),
-            stream=True
-        )
-
-        # create variables to collect the stream of chunks
-        collected_chunks = []
-        collected_messages = []
-        # iterate through the stream of events
-        async for chunk in response:
-            collected_chunks.append(chunk)  # save the event response
-            chunk_message = chunk['choices'][0]['delta']  # extract the message
-            collected_messages.append(chunk_message)  # save the message
-            if "content" in chunk_message:
-                print(chunk_message["content"], end="")
-
-        full_reply_content = ''.join([m.get('content', '') for m in collected_messages])
+    def _aiosession(self) -> aiohttp.ClientSession:
+        """The keep-alive connection pool of this instance, bound to the running event loop.
+
+        Only the non-streaming async calls (`acompletion`, `aask_json`, batches) go through it. Streams are read by
+        litellm in an executor thread and the sync calls run in the caller's thread, both on the requests session
+        openai keeps per thread, which keeps its connections alive as well. Close it with `aclose` before the loop ends.
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.rpm, keepalive_timeout=60))
+            self._session_loop = loop
+        return self._session
+
+    async def aclose(self):
+        """Close the connection pool opened on the running event loop"""
+        session, self._session, self._session_loop = self._session, None, None
+        if session is not None and not session.closed:
+            await session.close()
+
+    async def astream(self, messages: list[dict], admission: Admission = None) -> AsyncIterator[str]:
+        """Yield the content deltas of a streamed completion as they arrive.
+
+        litellm reads its stream synchronously: a single executor task reads the whole stream and hands the deltas
+        over through a queue, so the event loop stays free without a thread hop per token. When the consumer stops
+        early (a lost hedge, a diverged answer) the upstream response is closed, and the completion tokens that were
+        received but never consumed are billed. A `next()` blocking in the executor cannot be interrupted, the
+        response is closed once it returns.
+        """
+        loop = asyncio.get_running_loop()
+        started = time.time()
+        kwargs = self._cons_kwargs(messages, admission)
+        queue = asyncio.Queue()
+        stopped = threading.Event()
+        received, consumed = [], 0
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                stopped.set()  # the event loop is gone
+
+        def read():
+            response = None
+            try:
+                response = litellm.completion(**kwargs, stream=True)
+                for chunk in response:
+                    content = chunk['choices'][0]['delta'].get('content')
+                    if content:
+                        received.append(content)
+                        put(content)
+                    if stopped.is_set():
+                        break
+                put(None)
+            except Exception as e:
+                put(e)
+            finally:
+                _close_stream(response)
+
+        def bill_unread(_):
+            unread = "".join(received[consumed:])
+            if unread:
+                self._update_costs({"prompt_tokens": 0, "completion_tokens": self._count_completion_tokens(unread)},
+                                   admission)
+
+        reader = loop.run_in_executor(None, read)
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                note_first_token(time.time() - started)
+                consumed += 1
+                yield item
+        finally:
+            stopped.set()
+            reader.add_done_callback(bill_unread, context=contextvars.copy_context())
+
+    def _hedged_stream(self, messages: list[dict], admission: Admission = None) -> AsyncIterator[str]:
+        prompt_tokens = self._count_prompt_tokens(messages)
+
+        def admit_hedge() -> bool:
+            # the duplicate request takes a request and its prompt tokens from the rate limiter, if free right away
+            return self.rate_limiter.try_acquire(1, prompt_tokens)
+
+        def on_hedge():
+            # the duplicate request is billed for its prompt even if it loses, astream bills what a loser received
+            self._update_costs({"prompt_tokens": prompt_tokens, "completion_tokens": 0}, admission)
+
+        return hedge(lambda: self.astream(messages, admission), self.hedger, on_hedge, admit_hedge)
+
+    async def _achat_completion_stream(self, messages: list[dict], forward=True, sinks=(),
+                                       admission: Admission = None) -> str:
+        """forward: pass the deltas to the subscribed stream sinks and `sinks`"""
+        deltas = self._hedged_stream(messages, admission) if self.hedger else self.astream(messages, admission)
+        try:
+            if forward:
+                full_reply_content = await collect(deltas, sinks)
+            else:
+                full_reply_content = "".join([delta async for delta in deltas])
+        except OutputDivergedError as e:
+            # a sink stopped the stream early, only what was generated until then is paid for
+            self._update_costs(self._calc_usage(messages, e.text), admission)
+            raise
         usage = self._calc_usage(messages, full_reply_content)
-        self._update_costs(usage)
+        self._update_costs(usage, admission)
         return full_reply_content
 
-    def _cons_kwargs(self, messages: list[dict]) -> dict:
+    def _cons_kwargs(self, messages: list[dict], admission: Admission = None) -> dict:
+        """admission: the model and max_tokens the budget allowed, the defaults of the instance without one"""
+        messages = self.context.fit_messages(messages)
         if CONFIG.openai_api_type == 'azure':
             kwargs = {
                 "deployment_id": CONFIG.deployment_id,
+                "api_key": self.api_key,
+                "api_base": self.api_base,
                 "messages": messages,
                 "max_tokens": CONFIG.max_tokens_rsp,
                 "n": 1,
@@ -195,22 +411,42 @@ class OpenAIGPTAPI(BaseGPTAPI, RateLimiter):
         else:
             kwargs = {
                 "model": self.model,
+                "api_key": self.api_key,
+                "api_base": self.api_base,
                 "messages": messages,
                 "max_tokens": CONFIG.max_tokens_rsp,
                 "n": 1,
                 "stop": self.stops,
                 "temperature": 0.3
             }
+        if admission:
+            kwargs["max_tokens"] = admission.max_tokens
+            if "model" in kwargs:
+                kwargs["model"] = admission.model
         return kwargs
 
-    async def _achat_completion(self, messages: list[dict]) -> dict:
-        rsp = await self.llm.ChatCompletion.acreate(**self._cons_kwargs(messages))
-        self._update_costs(rsp.get('usage'))
+    async def _achat_completion(self, messages: list[dict], admission: Admission = None, **kwargs) -> dict:
+        token = openai.aiosession.set(self._aiosession())
+        try:
+            rsp = await self.llm.ChatCompletion.acreate(**self._cons_kwargs(messages, admission), **kwargs)
+        finally:
+            openai.aiosession.reset(token)
+        self._update_costs(rsp.get('usage'), admission)
         return rsp
 
     def _chat_completion(self, messages: list[dict]) -> dict:
-        rsp = self.llm.ChatCompletion.create(**self._cons_kwargs(messages))
-        self._update_costs(rsp)
+        """Blocking completion, admitted by the budget and paced by the rate limiter like the async ones"""
+        prompt_tokens = self._count_prompt_tokens(messages)
+        admission = admit(self.model, prompt_tokens)
+        reserved_tokens, used_tokens = prompt_tokens + admission.max_tokens, 0
+        try:
+            self.rate_limiter.wait_if_needed_sync(1, reserved_tokens)
+            rsp = self.llm.ChatCompletion.create(**self._cons_kwargs(messages, admission))
+            used_tokens = prompt_tokens + self._count_completion_tokens(self.get_choice_text(rsp))
+        finally:
+            get_cost_manager().release(admission)
+            self.rate_limiter.settle(reserved_tokens, used_tokens)
+        self._update_costs(rsp.get('usage'), admission)
         return rsp
 
     def completion(self, messages: list[dict]) -> dict:
@@ -218,41 +454,210 @@ class OpenAIGPTAPI(BaseGPTAPI, RateLimiter):
         #     messages = self.messages_to_dict(messages)
         return self._chat_completion(messages)
 
+    @instrumented
     async def acompletion(self, messages: list[dict]) -> dict:
         # if isinstance(messages[0], Message):
         #     messages = self.messages_to_dict(messages)
-        return await self._achat_completion(messages)
+        admission = admit(self.model, self._count_prompt_tokens(messages))
+        try:
+            return await self._achat_completion(messages, admission)
+        finally:
+            get_cost_manager().release(admission)
+
+    async def acompletion_text(self, messages: list[dict], stream=False, sinks=(), check=None) -> str:
+        """when streaming, every delta goes to the stream sinks subscribed in the current context and to `sinks`.
+        check: raises if the caller cannot use the answer, e.g. it does not parse. Only answers passing it are cached,
+        so a retry after a parse failure asks the LLM again instead of getting the same answer back."""
+        cache = ResponseCache()
+        key = cache.make_key(self._cons_kwargs(messages))
+        rsp = self._cache_get(cache, key, check)
+        if rsp is not None:
+            if stream:
+                replay(rsp, sinks)
+            return rsp
+
+        leader = False
+
+        async def call():
+            nonlocal leader
+            leader = True
+            rsp, admission = await self._acompletion_text(messages, stream, sinks)
+            if check:
+                check(rsp)
+            self._cache_put(cache, key, rsp, admission)
+            return rsp
+
+        # identical requests issued concurrently (e.g. by several roles) share one upstream call
+        rsp = await self._single_flight.do(key, call)
+        if stream and not leader:
+            # only the caller that made the call saw it stream, the others get the answer in one piece
+            replay(rsp, sinks)
+        return rsp
+
+    @staticmethod
+    def _cache_get(cache: ResponseCache, key: str, check=None) -> Optional[str]:
+        """The recorded answer of `key`, None if there is none or `check` rejects it"""
+        if not cache.readable:
+            return None
+        rsp = cache.get(key)
+        if rsp is not None and check:
+            try:
+                check(rsp)
+            except Exception as e:
+                if cache.mode == "replay":
+                    raise
+                logger.warning(f"Recorded answer rejected, asking again: {e}")
+                return None
+        return rsp
 
+    @staticmethod
+    def _cache_put(cache: ResponseCache, key: str, rsp: str, admission: Admission):
+        """Record the answer under the key of the full request, unless the budget made it a cheaper one"""
+        if not cache.writable:
+            return
+        if admission.decision != "admitted":
+            logger.debug(f"Not caching an answer {admission.decision} by the budget")
+            return
+        cache.put(key, rsp)
+
+    @instrumented
     @retry(max_retries=6)
-    async def acompletion_text(self, messages: list[dict], stream=False) -> str:
-        """when streaming, print each token in place."""
-        if stream:
-            return await self._achat_completion_stream(messages)
-        rsp = await self._achat_completion(messages)
-        return self.get_choice_text(rsp)
+    async def _acompletion_text(self, messages: list[dict], stream=False, sinks=()) -> tuple[str, Admission]:
+        prompt_tokens = self._count_prompt_tokens(messages)
+        admission = admit(self.model, prompt_tokens)
+        reserved_tokens, used_tokens = prompt_tokens + admission.max_tokens, 0
+        try:
+            note_queue_wait(await self.rate_limiter.wait_if_needed(1, reserved_tokens))
+            if stream or self.hedger:
+                # hedging needs the first token of the upstream stream, even if the caller does not stream
+                rsp = await self._achat_completion_stream(messages, forward=stream, sinks=sinks, admission=admission)
+            else:
+                rsp = self.get_choice_text(await self._achat_completion(messages, admission))
+            used_tokens = prompt_tokens + self._count_completion_tokens(rsp)
+        finally:
+            get_cost_manager().release(admission)
+            # a failed call gives its whole reservation back, or every retry would shrink the shared capacity
+            self.rate_limiter.settle(reserved_tokens, used_tokens)
+        return rsp, admission
+
+    async def aask_json(self, msg: str, schema: dict, name: str, system_msgs: Optional[list[str]] = None,
+                        check=None) -> dict:
+        """Ask for an answer matching the JSON `schema`, enforced through a forced function call.
+        check: raises if the parsed answer does not fit the schema, only answers that parse and pass it are cached"""
+        if system_msgs:
+            messages = self._system_msgs(system_msgs)
+        else:
+            messages = [self._default_system_msg()]
+        messages += [self._system_msg(STRUCTURED_OUTPUT_PROMPT.format(name=name)), self._user_msg(msg)]
+        function = {"name": name, "parameters": schema}
+
+        def parse(arguments: str) -> dict:
+            parsed = json.loads(arguments)
+            if check:
+                check(parsed)
+            return parsed
+
+        cache = ResponseCache()
+        key = cache.make_key({**self._cons_kwargs(messages), "functions": [function]})
+        rsp = self._cache_get(cache, key, parse)
+        if rsp is None:
+            async def call():
+                arguments, admission = await self._acompletion_json(messages, function)
+                parse(arguments)
+                self._cache_put(cache, key, arguments, admission)
+                return arguments
+
+            rsp = await self._single_flight.do(key, call)
+        return json.loads(rsp)
+
+    @instrumented
+    @retry(max_retries=6)
+    async def _acompletion_json(self, messages: list[dict], function: dict) -> tuple[str, Admission]:
+        prompt_tokens = self._count_prompt_tokens(messages) + self.context.count(json.dumps(function))
+        admission = admit(self.model, prompt_tokens)
+        reserved_tokens, used_tokens = prompt_tokens + admission.max_tokens, 0
+        try:
+            note_queue_wait(await self.rate_limiter.wait_if_needed(1, reserved_tokens))
+            rsp = await self._achat_completion(messages, admission, functions=[function],
+                                               function_call={"name": function["name"]})
+            used_tokens = int(rsp['usage']['total_tokens'])
+        finally:
+            get_cost_manager().release(admission)
+            self.rate_limiter.settle(reserved_tokens, used_tokens)
+        return rsp["choices"][0]["message"]["function_call"]["arguments"], admission
+
+    def _count_prompt_tokens(self, messages: list[dict]) -> int:
+        """Prompt size for rate limiting and budgeting, also for models tiktoken does not know.
+        Counts are memoized, so counting the same prompt again after the call is cheap."""
+        return self.context.count_messages(messages)
+
+    def _count_completion_tokens(self, rsp: str) -> int:
+        return self.context.count(rsp)
 
     def _calc_usage(self, messages: list[dict], rsp: str) -> dict:
         usage = {}
-        prompt_tokens = count_message_tokens(messages, self.model)
-        completion_tokens = count_string_tokens(rsp, self.model)
+        prompt_tokens = self._count_prompt_tokens(messages)
+        completion_tokens = self._count_completion_tokens(rsp)
         usage['prompt_tokens'] = prompt_tokens
         usage['completion_tokens'] = completion_tokens
         return usage
 
+    async def _acompletion_batch_item(self, idx: int, prompt: list[dict], concurrency: AdaptiveConcurrency,
+                                      max_retries=6) -> tuple[int, dict]:
+        for i in range(max_retries):
+            await concurrency.acquire()
+            reserved_tokens = self._count_prompt_tokens(prompt) + CONFIG.max_tokens_rsp
+            try:
+                result = await self._acompletion_batch_call(prompt, reserved_tokens)
+            except Exception as e:
+                overloaded = is_overloaded(e)
+                # only overloads change the limit, a bad request or an auth error must not raise it
+                concurrency.release(overloaded=True, adjust=overloaded)
+                self.rate_limiter.settle(reserved_tokens, 0)
+                if not overloaded or i == max_retries - 1 or not get_retry_budget().take():
+                    raise
+                delay = retry_after(e)
+                if delay is not None:
+                    self.rate_limiter.defer(delay)
+                logger.warning(f"Batch request {idx} overloaded, concurrency down to {int(concurrency.limit)}: {e}")
+                continue
+            except asyncio.CancelledError:
+                # the batch was abandoned, e.g. its consumer stopped early
+                concurrency.release(adjust=False)
+                self.rate_limiter.settle(reserved_tokens, 0)
+                raise
+            concurrency.release()
+            self.rate_limiter.settle(reserved_tokens, int(result['usage']['total_tokens']))
+            return idx, result
+
+    @instrumented
+    async def _acompletion_batch_call(self, prompt: list[dict], reserved_tokens: int) -> dict:
+        # waiting for the rate limiter is part of the recorded call, like for the other completions
+        note_queue_wait(await self.rate_limiter.wait_if_needed(1, reserved_tokens))
+        return await self.acompletion(prompt)
+
+    async def acompletion_batch_iter(self, batch: list[list[dict]]) -> AsyncIterator[tuple[int, dict]]:
+        """Yield (index in batch, full JSON) for every prompt as soon as its completion arrives.
+        Concurrency grows while requests succeed and is halved on 429/5xx, the rate limiter still paces the starts."""
+        concurrency = AdaptiveConcurrency(maximum=self.rpm)
+        role, action = current_caller()
+        # the tasks inherit the caller's metrics scope, batches started outside of one are recorded as "batch"
+        with calling(role, action or "batch"):
+            tasks = [asyncio.create_task(self._acompletion_batch_item(idx, prompt, concurrency))
+                     for idx, prompt in enumerate(batch)]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            for task in tasks:
+                task.cancel()
+
     async def acompletion_batch(self, batch: list[list[dict]]) -> list[dict]:
         """返回完整JSON"""
-        split_batches = self.split_batches(batch)
-        all_results = []
-
-        for small_batch in split_batches:
-            logger.info(small_batch)
-            await self.wait_if_needed(len(small_batch))
-
-            future = [self.acompletion(prompt) for prompt in small_batch]
-            results = await asyncio.gather(*future)
-            logger.info(results)
-            all_results.extend(results)
-
+        all_results = [None] * len(batch)
+        async for idx, result in self.acompletion_batch_iter(batch):
+            logger.info(f"Result of task {idx + 1} received")
+            all_results[idx] = result
         return all_results
 
     async def acompletion_batch_text(self, batch: list[list[dict]]) -> list[str]:
@@ -265,10 +670,10 @@ class OpenAIGPTAPI(BaseGPTAPI, RateLimiter):
             logger.info(f"Result of task {idx}: {result}")
         return results
 
-    def _update_costs(self, usage: dict):
+    def _update_costs(self, usage: dict, admission: Admission = None):
         prompt_tokens = int(usage['prompt_tokens'])
         completion_tokens = int(usage['completion_tokens'])
-        self._cost_manager.update_cost(prompt_tokens, completion_tokens, self.model)
+        get_cost_manager().update_cost(prompt_tokens, completion_tokens, admission.model if admission else self.model)
 
     def get_costs(self) -> Costs:
-        return self._cost_manager.get_costs()
+        return get_cost_manager().get_costs()
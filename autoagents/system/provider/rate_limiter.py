@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : rate_limiter.py
+@Desc    : process-wide request/token rate control, shared by every provider that uses the same key and model
+"""
+import asyncio
+import time
+
+from autoagents.system.logs import logger
+
+
+class TokenBucket:
+    """A bucket holding at most `capacity` units, refilled with `per_minute` units every minute.
+
+    Units are taken eagerly and the bucket may go into debt, so a reservation never has to be retried:
+    the caller only has to sleep until the debt it created is paid back.
+    """
+    def __init__(self, capacity: float, per_minute: float):
+        self.capacity = capacity
+        self.fill_rate = per_minute / 60
+        self.level = capacity
+        self.updated = time.time()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Take `amount` units and return how many seconds the caller has to wait before using them"""
+        self._refill(now)
+        self.level -= amount
+        if self.level >= 0:
+            return 0
+        return -self.level / self.fill_rate
+
+    def try_take(self, amount: float, now: float) -> bool:
+        """Take `amount` units only if they are there right away"""
+        self._refill(now)
+        if self.level < amount:
+            return False
+        self.level -= amount
+        return True
+
+    def refund(self, amount: float):
+        """Give back units that were reserved but not used (a negative amount charges extra units)"""
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """Rate control class, each call goes through wait_if_needed, sleep if rate control is needed.
+
+    Requests are paced one by one at `rpm`, and when `tpm` is set the estimated prompt plus completion tokens
+    of every call are taken from a tokens-per-minute bucket as well.
+    """
+    def __init__(self, rpm, tpm=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.interval = 1.1 * 60 / rpm  # Here 1.1 is used because even if the calls are made strictly according to time, they will still be QOS'd
+        self.resume_time = 0
+        self._requests = TokenBucket(1, 60 / self.interval)
+        self._tokens = TokenBucket(tpm, tpm) if tpm else None
+
+    def split_batches(self, batch):
+        return [batch[i:i + self.rpm] for i in range(0, len(batch), self.rpm)]
+
+    def defer(self, seconds: float):
+        """Hold back every following call for `seconds`, e.g. when the server answered with Retry-After"""
+        self.resume_time = max(self.resume_time, time.time() + seconds)
+
+    def _reserve(self, num_requests, num_tokens) -> float:
+        # Reserving happens before sleeping, so concurrent callers queue up behind each other
+        # instead of all waking up at the same time.
+        current_time = time.time()
+        remaining_time = max(self._requests.reserve(num_requests, current_time), self.resume_time - current_time)
+        if self._tokens and num_tokens:
+            remaining_time = max(remaining_time, self._tokens.reserve(num_tokens, current_time))
+        if remaining_time > 0:
+            logger.info(f"sleep {remaining_time}")
+            return remaining_time
+        return 0
+
+    async def wait_if_needed(self, num_requests, num_tokens=0) -> float:
+        """Reserve `num_requests` requests and `num_tokens` tokens, sleep until they are available.
+        Return the time spent waiting."""
+        remaining_time = self._reserve(num_requests, num_tokens)
+        if remaining_time:
+            await asyncio.sleep(remaining_time)
+        return remaining_time
+
+    def wait_if_needed_sync(self, num_requests, num_tokens=0) -> float:
+        """wait_if_needed for blocking calls"""
+        remaining_time = self._reserve(num_requests, num_tokens)
+        if remaining_time:
+            time.sleep(remaining_time)
+        return remaining_time
+
+    def try_acquire(self, num_requests=1, num_tokens=0) -> bool:
+        """Reserve like wait_if_needed, but only if no waiting is needed, e.g. for optional extra requests.
+        Nothing is reserved when it returns False."""
+        current_time = time.time()
+        if current_time < self.resume_time or not self._requests.try_take(num_requests, current_time):
+            return False
+        if self._tokens and num_tokens and not self._tokens.try_take(num_tokens, current_time):
+            self._requests.refund(num_requests)
+            return False
+        return True
+
+    def settle(self, reserved_tokens: int, used_tokens: int):
+        """Correct a token reservation once the real usage of the call is known"""
+        if self._tokens:
+            self._tokens.refund(reserved_tokens - used_tokens)
+
+
+class AdaptiveConcurrency:
+    """AIMD concurrency limit: every success raises the limit by one, every overload halves it.
+
+    Call `acquire()` before a request and `release(overloaded=...)` once its outcome is known, or
+    `release(adjust=False)` if the outcome says nothing about the load (a bad request, a cancelled one).
+    """
+    def __init__(self, initial=1, minimum=1, maximum=64):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._released = asyncio.Event()
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            self._released.clear()
+            await self._released.wait()
+        self.in_flight += 1
+
+    def release(self, overloaded=False, adjust=True):
+        self.in_flight -= 1
+        if adjust and overloaded:
+            self.limit = max(self.minimum, self.limit / 2)
+        elif adjust:
+            self.limit = min(self.maximum, self.limit + 1)
+        self._released.set()
+
+
+_RATE_LIMITERS: dict[tuple[str, str], RateLimiter] = {}
+
+
+def get_rate_limiter(api_key: str, model: str, rpm: int, tpm: int = 0) -> RateLimiter:
+    """Return the limiter shared by every provider calling `model` with `api_key` in this process"""
+    key = (api_key or "", model)
+    if key not in _RATE_LIMITERS:
+        _RATE_LIMITERS[key] = RateLimiter(rpm, tpm)
+    return _RATE_LIMITERS[key]
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : response_cache.py
+@Desc    : content-addressed cache of LLM responses, stored in a local SQLite file
+"""
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+
+from autoagents.system.config import CONFIG
+from autoagents.system.const import DATA_PATH
+from autoagents.system.logs import logger
+from autoagents.system.utils.singleton import Singleton
+
+CACHE_MODES = ("off", "on", "record", "replay")
+
+
+class CacheMissError(Exception):
+    """Raised in replay mode when a request has no recorded response"""
+
+    def __init__(self, key: str, message="No recorded LLM response"):
+        self.key = key
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'{self.message} -> key: {self.key}'
+
+
+class ResponseCache(metaclass=Singleton):
+    """
+    LLM_CACHE modes:
+    - off: never read nor write the cache
+    - on: serve recorded responses, record the new ones
+    - record: always call the LLM and (re)record its response
+    - replay: only serve recorded responses, raise CacheMissError for anything else
+    """
+
+    def __init__(self, path=None, mode=None, max_size_mb=None):
+        self.mode = mode or CONFIG.llm_cache
+        if self.mode not in CACHE_MODES:
+            raise ValueError(f"LLM_CACHE must be one of {CACHE_MODES}, got {self.mode!r}")
+        self.path = Path(path or CONFIG.llm_cache_path or DATA_PATH / "llm_cache.sqlite")
+        self.max_size = int(float(max_size_mb or CONFIG.llm_cache_size_mb) * 1024 * 1024)
+        self._db: sqlite3.Connection = None
+        self._size = 0
+
+    @property
+    def readable(self) -> bool:
+        return self.mode in ("on", "replay")
+
+    @property
+    def writable(self) -> bool:
+        return self.mode in ("on", "record")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses "
+                             "(key TEXT PRIMARY KEY, response TEXT, size INTEGER, accessed REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self._db
+
+    @staticmethod
+    def make_key(request: dict) -> str:
+        """Hash the parts of a completion request that determine its response"""
+        fields = {k: request.get(k) for k in ("model", "deployment_id", "messages", "temperature", "max_tokens", "stop")}
+        if request.get("functions"):
+            fields["functions"] = request["functions"]
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        db = self._connect()
+        row = db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            if self.mode == "replay":
+                raise CacheMissError(key)
+            return None
+        db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        db.commit()
+        logger.debug(f"LLM cache hit: {key}")
+        return row[0]
+
+    def put(self, key: str, response: str):
+        db = self._connect()
+        size = len(response.encode("utf-8"))
+        old = db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        db.execute("INSERT OR REPLACE INTO responses (key, response, size, accessed) VALUES (?, ?, ?, ?)",
+                   (key, response, size, time.time()))
+        self._size += size - (old[0] if old else 0)
+        if self._size > self.max_size:
+            self._evict()
+        db.commit()
+
+    def _evict(self):
+        """Drop the least recently used responses until the cache is back under 90% of its size limit"""
+        target = self.max_size * 0.9
+        evicted = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logger.info(f"LLM cache evicted {len(evicted)} responses")
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : retry_policy.py
+@Desc    : one retry subsystem for all providers: error classification, backoff with jitter, Retry-After,
+           a per-task retry budget and a circuit breaker per endpoint
+"""
+import asyncio
+import random
+import time
+from contextvars import ContextVar
+from enum import Enum
+from functools import wraps
+from typing import Optional
+
+import aiohttp
+import anthropic
+import openai
+
+from autoagents.system.config import CONFIG
+from autoagents.system.logs import logger
+from autoagents.system.provider.metrics import note_retry
+from autoagents.system.provider.response_cache import CacheMissError
+from autoagents.system.utils.common import NoMoneyException, OutputDivergedError
+
+
+class ErrorKind(Enum):
+    RATE_LIMITED = "rate_limited"  # 429, retry once the endpoint allows it again
+    TRANSIENT = "transient"  # 5xx, timeouts, connection problems: retry with backoff
+    FATAL = "fatal"  # the same request will fail again: auth, bad request, context length, ...
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint that keeps failing"""
+
+    def __init__(self, endpoint: str, retry_in: float, message="Circuit open"):
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'{self.message} -> {self.endpoint}, retry in {self.retry_in:.0f}s'
+
+
+_FATAL_ERRORS = (openai.error.AuthenticationError, openai.error.PermissionError, openai.error.InvalidRequestError,
+                 CircuitOpenError, OutputDivergedError, NoMoneyException)
+_TRANSIENT_ERRORS = (openai.error.ServiceUnavailableError, openai.error.Timeout, openai.error.APIConnectionError,
+                     openai.error.TryAgain, asyncio.TimeoutError, ConnectionError)
+
+# errors that leave a provider have been through its retry loop already, callers must not retry them again
+PROVIDER_ERRORS = (openai.error.OpenAIError, anthropic.APIError, aiohttp.ClientError, asyncio.TimeoutError,
+                   ConnectionError, CircuitOpenError, CacheMissError, NoMoneyException)
+
+
+def _status(error: Exception) -> Optional[int]:
+    status = getattr(error, "http_status", None) or getattr(error, "status_code", None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error: Exception) -> ErrorKind:
+    status = _status(error)
+    if isinstance(error, openai.error.RateLimitError) or status == 429:
+        return ErrorKind.RATE_LIMITED
+    if isinstance(error, _FATAL_ERRORS) or (status is not None and 400 <= status < 500 and status != 408):
+        return ErrorKind.FATAL
+    if isinstance(error, _TRANSIENT_ERRORS) or (status is not None and (status == 408 or status >= 500)):
+        return ErrorKind.TRANSIENT
+    # unknown errors (e.g. wrapped ones from litellm) are assumed transient, the retry budget bounds them
+    return ErrorKind.TRANSIENT
+
+
+def is_overloaded(error: Exception) -> bool:
+    """Whether an API error means the endpoint is overloaded (429 or 5xx) rather than the request being wrong"""
+    status = _status(error)
+    return classify_error(error) == ErrorKind.RATE_LIMITED or (status is not None and status >= 500) or \
+        isinstance(error, (openai.error.ServiceUnavailableError, openai.error.Timeout))
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Return the Retry-After delay in seconds carried by an API error, if any"""
+    headers = getattr(error, "headers", None) or getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class TaskBudget:
+    """How many more retries (or other extra calls) a task may spend, across all of its LLM calls"""
+
+    def __init__(self, remaining: int):
+        self.remaining = remaining
+
+    def take(self) -> bool:
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+_RETRY_BUDGET: ContextVar[Optional[TaskBudget]] = ContextVar("retry_budget", default=None)
+
+
+def set_retry_budget(retries: int):
+    """Give the current task, and the tasks it starts, its own retry budget"""
+    _RETRY_BUDGET.set(TaskBudget(retries))
+
+
+def get_retry_budget() -> TaskBudget:
+    budget = _RETRY_BUDGET.get()
+    if budget is None:
+        budget = TaskBudget(int(CONFIG.retry_budget))
+        _RETRY_BUDGET.set(budget)
+    return budget
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures of an endpoint, so callers fail fast for `reset_timeout`
+    seconds; then a single trial call is let through (half-open) and its outcome closes or re-opens the circuit."""
+
+    def __init__(self, endpoint: str, threshold: int, reset_timeout: float):
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def before_call(self) -> bool:
+        """Raise CircuitOpenError while the circuit is open, return whether the call is the trial of a half-open one"""
+        if self.opened_at is None:
+            return False
+        waited = time.time() - self.opened_at
+        if waited < self.reset_timeout or self.trial_running:
+            raise CircuitOpenError(self.endpoint, max(0, self.reset_timeout - waited))
+        self.trial_running = True
+        return True
+
+    def on_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def on_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f"Circuit opened for {self.endpoint} after {self.failures} failures")
+            self.opened_at = time.time()
+
+
+_CIRCUIT_BREAKERS: dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(endpoint: str) -> CircuitBreaker:
+    if endpoint not in _CIRCUIT_BREAKERS:
+        _CIRCUIT_BREAKERS[endpoint] = CircuitBreaker(endpoint, int(CONFIG.circuit_breaker_threshold),
+                                                     float(CONFIG.circuit_breaker_reset))
+    return _CIRCUIT_BREAKERS[endpoint]
+
+
+def backoff(attempt: int, base=1.0, cap=60.0) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry(max_retries):
+    """Retry a provider coroutine method. The provider needs `endpoint` and `rate_limiter` attributes.
+
+    Fatal errors are raised at once, rate limited calls wait for the Retry-After of the server (through the shared
+    rate limiter) or back off with jitter, and every retry is paid from the retry budget of the current task.
+    Transient failures count towards the circuit breaker of the endpoint.
+    """
+    def decorator(f):
+        @wraps(f)
+        async def wrapper(self, *args, **kwargs):
+            breaker = get_circuit_breaker(self.endpoint)
+            for i in range(max_retries):
+                trial = breaker.before_call()
+                try:
+                    rsp = await f(self, *args, **kwargs)
+                except Exception as e:
+                    kind = classify_error(e)
+                    if kind == ErrorKind.TRANSIENT:
+                        breaker.on_failure()
+                    elif trial:
+                        breaker.trial_running = False
+                    if kind == ErrorKind.FATAL or i == max_retries - 1 or not get_retry_budget().take():
+                        raise
+                    delay = retry_after(e)
+                    if delay is None:
+                        delay = backoff(i)
+                        logger.warning(f"{kind.value} error, retry {i + 1}/{max_retries - 1} in {delay:.1f}s: {e}")
+                        note_retry(backoff=delay)
+                        await asyncio.sleep(delay)
+                    else:
+                        logger.warning(f"{kind.value} error, retry {i + 1}/{max_retries - 1} after {delay:.1f}s: {e}")
+                        # the rate limiter holds the next call back until the server allows it again
+                        note_retry()
+                        self.rate_limiter.defer(delay)
+                    continue
+                except BaseException:
+                    # cancelled (a lost hedge, an interrupt, a timeout): the trial has no outcome, the next call is one
+                    if trial:
+                        breaker.trial_running = False
+                    raise
+                breaker.on_success()
+                return rsp
+        return wrapper
+    return decorator
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : router.py
+@Desc    : route every LLM call site to a model by the class of task it asks for
+"""
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from autoagents.system.config import CONFIG
+from autoagents.system.logs import logger
+from autoagents.system.utils.singleton import Singleton
+
+CLASSIFICATION = "classification"  # pick one of a few options, e.g. the next state of a role
+CRITIQUE = "critique"  # review a plan or a team, usually answering "No Suggestions"
+GENERATION = "generation"  # write the actual content
+SUMMARIZATION = "summarization"  # condense the messages a bounded memory evicted
+TASK_CLASSES = (CLASSIFICATION, CRITIQUE, GENERATION, SUMMARIZATION)
+
+_ROUTE: ContextVar[str] = ContextVar("llm_route", default=GENERATION)
+
+
+class RouteStats:
+    def __init__(self):
+        self.calls = 0
+        self.latency = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+
+    def to_dict(self) -> dict:
+        return {"calls": self.calls, "avg_latency": self.latency / self.calls if self.calls else 0,
+                "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens, "cost": self.cost}
+
+
+_TASK_STATS: ContextVar[Optional[dict[str, RouteStats]]] = ContextVar("task_route_stats", default=None)
+
+
+def start_task_routes() -> dict[str, RouteStats]:
+    """Count the calls of the current task, and of the tasks it starts, per route apart from other tasks"""
+    stats = {task_class: RouteStats() for task_class in TASK_CLASSES}
+    _TASK_STATS.set(stats)
+    return stats
+
+
+def task_route_summary() -> dict:
+    """Route stats of the current task, empty outside of a task"""
+    stats = _TASK_STATS.get() or {}
+    return {task_class: i.to_dict() for task_class, i in stats.items() if i.calls}
+
+
+class Router(metaclass=Singleton):
+    """Maps task classes to models (LLM_ROUTES in config.yaml) and keeps cost and latency counters per route.
+    Task classes without a route use the default model of the provider.
+    Its stats cover the whole process, the ones of the current task are kept apart too (see start_task_routes)."""
+
+    def __init__(self, routes: Optional[dict] = None):
+        self.routes = dict(routes if routes is not None else CONFIG.llm_routes or {})
+        unknown = set(self.routes) - set(TASK_CLASSES)
+        if unknown:
+            logger.warning(f"Unknown task classes in LLM_ROUTES: {unknown}, expected some of {TASK_CLASSES}")
+        self.stats = {task_class: RouteStats() for task_class in TASK_CLASSES}
+
+    def model(self, task_class: str) -> str:
+        return self.routes.get(task_class, '')
+
+    def _stats(self, task_class: str) -> list[RouteStats]:
+        task_stats = _TASK_STATS.get()
+        return [self.stats[task_class]] + ([task_stats[task_class]] if task_stats else [])
+
+    def record_latency(self, task_class: str, latency: float):
+        for stats in self._stats(task_class):
+            stats.calls += 1
+            stats.latency += latency
+
+    def record_cost(self, prompt_tokens: int, completion_tokens: int, cost: float):
+        """Charge a call to the route it was made on"""
+        for stats in self._stats(_ROUTE.get()):
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.cost += cost
+
+    def summary(self) -> dict:
+        return {task_class: stats.to_dict() for task_class, stats in self.stats.items() if stats.calls}
+
+
+class RoutedLLM:
+    """A provider bound to a task class: calls made through it are counted on that route"""
+
+    def __init__(self, task_class: str, llm):
+        self.task_class = task_class
+        self.llm = llm
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    async def _routed(self, coro):
+        token = _ROUTE.set(self.task_class)
+        start = time.time()
+        try:
+            return await coro
+        finally:
+            Router().record_latency(self.task_class, time.time() - start)
+            _ROUTE.reset(token)
+
+    async def aask(self, msg: str, system_msgs: Optional[list[str]] = None, sinks=(), check=None) -> str:
+        return await self._routed(self.llm.aask(msg, system_msgs, sinks, check))
+
+    async def acompletion_text(self, messages: list[dict], stream=False, sinks=(), check=None) -> str:
+        return await self._routed(self.llm.acompletion_text(messages, stream, sinks, check))
+
+    async def aask_json(self, msg: str, schema: dict, name: str, system_msgs: Optional[list[str]] = None,
+                        check=None) -> dict:
+        return await self._routed(self.llm.aask_json(msg, schema, name, system_msgs, check))
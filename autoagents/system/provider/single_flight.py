@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : single_flight.py
+@Desc    : coalesce identical in-flight calls into one
+"""
+import asyncio
+from typing import Awaitable, Callable
+
+from autoagents.system.logs import logger
+
+
+class SingleFlight:
+    """Run at most one call per key at a time. Callers arriving while a call with the same key is in flight
+    wait for it and share its result (or its exception) instead of issuing their own."""
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        while key in self._calls:
+            future = self._calls[key]
+            logger.debug(f"Joining in-flight call {key}")
+            try:
+                # shield: a cancelled follower must not cancel the call the other callers are waiting for
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the caller that issued the call was cancelled, try again ourselves
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark as retrieved, there may be nobody waiting
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : streaming.py
+@Desc    : sinks that subscribe to the token stream of LLM completions
+"""
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Iterable
+
+from autoagents.system.logs import logger
+
+
+class StreamSink:
+    """Receives the deltas of every streamed completion it is subscribed to"""
+
+    def on_start(self):
+        """Called before every attempt of a completion, a retried one starts over from nothing"""
+
+    def on_delta(self, delta: str):
+        """Called for every piece of content as soon as it arrives"""
+
+    def on_end(self, text: str):
+        """Called with the full completion once the stream is exhausted"""
+
+
+class NullSink(StreamSink):
+    """Drops everything"""
+
+
+class LogSink(StreamSink):
+    """Writes the stream to the log line by line instead of token by token"""
+
+    def __init__(self, level="INFO"):
+        self.level = level
+        self._line = []
+
+    def on_start(self):
+        self._line = []
+
+    def on_delta(self, delta: str):
+        *lines, rest = delta.split("\n")
+        for line in lines:
+            self._line.append(line)
+            logger.log(self.level, "".join(self._line))
+            self._line = []
+        if rest:
+            self._line.append(rest)
+
+    def on_end(self, text: str):
+        if self._line:
+            logger.log(self.level, "".join(self._line))
+            self._line = []
+
+
+class QueueSink(StreamSink):
+    """Forwards partial output to a queue, e.g. the one the websocket worker sends to the client from.
+
+    Deltas are buffered until a line is complete or `flush_size` characters are pending, so the client
+    gets partial output right away without one queue message per token.
+    """
+
+    def __init__(self, queue, wrap: Callable[[str], object] = None, flush_size=64):
+        self.queue = queue
+        self.wrap = wrap or (lambda text: text)
+        self.flush_size = flush_size
+        self._pending = []
+        self._pending_size = 0
+
+    def _flush(self):
+        if self._pending:
+            self.queue.put_nowait(self.wrap("".join(self._pending)))
+            self._pending = []
+            self._pending_size = 0
+
+    def on_start(self):
+        # what was flushed already has been sent, only the unsent rest of a failed attempt is dropped
+        self._pending = []
+        self._pending_size = 0
+
+    def on_delta(self, delta: str):
+        self._pending.append(delta)
+        self._pending_size += len(delta)
+        if "\n" in delta or self._pending_size >= self.flush_size:
+            self._flush()
+
+    def on_end(self, text: str):
+        self._flush()
+
+
+_SINKS: ContextVar[tuple[StreamSink, ...]] = ContextVar("stream_sinks", default=())
+
+
+def subscribe(sink: StreamSink):
+    """Subscribe `sink` to the completions streamed from the current task and the tasks it starts"""
+    _SINKS.set(_SINKS.get() + (sink,))
+
+
+def get_sinks() -> tuple[StreamSink, ...]:
+    return _SINKS.get()
+
+
+def replay(text: str, sinks: Iterable[StreamSink] = ()):
+    """Pass an answer that did not stream from upstream, e.g. a cached one, to the sinks as a single delta"""
+    sinks = get_sinks() + tuple(sinks)
+    for sink in sinks:
+        sink.on_start()
+        if text:
+            sink.on_delta(text)
+        sink.on_end(text)
+
+
+async def collect(stream: AsyncIterator[str], sinks: Iterable[StreamSink] = ()) -> str:
+    """Consume a delta stream, fan every delta out to the subscribed `sinks`, return the full text.
+    Called once per attempt, so the sinks are reset first: a retry must not append to the failed attempt."""
+    sinks = get_sinks() + tuple(sinks)
+    for sink in sinks:
+        sink.on_start()
+    collected = []
+    try:
+        async for delta in stream:
+            collected.append(delta)
+            for sink in sinks:
+                sink.on_delta(delta)
+    finally:
+        await stream.aclose()
+    text = "".join(collected)
+    for sink in sinks:
+        sink.on_end(text)
+    return text
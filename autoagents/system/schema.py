@@ -6,6 +6,8 @@
 """
 from __future__ import annotations
 
+import hashlib
+import json
 from dataclasses import dataclass, field
 from typing import Type, TypedDict
 
@@ -33,6 +35,20 @@ class Message:
         # prefix = '-'.join([self.role, str(self.cause_by)])
         return f"{self.role}: {self.content}"
 
+    @property
+    def id(self) -> str:
+        """Stable hash of all fields: equal messages have equal ids. It is computed once, so a message must not be
+        changed after it was stored (use dataclasses.replace for a changed copy)"""
+        if "_id" not in self.__dict__:
+            cause_by = self.cause_by if isinstance(self.cause_by, str) else \
+                f"{self.cause_by.__module__}.{self.cause_by.__qualname__}"
+            instruct_content = json.dumps(self.instruct_content.dict(), sort_keys=True, default=str) \
+                if isinstance(self.instruct_content, BaseModel) else str(self.instruct_content)
+            fields = [self.content, self.role, cause_by, self.sent_from, self.send_to, instruct_content]
+            self.__dict__["_id"] = hashlib.blake2b("\0".join(fields).encode("utf-8", "surrogatepass"),
+                                                   digest_size=16).hexdigest()
+        return self.__dict__["_id"]
+
     def __repr__(self):
         return self.__str__()
 
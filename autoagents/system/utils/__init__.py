@@ -13,4 +13,5 @@ from .token_counter import (
     TOKEN_COSTS,
     count_message_tokens,
     count_string_tokens,
+    count_tokens_batch,
 )
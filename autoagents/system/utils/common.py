@@ -10,7 +10,7 @@ import ast
 import inspect
 import os
 import re
-from typing import List, Tuple
+from typing import Callable, List, Tuple
 
 from autoagents.system.logs import logger
 
@@ -104,31 +104,112 @@ class OutputParser:
         block_dict = cls.parse_blocks(data)
         parsed_data = {}
         for block, content in block_dict.items():
-            # 尝试去除code标记
+            parsed_data[block] = cls.parse_content_with_mapping(block, content, mapping)
+        return parsed_data
+
+    @classmethod
+    def render_blocks(cls, data: dict) -> str:
+        """The inverse of parse_data_with_mapping: "## Block" text of parsed data"""
+        blocks = []
+        for block, content in data.items():
+            if isinstance(content, (list, tuple)):
+                content = f"```python\n{list(content)!r}\n```"
+            blocks.append(f"## {block}\n{content}\n")
+        return "\n".join(blocks)
+
+    @classmethod
+    def parse_content_with_mapping(cls, block, content, mapping):
+        # 尝试去除code标记
+        try:
+            content = cls.parse_code(text=content)
+        except Exception:
+            pass
+        typing_define = mapping.get(block, None)
+        if isinstance(typing_define, tuple):
+            typing = typing_define[0]
+        else:
+            typing = typing_define
+        if typing == List[str] or typing == List[Tuple[str, str]]:
+            # 尝试解析list
             try:
-                content = cls.parse_code(text=content)
+                content = cls.parse_file_list(text=content)
             except Exception:
                 pass
-            typing_define = mapping.get(block, None)
-            if isinstance(typing_define, tuple):
-                typing = typing_define[0]
-            else:
-                typing = typing_define
-            if typing == List[str] or typing == List[Tuple[str, str]]:
-                # 尝试解析list
-                try:
-                    content = cls.parse_file_list(text=content)
-                except Exception:
-                    pass
-            # TODO: 多余的引号去除有风险，后期再解决
-            # elif typing == str:
-            #     # 尝试去除多余的引号
-            #     try:
-            #         content = cls.parse_str(text=content)
-            #     except Exception:
-            #         pass
-            parsed_data[block] = content
-        return parsed_data
+        # TODO: 多余的引号去除有风险，后期再解决
+        # elif typing == str:
+        #     # 尝试去除多余的引号
+        #     try:
+        #         content = cls.parse_str(text=content)
+        #     except Exception:
+        #         pass
+        return content
+
+
+class IncrementalOutputParser:
+    """Parses a "## Block" output while it is streamed, subscribe it to the completion as a stream sink.
+
+    Every block is parsed (the same way as parse_data_with_mapping) and validated against the field of
+    `output_class` as soon as the next "##" closes it. When the output has clearly left the format -- a block
+    fails validation, a block of the mapping is repeated, a block has no content line or no block starts
+    within `max_preamble` characters -- OutputDivergedError is raised, which ends the stream right away.
+    """
+
+    def __init__(self, mapping: dict, output_class=None, on_block: Callable[[str, object], None] = None,
+                 max_preamble=2000):
+        self.mapping = mapping
+        self.fields = output_class.__fields__ if output_class else {}
+        self.on_block = on_block
+        self.max_preamble = max_preamble
+        self.on_start()
+
+    def on_start(self):
+        """Forget the output of a previous attempt, the retried completion is parsed from its beginning"""
+        self.text = ""
+        self.blocks = {}
+        self._pending = ""
+        self._started = False
+
+    def feed(self, delta: str) -> dict:
+        """Add a piece of the output, return the blocks it closed"""
+        self.text += delta
+        self._pending += delta
+        *closed, self._pending = self._pending.split("##")
+        parsed = {}
+        for block in closed:
+            if self._started:
+                parsed.update(self._close(block))
+            self._started = True
+        if not self._started and len(self._pending) > self.max_preamble:
+            raise OutputDivergedError(self.text, f"no block within {self.max_preamble} characters")
+        return parsed
+
+    def _close(self, block: str) -> dict:
+        if block.strip() == "":
+            return {}
+        if "\n" not in block:
+            raise OutputDivergedError(self.text, f"block without content: {block.strip()[:50]}")
+        block_title, block_content = block.split("\n", 1)
+        block_title = block_title.strip()
+        if block_title.endswith(":"):
+            block_title = block_title[:-1].strip()
+        if block_title in self.blocks and block_title in self.mapping:
+            raise OutputDivergedError(self.text, f"block {block_title} repeated")
+        content = OutputParser.parse_content_with_mapping(block_title, block_content.strip(), self.mapping)
+        if block_title in self.fields:
+            content, errors = self.fields[block_title].validate(content, {}, loc=block_title)
+            if errors:
+                raise OutputDivergedError(self.text, f"block {block_title} is invalid: {errors}")
+        self.blocks[block_title] = content
+        logger.debug(f"Block {block_title} complete")
+        if self.on_block:
+            self.on_block(block_title, content)
+        return {block_title: content}
+
+    def on_delta(self, delta: str):
+        self.feed(delta)
+
+    def on_end(self, text: str):
+        pass
 
 
 class CodeParser:
@@ -199,6 +280,18 @@ class CodeParser:
         return tasks
 
 
+class OutputDivergedError(Exception):
+    """Raised when a streamed output has left the expected format, `text` is what was received until then"""
+
+    def __init__(self, text, message="Output diverged from the format"):
+        self.text = text
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'Output diverged from the format -> {self.message}'
+
+
 class NoMoneyException(Exception):
     """Raised when the operation cannot be completed due to insufficient funds"""
 
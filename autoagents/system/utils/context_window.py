@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : context_window.py
+@Desc    : keep prompts inside the context window of the model they are sent to
+"""
+from dataclasses import replace
+
+from autoagents.system.config import CONFIG
+from autoagents.system.logs import logger
+from autoagents.system.schema import Message
+from autoagents.system.utils.pricing import ModelRegistry
+from autoagents.system.utils.token_counter import (
+    count_message_tokens,
+    count_string_tokens,
+    count_tokens_batch,
+    get_encoding,
+)
+
+TRUNCATION_MARK = "\n[...truncated...]\n"
+
+
+class ContextWindow:
+    """Token budget of one model: the context window minus what is reserved for the completion"""
+
+    def __init__(self, model: str, reserved=None):
+        self.model = model
+        self.reserved = CONFIG.max_tokens_rsp if reserved is None else reserved
+        self.max_prompt_tokens = ModelRegistry().max_tokens(model) - self.reserved
+        # not an OpenAI model: cl100k_base is close enough for budgeting
+        self.encoding = get_encoding(model)
+
+    def count(self, text: str) -> int:
+        return count_string_tokens(text, self.model)
+
+    def count_messages(self, messages: list[dict]) -> int:
+        return count_message_tokens(messages, self.model)
+
+    def truncate(self, text: str, max_tokens: int, keep="tail") -> str:
+        """Cut `text` down to `max_tokens`, keeping its "head", its "tail" or both ends ("middle" is cut)"""
+        if self.count(text) <= max_tokens:
+            return text
+        tokens = self.encoding.encode_ordinary(text)
+        max_tokens = max(0, max_tokens - self.count(TRUNCATION_MARK))
+        if keep == "head":
+            return self.encoding.decode(tokens[:max_tokens]) + TRUNCATION_MARK
+        if keep == "tail":
+            return TRUNCATION_MARK + self.encoding.decode(tokens[len(tokens) - max_tokens:])
+        half = max_tokens // 2
+        return self.encoding.decode(tokens[:half]) + TRUNCATION_MARK + \
+            self.encoding.decode(tokens[len(tokens) - (max_tokens - half):])
+
+    def fit_history(self, history: list[Message], max_tokens: int, pin_first=True, sizes: list[int] = None) \
+            -> list[Message]:
+        """Sliding window over a message history: keep the newest messages that fit into `max_tokens`.
+        The first message (usually the task) is kept if `pin_first`, and dropped messages are replaced with a
+        note saying how many there were, so the size of the prompt stays bounded however long the task runs.
+        sizes: token counts of the messages if known already, e.g. from Memory.count_tokens"""
+        if not history:
+            return []
+        if sizes is None:
+            sizes = count_tokens_batch([str(i) for i in history], self.model)
+        if sum(sizes) <= max_tokens:
+            return list(history)
+
+        pinned = []
+        if pin_first:
+            first = history[0]
+            if sizes[0] > max_tokens // 2:
+                first = replace(first, content=self.truncate(first.content, max_tokens // 2, keep="head"))
+            pinned = [first]
+            max_tokens -= self.count(str(first))
+            history, sizes = history[1:], sizes[1:]
+
+        kept = []
+        for message, size in zip(reversed(history), reversed(sizes)):
+            if size > max_tokens:
+                if not kept:
+                    # not even the newest message fits, keep its end
+                    kept.append(replace(message, content=self.truncate(message.content, max_tokens)))
+                break
+            kept.append(message)
+            max_tokens -= size
+        omitted = len(history) - len(kept)
+        note = [Message(content=f"[{omitted} earlier messages omitted]", role="system")] if omitted else []
+        return pinned + note + kept[::-1]
+
+    def fit_messages(self, messages: list[dict]) -> list[dict]:
+        """Last resort before a call: shorten the longest message contents until the prompt fits,
+        so an oversized prompt fails neither upstream nor in the retry loop"""
+        excess = self.count_messages(messages) - self.max_prompt_tokens
+        if excess <= 0:
+            return messages
+        logger.warning(f"Prompt exceeds the {self.max_prompt_tokens} tokens of {self.model} by {excess}, truncating")
+        messages = [dict(i) for i in messages]
+        while excess > 0:
+            longest = max(messages, key=lambda i: len(i["content"]))
+            size = self.count(longest["content"])
+            if size <= self.count(TRUNCATION_MARK):
+                break
+            truncated = self.truncate(longest["content"], max(0, size - excess), keep="middle")
+            if len(truncated) >= len(longest["content"]):
+                break
+            longest["content"] = truncated
+            excess = self.count_messages(messages) - self.max_prompt_tokens
+        return messages
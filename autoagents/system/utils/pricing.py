@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : pricing.py
+@Desc    : prices, context windows and tokenizers of models, with fallbacks for unknown ones, and task cost forecasts
+"""
+from typing import NamedTuple, Optional
+
+from autoagents.system.config import CONFIG
+from autoagents.system.logs import logger
+from autoagents.system.utils.singleton import Singleton
+from autoagents.system.utils.token_counter import TOKEN_COSTS, TOKEN_MAX, TOKENIZERS, get_encoding
+
+DEFAULT_TOKEN_MAX = 4096
+
+
+class ModelRegistry(metaclass=Singleton):
+    """The built-in TOKEN_COSTS and TOKEN_MAX, overridden and extended by LLM_MODELS in config.yaml.
+
+    A model missing from both is looked up without its provider prefix ("azure/gpt-4") and by the longest known
+    name it starts with ("gpt-4-1106-preview" -> "gpt-4"). Unknown prices fall back to LLM_DEFAULT_PRICE, or to the
+    most expensive known price, so budgets err on the safe side instead of the call failing after it was paid for.
+    """
+
+    def __init__(self, models: Optional[dict] = None):
+        models = models if models is not None else CONFIG.llm_models or {}
+        self.prices = dict(TOKEN_COSTS)
+        self.token_max = dict(TOKEN_MAX)
+        for name, info in models.items():
+            if "prompt" in info and "completion" in info:
+                self.prices[name] = {"prompt": float(info["prompt"]), "completion": float(info["completion"])}
+            if "max_tokens" in info:
+                self.token_max[name] = int(info["max_tokens"])
+            if "tokenizer" in info:
+                TOKENIZERS[name] = info["tokenizer"]
+        get_encoding.cache_clear()
+        self.default_price = CONFIG.llm_default_price or max(self.prices.values(),
+                                                               key=lambda i: i["prompt"] + i["completion"])
+        self._warned = set()
+
+    @staticmethod
+    def _lookup(model: str, table: dict) -> Optional[str]:
+        name = model.split("/")[-1]
+        if name in table:
+            return name
+        prefixes = [i for i in table if name.startswith(i)]
+        return max(prefixes, key=len) if prefixes else None
+
+    def price(self, model: str) -> dict:
+        """Dollars per 1k prompt and completion tokens"""
+        known = self._lookup(model, self.prices)
+        if known:
+            return self.prices[known]
+        if model not in self._warned:
+            self._warned.add(model)
+            logger.warning(f"No price for {model}, add it to LLM_MODELS. Charging {self.default_price} per 1k tokens")
+        return self.default_price
+
+    def max_tokens(self, model: str) -> int:
+        """Context window of the model"""
+        known = self._lookup(model, self.token_max)
+        return self.token_max[known] if known else DEFAULT_TOKEN_MAX
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        price = self.price(model)
+        return (prompt_tokens * price["prompt"] + completion_tokens * price["completion"]) / 1000
+
+    def affordable_tokens(self, model: str, prompt_tokens: int, budget: float) -> int:
+        """The longest completion of `model` that `budget` dollars pay for after the prompt"""
+        price = self.price(model)
+        left = budget * 1000 - prompt_tokens * price["prompt"]
+        if left <= 0:
+            return 0
+        if not price["completion"]:
+            return self.max_tokens(model)
+        return int(left / price["completion"])
+
+
+class TaskForecast(NamedTuple):
+    calls: int
+    prompt_tokens: int
+    completion_tokens: int
+    cost: float
+
+
+def forecast_task_cost(model: str, agents_per_step: list[int], prompt_tokens_per_call: int,
+                       completion_tokens_per_call: int, rounds_per_step: int = None) -> TaskForecast:
+    """Predict what executing a plan costs: every step runs `rounds_per_step` rounds (FORECAST_ROUNDS) in which
+    each of its agents makes one call of the average size"""
+    rounds = int(CONFIG.forecast_rounds) if rounds_per_step is None else rounds_per_step
+    calls = sum(agents_per_step) * rounds
+    prompt_tokens = calls * prompt_tokens_per_call
+    completion_tokens = calls * completion_tokens_per_call
+    return TaskForecast(calls, prompt_tokens, completion_tokens,
+                        ModelRegistry().cost(model, prompt_tokens, completion_tokens))
@@ -9,8 +9,15 @@ ref1: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_
 ref2: https://github.com/Significant-Gravitas/Auto-GPT/blob/master/autogpt/llm/token_counter.py
 ref3: https://github.com/hwchase17/langchain/blob/master/langchain/chat_models/openai.py
 """
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
 import tiktoken
 
+from autoagents.system.logs import logger
+
 TOKEN_COSTS = {
     "gpt-3.5-turbo": {"prompt": 0.0015, "completion": 0.002},
     "gpt-3.5-turbo-0301": {"prompt": 0.0015, "completion": 0.002},
@@ -23,46 +30,132 @@ TOKEN_COSTS = {
     "gpt-4-32k-0314": {"prompt": 0.06, "completion": 0.12},
     "gpt-4-0613": {"prompt": 0.06, "completion": 0.12},
     "text-embedding-ada-002": {"prompt": 0.0004, "completion": 0.0},
+    "claude-instant-1": {"prompt": 0.00163, "completion": 0.00551},
+    "claude-2": {"prompt": 0.01102, "completion": 0.03268},
 }
 
 
-def count_message_tokens(messages, model="gpt-3.5-turbo-0613"):
-    """Return the number of tokens used by a list of messages."""
+TOKEN_MAX = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-0301": 4096,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo-16k-0613": 16384,
+    "gpt-4-0314": 8192,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-32k-0314": 32768,
+    "gpt-4-0613": 8192,
+    "text-embedding-ada-002": 8192,
+    "claude-instant-1": 100000,
+    "claude-2": 100000,
+}
+
+
+# model -> tiktoken encoding, for models tiktoken does not know (set from LLM_MODELS by ModelRegistry)
+TOKENIZERS: dict[str, str] = {}
+
+# (tokens per message, tokens per name) of the chat formats, see ref1
+MESSAGE_FORMATS = {
+    # every message follows <|start|>{role/name}\n{content}<|end|>\n, if there's a name, the role is omitted
+    "gpt-3.5-turbo-0301": (4, -1),
+    "gpt-3.5-turbo-0613": (3, 1),
+    "gpt-3.5-turbo-16k-0613": (3, 1),
+    "gpt-4-0314": (3, 1),
+    "gpt-4-32k-0314": (3, 1),
+    "gpt-4-0613": (3, 1),
+    "gpt-4-32k-0613": (3, 1),
+}
+
+TOKEN_COUNT_CACHE_SIZE = 8192
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """The tiktoken encoding of `model`, loaded once. Models neither TOKENIZERS nor tiktoken know get cl100k_base."""
+    if model in TOKENIZERS:
+        return tiktoken.get_encoding(TOKENIZERS[model])
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model in {
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-4-0314",
-        "gpt-4-32k-0314",
-        "gpt-4-0613",
-        "gpt-4-32k-0613",
-        }:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif "gpt-3.5-turbo" in model:
-        print("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-        return count_message_tokens(messages, model="gpt-3.5-turbo-0613")
-    elif "gpt-4" in model:
-        print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-        return count_message_tokens(messages, model="gpt-4-0613")
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-        )
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+        logger.debug(f"No tiktoken encoding for {model}, using cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=None)
+def _message_format(model: str) -> tuple[int, int]:
+    if model in MESSAGE_FORMATS:
+        return MESSAGE_FORMATS[model]
+    # gpt-3.5-turbo and gpt-4 may update over time, count them as their latest snapshot
+    if "gpt-3.5-turbo" in model:
+        return MESSAGE_FORMATS["gpt-3.5-turbo-0613"]
+    if "gpt-4" in model:
+        return MESSAGE_FORMATS["gpt-4-0613"]
+    # other chat models wrap messages differently, the current OpenAI format is a close enough estimate
+    logger.debug(f"No chat format for {model}, counting messages like gpt-4-0613")
+    return MESSAGE_FORMATS["gpt-4-0613"]
+
+
+class TokenCountCache:
+    """Bounded LRU of token counts, keyed by encoding and a hash of the text, so long prompts are not kept alive"""
+
+    def __init__(self, maxsize=TOKEN_COUNT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._counts: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+        self._lock = threading.Lock()  # counting also runs in executor threads
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(encoding: tiktoken.Encoding, text: str) -> tuple[str, bytes]:
+        return encoding.name, hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def get(self, key) -> int:
+        with self._lock:
+            count = self._counts.get(key)
+            if count is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._counts.move_to_end(key)
+            return count
+
+    def put(self, key, count: int):
+        with self._lock:
+            self._counts[key] = count
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.maxsize:
+                self._counts.popitem(last=False)
+
+
+_TOKEN_COUNTS = TokenCountCache()
+
+
+def count_tokens_batch(texts: list[str], model: str = "gpt-3.5-turbo") -> list[int]:
+    """Token counts of many texts at once: cached ones are looked up, the rest are encoded in one batch"""
+    encoding = get_encoding(model)
+    keys = [_TOKEN_COUNTS.key(encoding, text) for text in texts]
+    counts = [_TOKEN_COUNTS.get(key) for key in keys]
+    missing = {}  # the same text may appear several times
+    for i, count in enumerate(counts):
+        if count is None:
+            missing.setdefault(keys[i], texts[i])
+    if missing:
+        encoded = encoding.encode_ordinary_batch(list(missing.values()))
+        computed = {key: len(tokens) for key, tokens in zip(missing, encoded)}
+        for key, count in computed.items():
+            _TOKEN_COUNTS.put(key, count)
+        counts = [computed[key] if count is None else count for key, count in zip(keys, counts)]
+    return counts
+
+
+def count_message_tokens(messages, model="gpt-3.5-turbo-0613"):
+    """Return the number of tokens used by a list of messages."""
+    tokens_per_message, tokens_per_name = _message_format(model)
+    values = [value for message in messages for value in message.values()]
+    num_tokens = sum(count_tokens_batch(values, model))
+    num_tokens += tokens_per_message * len(messages)
+    num_tokens += tokens_per_name * sum(1 for message in messages if "name" in message)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
@@ -78,5 +171,4 @@ def count_string_tokens(string: str, model_name: str) -> int:
     Returns:
         int: The number of tokens in the text string.
     """
-    encoding = tiktoken.encoding_for_model(model_name)
-    return len(encoding.encode(string))
+    return count_tokens_batch([string], model_name)[0]
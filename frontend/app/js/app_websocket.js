@@ -354,6 +354,28 @@ function showCallingNextAgentMessage() {
   };
 }
 
+// Partial output of the agent that is answering, replaced by its message once the answer is complete
+function renderStreamDelta(delta) {
+    const chatView = document.getElementById('chatView');
+    let streamingMessage = chatView.querySelector('.streaming-message');
+    if (!streamingMessage) {
+        clearCallingMessages();
+        streamingMessage = document.createElement('p');
+        streamingMessage.className = 'streaming-message chat-bubble ms-2 px-3 pb-3 fs';
+        streamingMessage.style.whiteSpace = 'pre-wrap';
+        chatView.appendChild(streamingMessage);
+    }
+    streamingMessage.textContent += delta;
+    chatView.scrollTop = chatView.scrollHeight;
+}
+
+function clearStreamingMessage() {
+    const chatView = document.getElementById('chatView');
+    chatView.querySelectorAll('.streaming-message').forEach((message) => {
+        chatView.removeChild(message);
+    });
+}
+
 function showFullText(element) {
     const parentMessage = element.parentElement;
     const fullText = parentMessage.dataset.fullText;
@@ -700,8 +722,13 @@ async function connect() {
     };
 
     ws.onmessage = async function (e) {
-        console.log(e['data'])
         var response = JSON.parse(e['data']);
+        if (response["action"] == "stream") {
+            renderStreamDelta(response['data']['delta']);
+            return;
+        }
+        console.log(e['data'])
+        clearStreamingMessage();
         if (response["action"] == "run_task") {
             // console.log(response);
             // nothing to do
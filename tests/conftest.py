@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : conftest.py
+@Desc    : the tests run offline: tiktoken cannot download its encodings, a word-level encoding stands in for them
+"""
+import re
+import sys
+from pathlib import Path
+
+import tiktoken
+import tiktoken.registry
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+class WordEncoding:
+    """One token per word or punctuation mark, with the whitespace before it"""
+    name = "words"
+
+    def encode(self, text, **kwargs):
+        return re.findall(r"\s*(?:\w+|[^\w\s])|\s+", text)
+
+    def encode_ordinary(self, text):
+        return self.encode(text)
+
+    def encode_ordinary_batch(self, texts, num_threads=8):
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+tiktoken.get_encoding = tiktoken.registry.get_encoding = lambda name: WordEncoding()
+tiktoken.encoding_for_model = lambda model: WordEncoding()
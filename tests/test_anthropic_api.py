@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from autoagents.system.provider.anthropic_api import Claude2
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.requests = []
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return SimpleNamespace(completion="hi there")
+
+
+class FakeClient:
+    def __init__(self):
+        self.completions = FakeCompletions()
+
+    def count_tokens(self, text: str) -> int:
+        return len(text.split())
+
+
+class FakeAsyncClient(FakeClient):
+    def __init__(self):
+        super().__init__()
+        sync = self.completions
+
+        async def create(**kwargs):
+            return sync.create(**kwargs)
+
+        self.completions = SimpleNamespace(create=create, requests=sync.requests)
+
+    async def count_tokens(self, text: str) -> int:
+        return super().count_tokens(text)
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.calls = []
+
+    def wait_if_needed_sync(self, num_requests, num_tokens=0):
+        self.calls.append(("wait", num_requests, num_tokens))
+        return 0
+
+    async def wait_if_needed(self, num_requests, num_tokens=0):
+        return self.wait_if_needed_sync(num_requests, num_tokens)
+
+    def settle(self, reserved_tokens, used_tokens):
+        self.calls.append(("settle", reserved_tokens, used_tokens))
+
+
+def make_provider(monkeypatch) -> Claude2:
+    provider = Claude2(api_key="test", model="claude-2")
+    provider.client, provider.sync_client = FakeAsyncClient(), FakeClient()
+    provider.rate_limiter, provider.hedger = CountingLimiter(), None
+    fitted = []
+    fit_messages = provider.context.fit_messages
+    monkeypatch.setattr(provider.context, "fit_messages", lambda messages: fitted.append(1) or fit_messages(messages))
+    provider.fitted = fitted
+    return provider
+
+
+def test_async_request_is_built_once(monkeypatch):
+    provider = make_provider(monkeypatch)
+    rsp = asyncio.run(provider.acompletion_text(MESSAGES))
+    assert rsp == "hi there"
+    assert len(provider.fitted) == 1
+    assert len(provider.client.completions.requests) == 1
+
+
+def test_sync_completion_is_admitted_and_rate_limited(monkeypatch):
+    provider = make_provider(monkeypatch)
+    rsp = provider.completion(MESSAGES)
+    assert provider.get_choice_text(rsp) == "hi there"
+    assert len(provider.fitted) == 1
+    (request,) = provider.sync_client.completions.requests
+    prompt_tokens = rsp["usage"]["prompt_tokens"]
+    reserved = prompt_tokens + request["max_tokens_to_sample"]
+    assert provider.rate_limiter.calls == [("wait", 1, reserved), ("settle", reserved, prompt_tokens + 2)]
+
+
+def test_failed_sync_completion_gives_its_reservation_back(monkeypatch):
+    provider = make_provider(monkeypatch)
+
+    def fail(**kwargs):
+        raise RuntimeError("boom")
+
+    provider.sync_client.completions.create = fail
+    with pytest.raises(RuntimeError):
+        provider.completion(MESSAGES)
+    action, reserved, used = provider.rate_limiter.calls[-1]
+    assert action == "settle" and reserved > 0 and used == 0
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+
+from autoagents.actions import Action
+from autoagents.system.memory.bounded_memory import (BoundedMemory, FIFOEviction, ImportanceEviction, PinnedEviction,
+                                                     extract)
+from autoagents.system.schema import Message
+
+
+class Requirement(Action):
+    pass
+
+
+class Requirement_Group(Requirement):
+    pass
+
+
+class Plan(Action):
+    pass
+
+
+class Execute(Action):
+    pass
+
+
+def messages(n: int, action=Execute) -> list[Message]:
+    return [Message(f"result {i}. More details follow.", role="Coder", cause_by=action) for i in range(n)]
+
+
+def test_extract_keeps_the_first_sentence():
+    assert extract(Message("# Title\nDone with it. Then more.", role="Coder")) == "Coder: Done with it."
+    assert extract(Message("x" * 300), max_chars=10) == "user: " + "x" * 10 + "..."
+
+
+def test_fifo_evicts_the_oldest_into_a_summary():
+    memory = BoundedMemory(max_messages=3, policy=FIFOEviction(), model="gpt-4")
+    memory.add_batch(messages(5))
+    assert [i.content for i in memory.storage] == ["result 2. More details follow.",
+                                                   "result 3. More details follow.",
+                                                   "result 4. More details follow."]
+    summary = memory.summary(Execute)
+    assert summary.content == "Summary of 2 earlier messages:\nCoder: result 0.\nCoder: result 1."
+    assert memory.get()[0] is summary
+    assert memory.get_by_actions([Execute]) == [summary] + memory.storage
+
+
+def test_pinned_actions_are_never_evicted():
+    memory = BoundedMemory(max_messages=2, policy=PinnedEviction(["Requirement"]), model="gpt-4")
+    task = Message("the task", cause_by=Requirement_Group)
+    memory.add(task)
+    memory.add_batch(messages(3))
+    assert memory.storage[0] is task
+    assert memory.count() == 2
+
+
+def test_everything_pinned_keeps_the_memory_over_its_limit():
+    memory = BoundedMemory(max_messages=1, policy=PinnedEviction(["Requirement"]), model="gpt-4")
+    memory.add_batch(messages(2, Requirement))
+    assert memory.count() == 2
+
+
+def test_importance_evicts_the_least_weighted():
+    policy = ImportanceEviction(weights={"Plan": 5}, half_life=100)
+    memory = BoundedMemory(max_messages=2, policy=policy, model="gpt-4")
+    plan = Message("the plan", cause_by=Plan)
+    memory.add(plan)
+    memory.add_batch(messages(2))
+    assert memory.storage[0] is plan
+
+
+def test_token_limit_and_summary_off():
+    memory = BoundedMemory(max_tokens=20, summary="off", model="gpt-4")
+    memory.add_batch(messages(10))
+    assert memory.total_tokens <= 20
+    assert memory.summaries == {} and memory.get() == memory.storage
+
+
+def test_summary_drops_its_oldest_lines_beyond_its_tokens():
+    memory = BoundedMemory(max_messages=1, summary_tokens=10, model="gpt-4")
+    memory.add_batch(messages(20))
+    summary = memory.summaries[Execute]
+    assert summary.folded == 19
+    assert summary.tokens <= 10
+    assert "result 18." in summary.notes and "result 0." not in summary.notes
+
+
+class FakeLLM:
+    def __init__(self):
+        self.prompts = []
+
+    async def aask(self, prompt):
+        self.prompts.append(prompt)
+        return "Results 0 to 2 are in."
+
+
+def test_summarize_condenses_only_stale_summaries():
+    memory = BoundedMemory(max_messages=1, summary="llm", model="gpt-4")
+    memory.add_batch(messages(4))
+    view = memory.get_by_actions([Execute])
+    assert memory.stale()
+    llm = FakeLLM()
+    asyncio.run(memory.summarize(llm))
+    assert len(llm.prompts) == 1 and "Coder: result 0." in llm.prompts[0]
+    assert not memory.stale()
+    assert memory.summary(Execute).content == "Summary of 3 earlier messages:\nResults 0 to 2 are in."
+    assert memory.get_by_actions([Execute]) is not view  # the cached view was dropped
+    asyncio.run(memory.summarize(llm))
+    assert len(llm.prompts) == 1
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import contextvars
+
+from autoagents.system.config import CONFIG
+from autoagents.system.provider import openai_api
+from autoagents.system.provider.openai_api import CostManager, OpenAIGPTAPI, start_task_costs
+
+from test_anthropic_api import CountingLimiter
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def test_admissions_nobody_reads_are_bounded(monkeypatch):
+    monkeypatch.setattr(CONFIG, "budget_max_admissions", 3)
+    costs = CostManager(max_budget=0.0)
+    for i in range(10):
+        costs._reserve(openai_api.Admission(f"role {i % 2}", "", "shortened", "gpt-4", 10, 0.0))
+    assert len(costs.admissions) == 3
+    assert [i.role for i in costs.pop_admissions("role 1")] == ["role 1", "role 1"]
+    assert [i.role for i in costs.admissions] == ["role 0"]
+
+
+def test_sync_completion_is_admitted_and_rate_limited(monkeypatch):
+    provider = OpenAIGPTAPI(api_key="test", model="gpt-4")
+    provider.rate_limiter = CountingLimiter()
+    requests = []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        return {"choices": [{"message": {"role": "assistant", "content": "hi there"}}],
+                "usage": {"prompt_tokens": 5, "completion_tokens": 2}}
+
+    monkeypatch.setattr(provider.llm.ChatCompletion, "create", create)
+    # a task of its own, so the costs do not leak into the other tests
+    costs, rsp = contextvars.copy_context().run(lambda: (start_task_costs(10.0), provider.completion(MESSAGES)))
+    assert provider.get_choice_text(rsp) == "hi there"
+    prompt_tokens = provider._count_prompt_tokens(MESSAGES)
+    reserved = prompt_tokens + requests[0]["max_tokens"]
+    assert provider.rate_limiter.calls == [("wait", 1, reserved), ("settle", reserved, prompt_tokens + 2)]
+    assert costs.reserved == 0 and costs.total_completion_tokens == 2
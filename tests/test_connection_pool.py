@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+
+from autoagents.system.provider import openai_api
+from autoagents.system.provider.openai_api import OpenAIGPTAPI, close_providers
+
+
+def test_pool_is_shared_per_loop_and_closed_when_the_task_ends(monkeypatch):
+    provider = OpenAIGPTAPI(api_key="test", model="gpt-4")
+    monkeypatch.setitem(openai_api._PROVIDERS, ("test",), provider)
+
+    async def task():
+        session = provider._aiosession()
+        assert provider._aiosession() is session
+        await close_providers()
+        return session
+
+    first = asyncio.run(task())
+    assert first.closed and provider._session is None
+    second = asyncio.run(task())
+    assert second is not first and second.closed
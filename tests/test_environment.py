@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from autoagents.actions import Action
+from autoagents.environment import Environment
+from autoagents.roles import Role
+from autoagents.system.provider.openai_api import start_task_costs
+from autoagents.system.schema import Message
+from autoagents.system.utils.common import NoMoneyException
+
+
+class Ping(Action):
+    pass
+
+
+class Pong(Action):
+    pass
+
+
+class Echo(Role):
+    """Answers every message of the action it watches with one of its own action, without an LLM"""
+
+    def __init__(self, profile, action, watch):
+        super().__init__(profile, profile)
+        self._init_actions([action])
+        self._watch([watch])
+        self.runs = 0
+
+    async def _act(self) -> Message:
+        self.runs += 1
+        return Message(content=f"{self.profile} {self.runs}", role=self.profile, cause_by=type(self._rc.todo))
+
+
+def ping_pong() -> tuple[Environment, Echo, Echo]:
+    env = Environment()
+    ping, pong = Echo("Ping", Ping, Pong), Echo("Pong", Pong, Ping)
+    env.add_roles([ping, pong])
+    return env, ping, pong
+
+
+async def serve(env: Environment, n_round=None):
+    await env.publish_message(Message(content="start", role="Human", cause_by=Pong))
+    await env.run(n_round)
+
+
+def test_roles_answering_each_other_stop_at_the_limit():
+    start_task_costs(10)
+    env, ping, pong = ping_pong()
+    asyncio.run(asyncio.wait_for(serve(env, n_round=3), timeout=5))
+    assert ping.runs == 3
+    assert pong.runs == 3
+
+
+def test_run_checks_the_budget_before_every_wakeup():
+    costs = start_task_costs(10)
+    env, ping, pong = ping_pong()
+    costs.total_cost = 11
+    with pytest.raises(NoMoneyException):
+        asyncio.run(asyncio.wait_for(serve(env, n_round=3), timeout=5))
+    assert ping.runs == 0
+
+
+def test_run_ends_when_no_role_has_news():
+    start_task_costs(10)
+    env = Environment()
+    ping = Echo("Ping", Ping, Pong)
+    env.add_role(ping)
+    asyncio.run(asyncio.wait_for(serve(env), timeout=5))
+    assert ping.runs == 1
+
+
+def test_late_role_gets_the_backlog():
+    start_task_costs(10)
+    env = Environment()
+    asyncio.run(env.publish_message(Message(content="start", role="Human", cause_by=Pong)))
+    ping = Echo("Ping", Ping, Pong)
+    env.add_role(ping)
+    asyncio.run(asyncio.wait_for(env.run(1), timeout=5))
+    assert ping.runs == 1
+
+
+class Start(Action):
+    pass
+
+
+class Later(Role):
+    """Answers the start with a Pong after a while"""
+
+    def __init__(self):
+        super().__init__("Later", "Later")
+        self._init_actions([Pong])
+        self._watch([Start])
+
+    async def _act(self) -> Message:
+        await asyncio.sleep(0.05)
+        return Message(content="fresh", role=self.profile, cause_by=Pong)
+
+
+def test_role_consumes_the_messages_taken_from_its_inbox():
+    start_task_costs(10)
+    env = Environment()
+    ping = Echo("Ping", Ping, Pong)
+    env.add_role(ping)
+    # the message never reached the environment's memory, only the inbox
+    rsp = asyncio.run(ping.run(inbox=[Message(content="start", role="Human", cause_by=Pong)]))
+    assert rsp.content == "Ping 1"
+
+
+def test_wakeups_without_news_do_not_count():
+    start_task_costs(10)
+    env = Environment()
+    ping, later = Echo("Ping", Ping, Pong), Later()
+    env.add_roles([ping, later])
+
+    async def serve():
+        seen = Message(content="seen", role="Human", cause_by=Pong)
+        ping.recv(seen)
+        await env.publish_message(seen)
+        await env.publish_message(Message(content="start", role="Human", cause_by=Start))
+        await env.run(1)
+
+    asyncio.run(asyncio.wait_for(serve(), timeout=5))
+    assert ping.runs == 1
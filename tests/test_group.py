@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+from autoagents.roles.group import Group
+from autoagents.system.schema import Message
+from autoagents.system.utils.context_window import ContextWindow
+
+
+def make_group(max_prompt_tokens: int) -> Group:
+    window = ContextWindow("gpt-4")
+    window.max_prompt_tokens = max_prompt_tokens
+    group = Group.__new__(Group)
+    group._llm = SimpleNamespace(context=window)
+    group._rc = SimpleNamespace(todo=SimpleNamespace(prefix="You are a writer.", prompt=lambda step: f"Do {step} now"))
+    group.next_step = "write the report"
+    return group
+
+
+def context_of(group: Group, history: list[Message], completed_steps: str) -> str:
+    sizes = [group._llm.context.count(str(i)) for i in history]
+    return group._context(history, sizes, completed_steps)
+
+
+def test_prompt_that_fits_is_kept_whole():
+    history = [Message(f"step {i} " + "word " * 50) for i in range(5)]
+    completed = "substep " * 200
+    context = context_of(make_group(10000), history, completed)
+    assert str(history) in context
+    assert completed in context
+
+
+def test_overflowing_prompt_shares_what_is_left():
+    group = make_group(400)
+    window = group._llm.context
+    history = [Message(f"step {i} " + "word " * 50) for i in range(10)]
+    context = context_of(group, history, "substep " * 400)
+    assert "earlier messages omitted" in context
+    fixed = window.count(group._rc.todo.prefix + group._rc.todo.prompt(group.next_step))
+    # the headers of the template are not part of the budget
+    assert window.count(context) <= 400 - fixed + 30
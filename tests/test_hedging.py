@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import contextvars
+
+from autoagents.system.provider.hedging import Hedger, hedge, set_hedge_budget
+
+
+def warmed_hedger(ttft=0.01) -> Hedger:
+    hedger = Hedger(percentile=95, min_samples=5)
+    for _ in range(5):
+        hedger.record(ttft)
+    return hedger
+
+
+def streams(*first_token_delays):
+    """start() for hedge: the n-th stream it starts yields its name after the n-th delay"""
+    started = []
+
+    async def stream(name, delay):
+        await asyncio.sleep(delay)
+        yield name
+        yield "!"
+
+    def start():
+        name = f"stream{len(started)}"
+        started.append(name)
+        return stream(name, first_token_delays[len(started) - 1])
+
+    return start, started
+
+
+def run(start, hedger, hedges=5, **kwargs) -> str:
+    async def scenario():
+        set_hedge_budget(hedges)
+        return "".join([delta async for delta in hedge(start, hedger, **kwargs)])
+
+    return contextvars.copy_context().run(asyncio.run, scenario())
+
+
+def test_no_hedging_before_enough_samples():
+    hedger = Hedger(percentile=95, min_samples=5)
+    assert hedger.delay() is None
+    start, started = streams(0.05)
+    assert run(start, hedger) == "stream0!"
+    assert started == ["stream0"]
+
+
+def test_late_stream_is_hedged_and_the_faster_one_kept():
+    start, started = streams(0.5, 0.01)
+    hedged = []
+    assert run(start, warmed_hedger(), on_hedge=lambda: hedged.append(1)) == "stream1!"
+    assert started == ["stream0", "stream1"] and hedged == [1]
+
+
+def test_hedge_needs_a_free_request():
+    start, started = streams(0.1, 0.01)
+    assert run(start, warmed_hedger(), admit_hedge=lambda: False) == "stream0!"
+    assert started == ["stream0"]
+
+
+def test_hedge_needs_budget():
+    start, started = streams(0.1, 0.01)
+    asked = []
+    assert run(start, warmed_hedger(), hedges=0, admit_hedge=lambda: asked.append(1) or True) == "stream0!"
+    assert started == ["stream0"] and asked == []
+
+
+def test_lost_openai_stream_is_closed_and_its_received_tokens_billed(monkeypatch):
+    from autoagents.system.provider import openai_api
+    from test_streaming import FakeLitellmStream
+
+    stream = FakeLitellmStream(["one ", "two ", "three ", "four"])
+    monkeypatch.setattr(openai_api.litellm, "completion", lambda **kwargs: stream)
+    provider = openai_api.OpenAIGPTAPI(api_key="test", model="gpt-4")
+    billed = []
+    monkeypatch.setattr(provider, "_update_costs", lambda usage, admission=None: billed.append(usage))
+
+    async def main():
+        deltas = provider.astream([{"role": "user", "content": "hi"}])
+        first = await deltas.__anext__()
+        for _ in range(100):  # upstream keeps generating while nobody reads
+            if stream.sent == 4:
+                break
+            await asyncio.sleep(0.01)
+        await deltas.aclose()  # what hedge() does with the loser
+        for _ in range(100):
+            if billed:
+                break
+            await asyncio.sleep(0.01)
+        return first
+
+    assert asyncio.run(main()) == "one "
+    assert stream.closed
+    assert billed == [{"prompt_tokens": 0, "completion_tokens": provider._count_completion_tokens("two three four")}]
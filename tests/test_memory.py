@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from autoagents.actions import Action
+from autoagents.system.memory import Memory
+from autoagents.system.schema import Message
+
+
+class Plan(Action):
+    pass
+
+
+class Execute(Action):
+    pass
+
+
+def make_memory() -> Memory:
+    memory = Memory(model="gpt-4")
+    memory.add_batch([
+        Message("write the code for the parser", role="Planner", cause_by=Plan, sent_from="Planner", send_to="Coder"),
+        Message("the decoder is done", role="Coder", cause_by=Execute, sent_from="Coder", send_to="Planner"),
+        Message("review the code, then ship it", role="Planner", cause_by=Plan, sent_from="Planner"),
+    ])
+    return memory
+
+
+def test_try_remember_matches_substrings():
+    memory = make_memory()
+    assert [i.content for i in memory.try_remember("cod")] == ["write the code for the parser",
+                                                               "the decoder is done",
+                                                               "review the code, then ship it"]
+    assert [i.content for i in memory.try_remember("code for the pars")] == ["write the code for the parser"]
+    assert memory.try_remember("Code") == []  # case sensitive, like the plain scan
+    assert memory.try_remember("") == memory.storage
+
+
+def test_get_by_content_agrees_with_a_scan():
+    memory = make_memory()
+    for text in ("the", "e code", "r the p", "then ship", "coder is", "missing"):
+        assert memory.get_by_content(text) == [i for i in memory.storage if text in i.content]
+
+
+def test_indexes_follow_deletes():
+    memory = make_memory()
+    first = memory.storage[0]
+    assert memory.get_by_role("Planner") == [first, memory.storage[2]]
+    assert memory.get_by_actions([Plan]) == [first, memory.storage[2]]
+    memory.delete(first)
+    assert first not in memory
+    assert memory.get_by_role("Planner") == [memory.storage[1]]
+    assert memory.get_by_receiver("Coder") == []
+    assert memory.get_by_actions([Plan]) == [memory.storage[1]]
+    assert memory.try_remember("parser") == []
+    assert memory.total_tokens == sum(memory.count_tokens(memory.storage))
+
+
+def test_duplicates_are_stored_once_and_since_reads_what_is_new():
+    memory = make_memory()
+    messages, seq = memory.since(0)
+    assert len(messages) == 3
+    memory.add(Message("the decoder is done", role="Coder", cause_by=Execute, sent_from="Coder", send_to="Planner"))
+    assert memory.count() == 3
+    memory.add(Message("shipped"))
+    assert [i.content for i in memory.since(seq)[0]] == ["shipped"]
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+
+from autoagents.actions import Action
+from autoagents.system.message_bus import MessageBus
+from autoagents.system.schema import Message
+
+
+class Plan(Action):
+    pass
+
+
+class Review(Action):
+    pass
+
+
+def test_messages_go_to_the_watchers_of_their_action():
+    bus = MessageBus()
+    bus.subscribe("Coder", [Plan])
+    bus.subscribe("Reviewer", [Plan, Review])
+    plan, review = Message("plan", cause_by=Plan), Message("review", cause_by=Review)
+    assert bus.publish(plan) == ["Coder", "Reviewer"]
+    assert bus.publish(review) == ["Reviewer"]
+    assert bus.publish(Message("no action")) == []
+    assert sorted(bus.pending()) == ["Coder", "Reviewer"]
+    assert bus.take("Reviewer") == [plan, review]
+    assert bus.take("Reviewer") == []
+    assert bus.pending() == ["Coder"]
+
+
+def test_subscribing_twice_delivers_once_and_backlog_is_delivered():
+    bus = MessageBus()
+    earlier = Message("earlier", cause_by=Plan)
+    bus.subscribe("Coder", [Plan], backlog=[earlier])
+    bus.subscribe("Coder", [Plan])
+    bus.publish(Message("later", cause_by=Plan))
+    assert [i.content for i in bus.take("Coder")] == ["earlier", "later"]
+
+
+def test_wait_returns_on_the_next_delivery():
+    bus = MessageBus()
+    bus.subscribe("Coder", [Plan])
+
+    async def main():
+        bus.clear()
+        waiter = asyncio.create_task(bus.wait())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        bus.publish(Message("plan", cause_by=Plan))
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(main())
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+
+from autoagents.system.provider.metrics import (
+    MetricsRegistry,
+    TaskMetrics,
+    calling,
+    get_task_metrics,
+    start_task_metrics,
+)
+from autoagents.system.provider.openai_api import OpenAIGPTAPI, start_task_costs
+from autoagents.system.provider.rate_limiter import RateLimiter
+
+
+def batch_provider() -> OpenAIGPTAPI:
+    provider = OpenAIGPTAPI(api_key="test", model="gpt-4")
+    provider.rate_limiter = RateLimiter(rpm=600)  # one request every 0.11s
+
+    async def _achat_completion(messages, admission=None, **kwargs):
+        return {"choices": [{"message": {"content": "ok"}}], "usage": {"total_tokens": 10}}
+
+    provider._achat_completion = _achat_completion
+    return provider
+
+
+def run_batch(size: int, role: str = None) -> list:
+    async def task():
+        start_task_costs(10)
+        start_task_metrics("test")
+        batch = [[{"role": "user", "content": str(i)}] for i in range(size)]
+        if role:
+            with calling(role, "Summarize"):
+                await batch_provider().acompletion_batch(batch)
+        else:
+            await batch_provider().acompletion_batch(batch)
+        return get_task_metrics().calls
+
+    return asyncio.run(task())
+
+
+def test_batch_queue_wait_is_credited():
+    calls = run_batch(3)
+    assert len(calls) == 3
+    assert {i.action for i in calls} == {"batch"}
+    assert sum(i.queue_wait for i in calls) > 0.1
+
+
+def test_batch_calls_belong_to_the_caller():
+    calls = run_batch(2, role="Writer")
+    assert {(i.role, i.action) for i in calls} == {("Writer", "Summarize")}
+
+
+def test_summary_groups_calls_by_caller():
+    metrics = TaskMetrics("test")
+    metrics.calls = run_batch(2) + run_batch(1, role="Writer")
+    summary = metrics.summary()
+    assert summary["calls"] == 3 and summary["errors"] == 0
+    assert summary["by_caller"]["/batch"]["calls"] == 2
+    assert summary["by_caller"]["Writer/Summarize"]["calls"] == 1
+    assert "llm_queue_wait_seconds" in MetricsRegistry().to_prometheus()
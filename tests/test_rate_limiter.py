@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+
+import openai
+import pytest
+
+from autoagents.system.provider.openai_api import OpenAIGPTAPI, start_task_costs
+from autoagents.system.provider.rate_limiter import AdaptiveConcurrency, RateLimiter, TokenBucket
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def test_bucket_goes_into_debt_and_refills():
+    bucket = TokenBucket(capacity=60, per_minute=60)
+    start = bucket.updated
+    assert bucket.reserve(60, now=start) == 0
+    assert bucket.reserve(30, now=start) == pytest.approx(30)  # 30 units at one per second
+    assert bucket.reserve(0, now=start + 30) == 0
+    bucket.refund(1000)
+    assert bucket.level == 60
+
+
+def test_requests_are_paced_one_by_one():
+    limiter = RateLimiter(rpm=60)
+
+    async def two_requests():
+        return await limiter.wait_if_needed(1), await limiter.wait_if_needed(1)
+
+    first, second = asyncio.run(two_requests())
+    assert first == 0
+    assert second == pytest.approx(1.1, abs=0.05)
+
+
+def test_settle_returns_unused_tokens():
+    limiter = RateLimiter(rpm=6000, tpm=1000)
+    asyncio.run(limiter.wait_if_needed(1, 800))
+    limiter.settle(800, 100)
+    assert limiter._tokens.level == pytest.approx(900, abs=1)
+
+
+def test_failed_call_gives_its_reservation_back():
+    start_task_costs(10)
+    provider = OpenAIGPTAPI(api_key="test", model="gpt-4")
+    provider.rate_limiter = RateLimiter(rpm=6000, tpm=100000)
+
+    async def failing(messages, admission=None, **kwargs):
+        raise openai.error.InvalidRequestError("bad request", None)
+
+    provider._achat_completion = failing
+    with pytest.raises(openai.error.InvalidRequestError):
+        asyncio.run(provider._acompletion_text(MESSAGES))
+    assert provider.rate_limiter._tokens.level == pytest.approx(100000, abs=1)
+
+
+def test_adaptive_concurrency_is_aimd():
+    concurrency = AdaptiveConcurrency(initial=4, maximum=8)
+    concurrency.release(overloaded=False)
+    assert concurrency.limit == 5
+    concurrency.release(overloaded=True)
+    assert concurrency.limit == 2.5
+    for _ in range(10):
+        concurrency.release()
+    assert concurrency.limit == 8
+
+
+def test_failed_batch_requests_only_lower_the_limit_when_overloaded():
+    provider = OpenAIGPTAPI(api_key="test", model="gpt-4")
+    provider.rate_limiter = RateLimiter(rpm=6000)
+    concurrency = AdaptiveConcurrency(initial=4)
+
+    async def bad_request(prompt, reserved_tokens):
+        raise openai.error.InvalidRequestError("bad request", None)
+
+    provider._acompletion_batch_call = bad_request
+    with pytest.raises(openai.error.InvalidRequestError):
+        asyncio.run(provider._acompletion_batch_item(0, MESSAGES, concurrency))
+    assert concurrency.limit == 4 and concurrency.in_flight == 0
+
+
+def test_adaptive_concurrency_blocks_at_the_limit():
+    async def scenario():
+        concurrency = AdaptiveConcurrency(initial=1)
+        await concurrency.acquire()
+        waiter = asyncio.create_task(concurrency.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        concurrency.release()
+        await asyncio.wait_for(waiter, 1)
+        return concurrency.in_flight
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_try_acquire_never_waits():
+    limiter = RateLimiter(rpm=60, tpm=1000)
+    assert limiter.try_acquire(1, 100)
+    assert not limiter.try_acquire(1, 100)  # the next request is only free in 1.1s
+    assert limiter._tokens.level == 900  # a refused try reserves nothing
+
+
+def test_try_acquire_respects_retry_after():
+    limiter = RateLimiter(rpm=6000)
+    limiter.defer(10)
+    assert not limiter.try_acquire()
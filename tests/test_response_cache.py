@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+
+import pytest
+
+from autoagents.system.provider.openai_api import Admission, OpenAIGPTAPI
+from autoagents.system.provider.response_cache import CacheMissError, ResponseCache
+from autoagents.system.utils.singleton import Singleton
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def make_cache(tmp_path, mode="on", max_size_mb=1) -> ResponseCache:
+    cache = ResponseCache.__new__(ResponseCache)
+    cache.__init__(path=tmp_path / "cache.sqlite", mode=mode, max_size_mb=max_size_mb)
+    return cache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path)
+    monkeypatch.setitem(Singleton._instances, ResponseCache, cache)
+    return cache
+
+
+def provider_answering(decision: str) -> OpenAIGPTAPI:
+    provider = OpenAIGPTAPI(api_key="test", model="gpt-4")
+    provider.calls = 0
+
+    async def _acompletion_text(messages, stream=False, sinks=()):
+        provider.calls += 1
+        return f"answer {provider.calls}", Admission("", "", decision, "gpt-4", 100, 0.0)
+
+    provider._acompletion_text = _acompletion_text
+    return provider
+
+
+def test_put_get_and_replay_miss(tmp_path):
+    cache = make_cache(tmp_path)
+    key = cache.make_key({"model": "gpt-4", "messages": MESSAGES})
+    assert cache.get(key) is None
+    cache.put(key, "hi")
+    assert cache.get(key) == "hi"
+    with pytest.raises(CacheMissError):
+        make_cache(tmp_path, mode="replay").get("unknown")
+
+
+def test_key_depends_on_the_request():
+    request = {"model": "gpt-4", "messages": MESSAGES, "max_tokens": 100}
+    assert ResponseCache.make_key(request) == ResponseCache.make_key(dict(request, api_key="other"))
+    assert ResponseCache.make_key(request) != ResponseCache.make_key(dict(request, max_tokens=50))
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = make_cache(tmp_path, max_size_mb=0.001)  # about 1kB
+    for i in range(4):
+        cache.put(str(i), "x" * 400)
+    assert cache.get("0") is None
+    assert cache.get("3") is not None
+
+
+def test_full_answers_are_served_from_cache(cache):
+    provider = provider_answering("admitted")
+    assert asyncio.run(provider.acompletion_text(MESSAGES)) == "answer 1"
+    assert asyncio.run(provider.acompletion_text(MESSAGES)) == "answer 1"
+    assert provider.calls == 1
+
+
+@pytest.mark.parametrize("decision", ["shortened", "downgraded"])
+def test_answers_degraded_by_the_budget_are_not_cached(cache, decision):
+    provider = provider_answering(decision)
+    asyncio.run(provider.acompletion_text(MESSAGES))
+    assert asyncio.run(provider.acompletion_text(MESSAGES)) == "answer 2"
+    assert provider.calls == 2
+
+
+class Recorder:
+    def __init__(self):
+        self.deltas, self.ends = [], []
+
+    def on_start(self):
+        self.deltas = []
+
+    def on_delta(self, delta):
+        self.deltas.append(delta)
+
+    def on_end(self, text):
+        self.ends.append(text)
+
+
+def test_cached_answers_are_replayed_to_the_sinks(cache):
+    provider = provider_answering("admitted")
+    asyncio.run(provider.acompletion_text(MESSAGES))
+    sink = Recorder()
+    assert asyncio.run(provider.acompletion_text(MESSAGES, stream=True, sinks=[sink])) == "answer 1"
+    assert sink.deltas == ["answer 1"] and sink.ends == ["answer 1"]
+
+
+def rejecting(*bad):
+    def check(rsp):
+        if rsp in bad:
+            raise ValueError(f"cannot parse {rsp!r}")
+    return check
+
+
+def test_answers_the_caller_rejects_are_not_cached(cache):
+    provider = provider_answering("admitted")
+    with pytest.raises(ValueError):
+        asyncio.run(provider.acompletion_text(MESSAGES, check=rejecting("answer 1")))
+    # the retry after the parse failure asks again instead of getting the broken answer back
+    assert asyncio.run(provider.acompletion_text(MESSAGES, check=rejecting("answer 1"))) == "answer 2"
+    assert asyncio.run(provider.acompletion_text(MESSAGES)) == "answer 2"
+    assert provider.calls == 2
+
+
+def test_recorded_answers_the_caller_rejects_are_asked_again(cache):
+    provider = provider_answering("admitted")
+    asyncio.run(provider.acompletion_text(MESSAGES))
+    assert asyncio.run(provider.acompletion_text(MESSAGES, check=rejecting("answer 1"))) == "answer 2"
+    assert provider.calls == 2
+
+
+def test_malformed_json_is_not_cached(cache):
+    provider = OpenAIGPTAPI(api_key="test", model="gpt-4")
+    answers = ['{"Answer": "broken', '{"Answer": "fine"}']
+
+    async def _acompletion_json(messages, function):
+        return answers.pop(0), Admission("", "", "admitted", "gpt-4", 100, 0.0)
+
+    provider._acompletion_json = _acompletion_json
+    schema = {"type": "object", "properties": {"Answer": {"type": "string"}}}
+    with pytest.raises(json.JSONDecodeError):
+        asyncio.run(provider.aask_json("hello", schema, "answer"))
+    assert asyncio.run(provider.aask_json("hello", schema, "answer")) == {"Answer": "fine"}
+    assert asyncio.run(provider.aask_json("hello", schema, "answer")) == {"Answer": "fine"}
+    assert answers == []
+
+
+def test_json_failing_the_schema_check_is_not_cached(cache):
+    provider = OpenAIGPTAPI(api_key="test", model="gpt-4")
+    answers = ['{"Other": 1}', '{"Answer": "fine"}']
+
+    async def _acompletion_json(messages, function):
+        return answers.pop(0), Admission("", "", "admitted", "gpt-4", 100, 0.0)
+
+    def check(data):
+        if "Answer" not in data:
+            raise ValueError("Answer missing")
+
+    provider._acompletion_json = _acompletion_json
+    with pytest.raises(ValueError):
+        asyncio.run(provider.aask_json("hello", {}, "answer", check=check))
+    assert asyncio.run(provider.aask_json("hello", {}, "answer", check=check)) == {"Answer": "fine"}
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+
+import openai
+import pytest
+
+from autoagents.system.provider import retry_policy
+from autoagents.system.provider.retry_policy import (CircuitBreaker, CircuitOpenError, ErrorKind, classify_error,
+                                                     retry, retry_after, set_retry_budget)
+
+
+class StatusError(Exception):
+    def __init__(self, status: int, headers: dict = None):
+        super().__init__(f"status {status}")
+        self.status_code = status
+        self.headers = headers or {}
+
+
+class FakeLimiter:
+    def __init__(self):
+        self.deferred = []
+
+    def defer(self, delay):
+        self.deferred.append(delay)
+
+
+class Flaky:
+    """Fails with `errors` in turn, then answers"""
+
+    def __init__(self, errors, endpoint="test"):
+        self.errors = list(errors)
+        self.endpoint = endpoint
+        self.rate_limiter = FakeLimiter()
+        self.calls = 0
+
+    @retry(max_retries=4)
+    async def call(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(retry_policy, "backoff", lambda attempt: 0)
+    monkeypatch.setattr(retry_policy, "_CIRCUIT_BREAKERS", {})
+
+
+def run_with_budget(coro_fn, retries=10):
+    async def main():
+        set_retry_budget(retries)
+        return await coro_fn()
+    return asyncio.run(main())
+
+
+def test_classify_error():
+    assert classify_error(openai.error.RateLimitError("slow down")) == ErrorKind.RATE_LIMITED
+    assert classify_error(StatusError(429)) == ErrorKind.RATE_LIMITED
+    assert classify_error(openai.error.AuthenticationError("no key")) == ErrorKind.FATAL
+    assert classify_error(StatusError(400)) == ErrorKind.FATAL
+    assert classify_error(StatusError(408)) == ErrorKind.TRANSIENT
+    assert classify_error(StatusError(503)) == ErrorKind.TRANSIENT
+    assert classify_error(asyncio.TimeoutError()) == ErrorKind.TRANSIENT
+    assert classify_error(ValueError("unknown")) == ErrorKind.TRANSIENT
+    assert retry_after(StatusError(429, {"retry-after": "2"})) == 2.0
+    assert retry_after(StatusError(429)) is None
+
+
+def test_transient_errors_are_retried():
+    provider = Flaky([StatusError(503), asyncio.TimeoutError()])
+    assert run_with_budget(provider.call) == "ok"
+    assert provider.calls == 3
+
+
+def test_fatal_errors_are_raised_at_once():
+    provider = Flaky([StatusError(401)])
+    with pytest.raises(StatusError):
+        run_with_budget(provider.call)
+    assert provider.calls == 1
+
+
+def test_retry_after_defers_the_rate_limiter():
+    provider = Flaky([StatusError(429, {"retry-after": "3"})])
+    assert run_with_budget(provider.call) == "ok"
+    assert provider.rate_limiter.deferred == [3.0]
+
+
+def test_retry_budget_bounds_the_retries():
+    provider = Flaky([StatusError(503)] * 3)
+    with pytest.raises(StatusError):
+        run_with_budget(provider.call, retries=1)
+    assert provider.calls == 2
+
+
+def test_circuit_opens_then_lets_one_trial_through(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retry_policy.time, "time", lambda: now[0])
+    breaker = CircuitBreaker("test", threshold=2, reset_timeout=30)
+    breaker.before_call()
+    breaker.on_failure()
+    breaker.before_call()
+    breaker.on_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    now[0] += 31
+    breaker.before_call()  # the trial call
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # only one at a time
+    breaker.on_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # re-opened by the failed trial
+
+    now[0] += 31
+    breaker.before_call()
+    breaker.on_success()
+    breaker.before_call()
+    assert breaker.opened_at is None and breaker.failures == 0
+
+
+def test_open_circuit_fails_fast():
+    provider = Flaky([StatusError(503)] * 10, endpoint="down")
+    retry_policy._CIRCUIT_BREAKERS["down"] = CircuitBreaker("down", threshold=2, reset_timeout=60)
+    with pytest.raises(CircuitOpenError):
+        run_with_budget(provider.call)
+    assert provider.calls == 2
+
+
+def test_cancelled_trial_does_not_keep_the_circuit_open(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retry_policy.time, "time", lambda: now[0])
+    breaker = CircuitBreaker("slow", threshold=1, reset_timeout=30)
+    retry_policy._CIRCUIT_BREAKERS["slow"] = breaker
+    breaker.on_failure()
+    now[0] += 31
+
+    class Hanging(Flaky):
+        @retry(max_retries=4)
+        async def call(self):
+            self.calls += 1
+            if self.calls == 1:
+                await asyncio.sleep(60)
+            return "ok"
+
+    provider = Hanging([], endpoint="slow")
+
+    async def main():
+        trial = asyncio.create_task(provider.call())
+        await asyncio.sleep(0)
+        assert breaker.trial_running
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        assert not breaker.trial_running
+        return await provider.call()
+
+    assert run_with_budget(main) == "ok"
+    assert breaker.opened_at is None
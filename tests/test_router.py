@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import contextvars
+
+from autoagents.system.provider.router import CLASSIFICATION, GENERATION, Router, RoutedLLM, task_route_summary
+from autoagents.system.provider.openai_api import start_task_costs
+
+
+class EchoLLM:
+    async def aask(self, msg, system_msgs=None, sinks=(), check=None):
+        return msg
+
+
+def run_task(task_class: str, calls: int) -> dict:
+    async def task():
+        start_task_costs(10)
+        llm = RoutedLLM(task_class, EchoLLM())
+        for i in range(calls):
+            await llm.aask(str(i))
+        return task_route_summary()
+
+    return asyncio.run(task())
+
+
+def test_routes_pick_configured_models():
+    router = Router.__new__(Router)
+    router.__init__({CLASSIFICATION: "gpt-3.5-turbo"})
+    assert router.model(CLASSIFICATION) == "gpt-3.5-turbo"
+    assert router.model(GENERATION) == ""
+
+
+def test_route_stats_of_tasks_stay_apart():
+    first = contextvars.copy_context().run(run_task, CLASSIFICATION, 2)
+    second = contextvars.copy_context().run(run_task, GENERATION, 3)
+    assert first[CLASSIFICATION]["calls"] == 2 and GENERATION not in first
+    assert second[GENERATION]["calls"] == 3 and CLASSIFICATION not in second
+    assert Router().stats[CLASSIFICATION].calls >= 2
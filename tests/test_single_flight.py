@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from autoagents.system.provider.openai_api import Admission, OpenAIGPTAPI
+from autoagents.system.provider.single_flight import SingleFlight
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def test_concurrent_calls_share_one_result():
+    flight, calls = SingleFlight(), []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def scenario():
+        return await asyncio.gather(*[flight.do("key", fn) for _ in range(5)])
+
+    assert asyncio.run(scenario()) == ["result"] * 5
+    assert len(calls) == 1
+
+
+def test_followers_get_the_exception():
+    flight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def scenario():
+        return await asyncio.gather(flight.do("key", fn), flight.do("key", fn), return_exceptions=True)
+
+    assert all(isinstance(i, ValueError) for i in asyncio.run(scenario()))
+
+
+def test_follower_takes_over_when_the_leader_is_cancelled():
+    flight, calls = SingleFlight(), []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def scenario():
+        leader = asyncio.create_task(flight.do("key", fn))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("key", fn))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(scenario()) == "result"
+    assert len(calls) == 2
+
+
+def test_followers_get_the_answer_replayed_to_their_sinks():
+    provider = OpenAIGPTAPI(api_key="test", model="gpt-4")
+
+    async def _acompletion_text(messages, stream=False, sinks=()):
+        await asyncio.sleep(0.01)
+        for sink in sinks:
+            sink.on_start()
+            sink.on_delta("streamed")
+            sink.on_end("streamed")
+        return "streamed", Admission("", "", "admitted", "gpt-4", 100, 0.0)
+
+    provider._acompletion_text = _acompletion_text
+    received = {}
+
+    class Sink:
+        def __init__(self, name):
+            self.name = name
+
+        def on_start(self):
+            received[self.name] = []
+
+        def on_delta(self, delta):
+            received[self.name].append(delta)
+
+        def on_end(self, text):
+            pass
+
+    async def scenario():
+        return await asyncio.gather(*[provider.acompletion_text(MESSAGES, stream=True, sinks=[Sink(i)])
+                                      for i in range(3)])
+
+    assert asyncio.run(scenario()) == ["streamed"] * 3
+    assert received == {0: ["streamed"], 1: ["streamed"], 2: ["streamed"]}
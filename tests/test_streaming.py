@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+
+import openai
+import pytest
+
+from autoagents.system.provider import retry_policy
+from autoagents.system.provider.rate_limiter import RateLimiter
+from autoagents.system.provider.retry_policy import retry
+from autoagents.system.provider.streaming import LogSink, QueueSink, collect
+from autoagents.system.utils.common import IncrementalOutputParser, OutputDivergedError
+
+MAPPING = {"Steps": (str, ...), "Answer": (str, ...)}
+OUTPUT = "## Steps\n1. think\n## Answer\n42\n## End\n"
+
+
+async def deltas(text, fail_after=None):
+    for i, delta in enumerate(text.split(" ")):
+        if fail_after is not None and i == fail_after:
+            raise openai.error.APIConnectionError("connection reset")
+        yield delta + " "
+
+
+class FlakyProvider:
+    """Streams a partial answer, fails, then streams the full answer on the retry"""
+    endpoint = "test://flaky"
+
+    def __init__(self):
+        self.rate_limiter = RateLimiter(rpm=6000)
+        self.attempts = 0
+
+    @retry(max_retries=3)
+    async def ask(self, sinks):
+        self.attempts += 1
+        return await collect(deltas(OUTPUT, fail_after=3 if self.attempts == 1 else None), sinks)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(retry_policy, "backoff", lambda attempt: 0)
+
+
+def test_parser_starts_over_on_retry():
+    blocks = []
+    parser = IncrementalOutputParser(MAPPING, on_block=lambda title, content: blocks.append(title))
+    provider = FlakyProvider()
+    text = asyncio.run(provider.ask([parser]))
+    assert provider.attempts == 2
+    assert parser.text == text
+    assert list(parser.blocks) == ["Steps", "Answer"]
+    # the block the failed attempt closed was reported then, the retry reports every block again
+    assert blocks == ["Steps", "Steps", "Answer"]
+
+
+def test_parser_rejects_repeated_block():
+    parser = IncrementalOutputParser(MAPPING)
+    with pytest.raises(OutputDivergedError, match="repeated"):
+        for delta in ["## Steps\n1.\n", "## Steps\n2.\n", "## Answer\n"]:
+            parser.feed(delta)
+
+
+def test_parser_rejects_long_preamble():
+    parser = IncrementalOutputParser(MAPPING, max_preamble=10)
+    with pytest.raises(OutputDivergedError, match="no block"):
+        parser.feed("Sure! Here is the answer you asked for")
+
+
+def test_queue_sink_drops_unsent_rest_of_failed_attempt():
+    queue = asyncio.Queue()
+    sink = QueueSink(queue, flush_size=1000)
+    sink.on_start()
+    sink.on_delta("partial")
+    sink.on_start()
+    sink.on_delta("full answer")
+    sink.on_end("full answer")
+    assert [queue.get_nowait() for _ in range(queue.qsize())] == ["full answer"]
+
+
+def test_log_sink_buffers_lines():
+    sink = LogSink()
+    sink.on_delta("par")
+    sink.on_start()
+    assert sink._line == []
+
+
+class FakeLitellmStream:
+    """What litellm.completion(stream=True) returns: an iterator over chunks, read synchronously"""
+
+    def __init__(self, deltas):
+        self.threads = set()
+        self.sent = 0
+        self.closed = False
+        self.completion_stream = self._chunks(deltas)
+
+    def _chunks(self, deltas):
+        for delta in deltas:
+            self.threads.add(threading.get_ident())
+            self.sent += 1
+            yield {"choices": [{"delta": {"content": delta}}]}
+
+    def __iter__(self):
+        return self.completion_stream
+
+    def close(self):
+        self.closed = True
+
+
+def test_openai_stream_is_read_in_a_single_executor_task(monkeypatch):
+    from autoagents.system.provider import openai_api
+    stream = FakeLitellmStream(["a ", "b ", "c"])
+    monkeypatch.setattr(openai_api.litellm, "completion", lambda **kwargs: stream)
+    provider = openai_api.OpenAIGPTAPI(api_key="test", model="gpt-4")
+    hops = []
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        run_in_executor = loop.run_in_executor
+        monkeypatch.setattr(loop, "run_in_executor", lambda *args: hops.append(1) or run_in_executor(*args))
+        return [delta async for delta in provider.astream([{"role": "user", "content": "hi"}])]
+
+    assert asyncio.run(main()) == ["a ", "b ", "c"]
+    assert hops == [1] and len(stream.threads) == 1
+    assert stream.closed
@@ -120,7 +120,9 @@ async def send_msg_worker(websocket=None, alg_msg_queue=None):
             await asyncio.sleep(0.5)
         else:
             msg = alg_msg_queue.get_nowait()
-            print("=====Sending msg=====\n", msg)
+            if json.loads(msg)["action"] != MessageType.Stream.value:
+                # partial output is sent as it streams, logging every piece of it would flood the log
+                print("=====Sending msg=====\n", msg)
             await websocket.send(msg)
 
 async def echo(websocket, proxy=None, llm_api_key=None, serpapi_key=None):